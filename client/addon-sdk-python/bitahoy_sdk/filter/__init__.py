@@ -11,6 +11,7 @@ from . import dhcpv6 as DHCPv6
 class TrafficFilter:
 
     def __init__(self, condition=None):
+        self.__compiled = None
         self.__symbool = ast.SymbolicBool(ast.ASTNode("TRUE", None, None))
         if condition is not None:
             assert isinstance(condition, ast.SymbolicBool)
@@ -32,17 +33,36 @@ class TrafficFilter:
     def get_ast(self):
         return self.__symbool.ast
 
+    def optimize(self, merge_loads=True):
+        """Equivalent filter with a smaller AST, see bitahoy_sdk.filter.optimizer"""
+        from bitahoy_sdk.filter.optimizer import optimize
+        return TrafficFilter(ast.SymbolicBool(optimize(self.get_ast(), merge_loads)))
+
     def __repr__(self):
         return f"TrafficFilter({repr(self.get_ast())})"
 
     def __str__(self):
         return repr(self)
 
+    def __getstate__(self):
+        # the generated function can not be pickled, it is compiled again when it is needed
+        state = self.__dict__.copy()
+        state["_TrafficFilter__compiled"] = None
+        return state
+
+    def compile(self):
+        """
+        Compile the filter to a Python function packet -> bool, it has the same result as Evaluator.
+        The function is generated once and cached on the filter.
+        """
+        if self.__compiled is None:
+            from bitahoy_sdk.filter.matcher import compile_filter
+            self.__compiled = compile_filter(self.get_ast())
+        return self.__compiled
+
     def evaluate(self, packet):
         assert isinstance(packet, bytes)
-        from bitahoy_sdk.filter.eval import Evaluator
-        evaluator = Evaluator(self)
-        return evaluator.evaluate(packet)
+        return self.compile()(packet)
 
 
 
@@ -63,6 +83,10 @@ class DissectedPacket:
         # assume its always a comparison between astnode and integer
         if isinstance(l, ast.ASTNode):
             return self.packet[l.l:l.r] == r.l
+        if attribute.ast.op == "LDX":
+            # behind the IPv4 header
+            offset = 14 + 4 * (self.packet[14] & 0xF)
+            return self.packet[offset + l:offset + r]
         return self.packet[l:r]
 
 
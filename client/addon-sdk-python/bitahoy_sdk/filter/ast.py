@@ -1,10 +1,10 @@
-from bitahoy_sdk.filter.bpf_building.bpf_builder import get_bpf_bytecode_from_tcpdump
 from bitahoy_sdk.filter.eval import unpack
 
 
 class ASTNode:
 
-    ops = ["LD", "EQ", "LDI", "LDB", "EXISTS", "NOT", "TRUE", "AND", "OR"]
+    # LDX loads relative to the end of the IPv4 header, IN compares with a frozenset of ints, MEQ with a (mask, value) pair
+    ops = ["LD", "LDX", "EQ", "LT", "GT", "IN", "MEQ", "LDI", "LDB", "EXISTS", "NOT", "TRUE", "AND", "OR"]
 
     def __init__(self, op, l=None, r=None):  # noqa: E741
         self.op = op
@@ -28,8 +28,17 @@ class ASTNode:
             return "(" + self.l.to_c_bpf() + " && " + self.r.to_c_bpf() + ")"
         elif self.op == "OR":
             return "(" + self.l.to_c_bpf() + " || " + self.r.to_c_bpf() + ")"
+        elif self.op in ("LT", "GT"):
+            return "(" + self.l.to_c_bpf() + (" < " if self.op == "LT" else " > ") + self.r.to_c_bpf() + ")"
+        elif self.op == "IN":
+            return "(" + (" || ".join(f"({self.l.to_c_bpf()} == {value})" for value in sorted(self.r)) or "false") + ")"
+        elif self.op == "MEQ":
+            return f"(({self.l.to_c_bpf()} & {self.r[0]}) == {self.r[1]})"
         elif self.op == "LD":
             return f"getnum({self.l}, {self.r})"
+        elif self.op == "LDX":
+            offset = "14 + ((packet[14] & 15) << 2)"
+            return f"getnum({offset} + {self.l}, {offset} + {self.r})"
         elif self.op == "LDI":
             return str(self.l)
         elif self.op == "LDB":
@@ -53,17 +62,31 @@ class ASTNode:
             return (
                 "(" + self.l.to_tcpdump_expr() + " || " + self.r.to_tcpdump_expr() + ")"
             )
+        elif self.op in ("LT", "GT"):
+            return (
+                "(" + self.l.to_tcpdump_expr() + (" < " if self.op == "LT" else " > ") + self.r.to_tcpdump_expr() + ")"
+            )
+        elif self.op == "IN":
+            field = self.l.to_tcpdump_expr()
+            return "(" + (" || ".join(f"{field} == {value}" for value in sorted(self.r)) or "not(1==1)") + ")"
+        elif self.op == "MEQ":
+            return f"({self.l.to_tcpdump_expr()} & {self.r[0]} == {self.r[1]})"
         elif self.op == "LD":
             return (
                 f"ether[{self.l}:{self.r - self.l}]"  # tcp dump expr ether[start:len]
             )
+        elif self.op == "LDX":
+            # the IHL is the low nibble of the first byte of the IPv4 header
+            return f"ether[14 + ((ether[14] & 15) << 2) + {self.l}:{self.r - self.l}]"
         elif self.op == "LDI":
             return str(self.l)
         elif self.op == "LDB":
             return str(unpack(self.l))
 
     async def to_bpf_bytecode(self):
-        return await get_bpf_bytecode_from_tcpdump(self.to_tcpdump_expr())
+        from bitahoy_sdk.filter.bpf_building.bpf_compiler import compile_bpf
+
+        return compile_bpf(self)
 
 
 class SymbolicBool:
@@ -104,13 +127,24 @@ class SymbolicBool:
 
 class SymbolicField:
     def __init__(self, astnode):
-        assert astnode.op == "LD"
+        assert astnode.op in ("LD", "LDX")
         self.ast = astnode
 
     def __len__(self):
-        assert self.ast.op == "LD"
+        assert self.ast.op in ("LD", "LDX")
         return self.ast.r - self.ast.l
 
+    def __value(self, value):
+        if isinstance(value, bytes):
+            assert len(self) == len(
+                value
+            ), "You can only compare fields/values of same size ({} != {})".format(
+                len(self), len(value)
+            )
+            return unpack(value)
+        assert isinstance(value, int) and 0 <= value < 256 ** len(self), "Value does not fit the field: {}".format(value)
+        return value
+
     def __boolop(self, other, op):
         if isinstance(other, SymbolicField):
             assert len(self) == len(
@@ -139,15 +173,57 @@ class SymbolicField:
         return self.__boolop(other, "EQ")
 
     def __ne__(self, other) -> SymbolicBool:
-        return self.__boolop(other, "EQ").__not__()
+        return self.__boolop(other, "EQ").negate()
+
+    def __lt__(self, other) -> SymbolicBool:
+        assert len(self) <= 4, "Only fields of up to 4 bytes can be ordered"
+        return self.__boolop(other, "LT")
+
+    def __gt__(self, other) -> SymbolicBool:
+        assert len(self) <= 4, "Only fields of up to 4 bytes can be ordered"
+        return self.__boolop(other, "GT")
+
+    def __le__(self, other) -> SymbolicBool:
+        return self.__gt__(other).negate()
+
+    def __ge__(self, other) -> SymbolicBool:
+        return self.__lt__(other).negate()
+
+    def __and__(self, mask) -> "SymbolicMaskedField":
+        assert len(self) <= 4, "Only fields of up to 4 bytes can be masked"
+        return SymbolicMaskedField(self, self.__value(mask))
+
+    def isin(self, values) -> SymbolicBool:
+        """The field is one of the values (ints or bytes), e.g. UDP.dst_port.isin([53, 853, 5353])"""
+        return SymbolicBool(ASTNode("IN", self.ast, frozenset(self.__value(value) for value in values)))
+
+
+class SymbolicMaskedField:
+    """The bits of a field that are set in a mask, e.g. (IPv4.source & 0xFF000000) == 0x0A000000"""
+
+    def __init__(self, field: SymbolicField, mask: int):
+        self.field = field
+        self.mask = mask
+
+    def __eq__(self, value) -> SymbolicBool:
+        if isinstance(value, bytes):
+            assert len(self.field) == len(value), "You can only compare fields/values of same size"
+            value = unpack(value)
+        assert value & self.mask == value, "The value has bits outside of the mask"
+        return SymbolicBool(ASTNode("MEQ", self.field.ast, (self.mask, value)))
+
+    def __ne__(self, value) -> SymbolicBool:
+        return self.__eq__(value).negate()
 
 
 class SymbolicPacket:
+    load = "LD"
+
     def __getitem__(self, key):
         if isinstance(key, int):
             assert isinstance(key, int)
             assert key >= 0
-            astnode = ASTNode("LD", key, key + 1)
+            astnode = ASTNode(self.load, key, key + 1)
             return SymbolicField(astnode)
         elif isinstance(key, slice):
             assert isinstance(key.start, int), "Only fixed-size slices allowed"
@@ -155,7 +231,16 @@ class SymbolicPacket:
             assert key.step is None, "Slice steps are not supported"
             assert key.start >= 0
             assert key.stop > key.start
-            astnode = ASTNode("LD", key.start, key.stop)
+            astnode = ASTNode(self.load, key.start, key.stop)
             return SymbolicField(astnode)
         else:
             raise ValueError("Unknown or incompatible operand: " + type(key))
+
+
+class SymbolicTransportHeader(SymbolicPacket):
+    """
+    Offsets relative to the end of the IPv4 header of an EthernetII frame, i.e. into the TCP or UDP header.
+    The IPv4 header is longer than 20 bytes if it has options, so these fields have no fixed offset in the frame.
+    """
+
+    load = "LDX"
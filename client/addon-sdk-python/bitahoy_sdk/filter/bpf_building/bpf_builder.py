@@ -3,6 +3,8 @@ import struct
 import tempfile
 import sys
 
+from bitahoy_sdk.filter.bpf_building.cache import bytecode_cache, normalize
+
 FILENAME = "bpfcode.c"
 REPLACEMENT = "BPFBALLERN"
 
@@ -55,6 +57,10 @@ async def get_bpf_bytecode_from_c(bpf_filter: str):
 
 
 async def get_bpf_bytecode_from_tcpdump(bpf_filter: str) -> bytes:
+    key = ("tcpdump", normalize(bpf_filter))
+    code = bytecode_cache.get(key)
+    if code is not None:
+        return code
     tcpdump_args = ["tcpdump", "-ddd", bpf_filter]
     tcpdump = await asyncio.create_subprocess_exec(
         *tcpdump_args, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE
@@ -88,4 +94,5 @@ async def get_bpf_bytecode_from_tcpdump(bpf_filter: str) -> bytes:
             struct.pack("HBBI", int(instructions[0]), int(instructions[1]), int(instructions[2]), int(instructions[3]))
         )
 
+    bytecode_cache.put(key, code)
     return code
@@ -0,0 +1,285 @@
+"""
+Classic BPF code generator for TrafficFilter ASTs, the programs can be attached with SO_ATTACH_FILTER.
+Like the programs tcpdump generates, a program rejects packets that are too short for one of its loads.
+IN compiles to a jump table that searches the sorted set with jge before it compares with jeq.
+"""
+import struct
+
+from bitahoy_sdk.filter.ast import ASTNode
+from bitahoy_sdk.filter.bpf_building.cache import BPF_MAXINSNS, ast_key, bytecode_cache
+from bitahoy_sdk.filter.eval import unpack
+
+# linux/filter.h
+BPF_LD = 0x00
+BPF_LDX = 0x01
+BPF_ST = 0x02
+BPF_ALU = 0x04
+BPF_JMP = 0x05
+BPF_RET = 0x06
+BPF_W = 0x00
+BPF_H = 0x08
+BPF_B = 0x10
+BPF_ABS = 0x20
+BPF_IND = 0x40
+BPF_MEM = 0x60
+BPF_MSH = 0xA0
+BPF_AND = 0x50
+BPF_JA = 0x00
+BPF_JEQ = 0x10
+BPF_JGT = 0x20
+BPF_JGE = 0x30
+BPF_K = 0x00
+BPF_X = 0x08
+
+# part of the keys of the cached programs, bump it whenever the generated code changes
+COMPILER_VERSION = 3
+
+ACCEPT = 0xFFFFFFFF
+SIZES = {4: BPF_W, 2: BPF_H, 1: BPF_B}
+# sets up to this size are compared one after the other, larger ones are split in halves first
+LINEAR_SEARCH = 4
+
+
+def _chunks(l, r):  # noqa: E741
+    """Split the bytes l to r into loads of 4, 2 and 1 bytes"""
+    while l < r:
+        size = 4 if r - l >= 4 else 2 if r - l >= 2 else 1
+        yield l, l + size
+        l += size  # noqa: E741
+
+
+def _constant(node):
+    return node.l if node.op == "LDI" else unpack(node.l)
+
+
+def _is_load(node):
+    return node.op in ("LD", "LDX")
+
+
+def _check_width(node):
+    if node.r - node.l not in SIZES:
+        raise ValueError("Only fields of 1, 2 or 4 bytes can be ordered or masked, not {}".format(node))
+
+
+class _Compiler:
+    """
+    The instructions are generated from the end of the program to its start. Jumps only go forward, so their targets
+    are generated before the jumps and a target is the index of its instruction counted from the end of the program.
+    """
+
+    def __init__(self):
+        self.code = []
+        self.trampolines = {}  # target -> label of the last unconditional jump to it
+
+    def emit(self, code, k=0, jt=None, jf=None):
+        """:return: label of the instruction, jt and jf are labels of the instructions to jump to"""
+        targets = []
+        for target in (jt, jf):
+            # the detour of the other target can add an instruction in between
+            if target is not None and len(self.code) - target - 1 > 0xFF - 1:
+                # out of range for a conditional jump, take a detour through an unconditional one
+                target = self.jump(target)
+            targets.append(target)
+        offsets = [0 if target is None else len(self.code) - target - 1 for target in targets]
+        self.code.append(struct.pack("HBBI", code, offsets[0], offsets[1], k & 0xFFFFFFFF))
+        return len(self.code) - 1
+
+    def jump(self, target):
+        return self.emit(BPF_JMP | BPF_JA | BPF_K, len(self.code) - target - 1)
+
+    def reach(self, target):
+        """:return: label of the target or of a jump to it that the next few conditional jumps can reach"""
+        near = self.trampolines.get(target, target)
+        if len(self.code) - near > 0xF0:
+            near = self.trampolines[target] = self.jump(target)
+        return near
+
+    def load(self, l, r, transport=False):  # noqa: E741
+        """:param transport: offsets relative to the end of the IPv4 header, X is set to its length first"""
+        if not transport:
+            return self.emit(BPF_LD | SIZES[r - l] | BPF_ABS, l)
+        self.emit(BPF_LD | SIZES[r - l] | BPF_IND, 14 + l)
+        return self.emit(BPF_LDX | BPF_B | BPF_MSH, 14)
+
+    def field(self, node):
+        """:return: label of the code that loads a field of up to 4 bytes into A"""
+        return self.load(node.l, node.r, node.op == "LDX")
+
+    def compile(self, node, t, f):
+        """:return: label of the code that continues at t if the node is true and at f otherwise"""
+        if t == f:
+            return t
+        if node.op == "TRUE":
+            return t
+        if node.op == "NOT":
+            return self.compile(node.l, f, t)
+        if node.op in ("AND", "OR"):
+            # a chain of the same operator is compiled in a loop, long chains would exceed the recursion limit
+            operands, stack = [], [node]
+            while stack:
+                operand = stack.pop()
+                if operand.op == node.op:
+                    stack += [operand.l, operand.r]
+                else:
+                    operands.append(operand)
+            entry = t if node.op == "AND" else f
+            for operand in operands:  # in reverse order, the stack popped the left operands last
+                entry = self.compile(operand, entry, f) if node.op == "AND" else self.compile(operand, t, entry)
+            return entry
+        if node.op == "EQ":
+            return self.equal(node.l, node.r, t, f)
+        if node.op == "MEQ":
+            mask, value = node.r
+            _check_width(node.l)
+            self.emit(BPF_JMP | BPF_JEQ | BPF_K, value, t, f)
+            self.emit(BPF_ALU | BPF_AND | BPF_K, mask)
+            return self.field(node.l)
+        if node.op in ("LT", "GT"):
+            return self.order(node.op, node.l, node.r, t, f)
+        if node.op == "IN":
+            return self.member(node.l, node.r, t, f)
+        raise ValueError("Unknown operand {}".format(node.op))
+
+    def equal(self, a, b, t, f):
+        if not _is_load(a):
+            a, b = b, a
+        if not _is_load(a):
+            # constant folding
+            return t if _constant(a) == _constant(b) else f
+        width = a.r - a.l
+        if not _is_load(b):
+            value = _constant(b)
+            if value >= 256 ** width:
+                return f
+            value = value.to_bytes(width, "big")
+            entry = t
+            for l, r in reversed(list(_chunks(a.l, a.r))):  # noqa: E741
+                self.emit(BPF_JMP | BPF_JEQ | BPF_K, int.from_bytes(value[l - a.l : r - a.l], "big"), entry, f)
+                entry = self.load(l, r, a.op == "LDX")
+            return entry
+        entry = t
+        for (l, r), (bl, br) in reversed(list(zip(_chunks(a.l, a.r), _chunks(b.l, b.r)))):  # noqa: E741
+            self.emit(BPF_JMP | BPF_JEQ | BPF_X, 0, entry, f)
+            entry = self.through_x((l, r, a.op == "LDX"), (bl, br, b.op == "LDX"))
+        return entry
+
+    def through_x(self, a, b):
+        """
+        :param a: (l, r, transport) of the load into A, b of the load into X
+        :return: label of the code that loads b into X and a into A
+        """
+        # b goes through the scratch memory, the load of a can set X to the IPv4 header length
+        self.emit(BPF_LDX | BPF_W | BPF_MEM, 0)
+        self.load(*a)
+        self.emit(BPF_ST, 0)
+        return self.load(*b)
+
+    def order(self, op, a, b, t, f):
+        if not _is_load(a):
+            # 5 < x is x > 5
+            a, b, op = b, a, {"LT": "GT", "GT": "LT"}[op]
+        if not _is_load(a):
+            return t if (_constant(a) < _constant(b) if op == "LT" else _constant(a) > _constant(b)) else f
+        _check_width(a)
+        if op == "LT":
+            # a < b is not a >= b
+            code, t, f = BPF_JGE, f, t
+        else:
+            code = BPF_JGT
+        if not _is_load(b):
+            value = _constant(b)
+            if value >= 256 ** (a.r - a.l):
+                # the field is always smaller, neither a > b nor a >= b
+                return f
+            self.emit(BPF_JMP | code | BPF_K, value, t, f)
+            return self.field(a)
+        _check_width(b)
+        self.emit(BPF_JMP | code | BPF_X, 0, t, f)
+        return self.through_x((a.l, a.r, a.op == "LDX"), (b.l, b.r, b.op == "LDX"))
+
+    def member(self, field, values, t, f):
+        values = sorted(value for value in values if value < 256 ** (field.r - field.l))
+        if not values:
+            return f
+        if field.r - field.l not in SIZES:
+            # wider fields are compared in chunks, one value after the other
+            entry = f
+            for value in reversed(values):
+                entry = self.equal(field, ASTNode("LDI", value), t, entry)
+            return entry
+        self.search(values, t, f)
+        return self.field(field)
+
+    def search(self, values, t, f):
+        """:return: label of the jump table over the sorted values, the field is in A"""
+        if len(values) <= LINEAR_SEARCH:
+            # the leaves of large tables share the detours to t and f
+            t, f = self.reach(t), self.reach(f)
+            entry = f
+            for value in reversed(values):
+                entry = self.emit(BPF_JMP | BPF_JEQ | BPF_K, value, t, entry)
+            return entry
+        middle = len(values) // 2
+        upper = self.search(values[middle:], t, f)
+        lower = self.search(values[:middle], t, f)
+        return self.emit(BPF_JMP | BPF_JGE | BPF_K, values[middle], upper, lower)
+
+
+def compile_bpf(tree: ASTNode, accept: int = ACCEPT) -> bytes:
+    """
+    :param tree: AST of a TrafficFilter
+    :param accept: return value for matching packets, the number of bytes a socket filter keeps
+    :return: struct sock_filter instructions of a program that returns accept for matching packets and 0 otherwise
+    """
+    key = ("bpf", COMPILER_VERSION, accept, ast_key(tree))
+    code = bytecode_cache.get(key)
+    if code is not None:
+        return code
+    compiler = _Compiler()
+    reject = compiler.emit(BPF_RET | BPF_K, 0)
+    accept = compiler.emit(BPF_RET | BPF_K, accept)
+    entry = compiler.compile(tree, accept, reject)
+    if entry in (accept, reject):
+        # the result does not depend on the packet
+        compiler.code.append(compiler.code[entry])
+    elif entry != len(compiler.code) - 1:
+        compiler.jump(entry)
+    if len(compiler.code) > BPF_MAXINSNS:
+        raise ValueError("BPF program has {} instructions, the kernel accepts {}".format(len(compiler.code), BPF_MAXINSNS))
+    code = b"".join(reversed(compiler.code))
+    bytecode_cache.put(key, code)
+    return code
+
+
+def _ipv4_prefix(offset, ip: bytes, length):
+    mask = (0xFFFFFFFF << (32 - length)) & 0xFFFFFFFF
+    return ASTNode("MEQ", ASTNode("LD", offset, offset + 4), (mask, int.from_bytes(ip, "big") & mask))
+
+
+def _any(nodes):
+    tree = nodes[0]
+    for node in nodes[1:]:
+        tree = ASTNode("OR", tree, node)
+    return tree
+
+
+def foreign_traffic(own_ip: bytes, own_mac: bytes, networks=()) -> ASTNode:
+    """
+    AST of the IPv4 frames that are neither from nor to the box, the same as the tcpdump expression
+    `not (ether src MAC || host IP || dst 255.255.255.255 || net 224.0.0.0/4 || dst 0.0.0.0 || dst 127.0.0.1)`
+    on sockets that only receive IPv4 frames.
+
+    :param networks: (ip, prefix length) pairs of further networks, the frames from and to them are excluded
+    """
+    ip_source, ip_destination = ASTNode("LD", 26, 30), ASTNode("LD", 30, 34)
+    own = [
+        ASTNode("EQ", ip_source, ASTNode("LDB", own_ip)),
+        ASTNode("EQ", ip_destination, ASTNode("LDB", own_ip)),
+        ASTNode("EQ", ip_destination, ASTNode("LDB", b"\xff\xff\xff\xff")),
+        ASTNode("EQ", ip_destination, ASTNode("LDB", b"\x00\x00\x00\x00")),
+        ASTNode("EQ", ip_destination, ASTNode("LDB", b"\x7f\x00\x00\x01")),
+    ]
+    for ip, length in [(b"\xe0\x00\x00\x00", 4)] + list(networks):
+        own += [_ipv4_prefix(26, ip, length), _ipv4_prefix(30, ip, length)]
+    ipv4 = ASTNode("AND", ASTNode("EQ", ASTNode("LD", 12, 14), ASTNode("LDI", 0x0800)), _any(own))
+    return ASTNode("NOT", ASTNode("OR", ASTNode("EQ", ASTNode("LD", 6, 12), ASTNode("LDB", own_mac)), ipv4))
@@ -0,0 +1,139 @@
+"""
+Process-wide cache of compiled BPF programs, so swapping back to a filter that was compiled before is instant.
+The programs on disk are loaded into the kernel, so they are only read from a directory that belongs to the user of the
+process and that nobody else can write, and only if they are well-formed.
+"""
+import hashlib
+import os
+import stat
+import struct
+import tempfile
+from collections import OrderedDict
+
+# bump when the file format changes, the generators of the programs put their own version into the keys
+FORMAT_VERSION = 1
+
+# linux/filter.h
+BPF_CLASS = 0x07
+BPF_JMP = 0x05
+BPF_RET = 0x06
+BPF_OP = 0xF0
+BPF_JA = 0x00
+BPF_MAXINSNS = 4096
+INSTRUCTION = struct.Struct("HBBI")
+
+
+def normalize(expression: str) -> str:
+    """tcpdump expressions that only differ in whitespace compile to the same program"""
+    return " ".join(expression.split())
+
+
+def well_formed(code: bytes) -> bool:
+    """:return: whether code is a program the kernel would accept: every jump stays inside it and it ends with a ret"""
+    if not code or len(code) % INSTRUCTION.size or len(code) // INSTRUCTION.size > BPF_MAXINSNS:
+        return False
+    count = len(code) // INSTRUCTION.size
+    for i, (op, jt, jf, k) in enumerate(INSTRUCTION.iter_unpack(code)):
+        if op & BPF_CLASS != BPF_JMP:
+            continue
+        targets = (k,) if op & BPF_OP == BPF_JA else (jt, jf)
+        if any(i + 1 + target >= count for target in targets):
+            return False
+    return INSTRUCTION.unpack_from(code, len(code) - INSTRUCTION.size)[0] & BPF_CLASS == BPF_RET
+
+
+def trusted(path: str) -> bool:
+    """:return: whether path belongs to the user of the process and only they can write it"""
+    try:
+        st = os.stat(path)
+    except OSError:
+        return False
+    return st.st_uid == os.geteuid() and not st.st_mode & (stat.S_IWGRP | stat.S_IWOTH)
+
+
+def ast_key(tree):
+    """:return: hashable key of a filter AST, built without recursion like the compilers walk the deep OR chains"""
+    key, stack = [], [tree]
+    while stack:
+        node = stack.pop()
+        if node.op in ("AND", "OR", "EQ", "LT", "GT", "NOT"):
+            key.append(node.op)
+            stack += [node.r, node.l] if node.op != "NOT" else [node.l]
+        elif node.op in ("IN", "MEQ"):
+            # the set or the (mask, value) pair, then the field
+            key += [node.op, node.r]
+            stack.append(node.l)
+        else:
+            key.append((node.op, node.l, node.r))
+    return tuple(key)
+
+
+class BytecodeCache:
+    """
+    LRU cache of compiled programs.
+    With a directory the programs are also stored on disk, so they survive restarts and are shared between processes.
+    """
+
+    def __init__(self, size=256, directory=None):
+        self.size = size
+        self.directory = directory
+        self.table = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.table)
+
+    def path(self, key):
+        return os.path.join(self.directory, hashlib.sha256(repr((FORMAT_VERSION, key)).encode()).hexdigest() + ".bpf")
+
+    def get(self, key):
+        """:return: the program, None if it was not compiled yet"""
+        code = self.table.get(key)
+        if code is None and self.directory and trusted(self.directory):
+            path = self.path(key)
+            try:
+                with open(path, "rb") as f:
+                    code = f.read() if trusted(path) else None
+            except OSError:
+                code = None
+            if code is not None and not well_formed(code):
+                code = None
+            if code is not None:
+                self._remember(key, code)
+        if code is None:
+            self.misses += 1
+            return None
+        self.table.move_to_end(key)
+        self.hits += 1
+        return code
+
+    def put(self, key, code: bytes):
+        self._remember(key, code)
+        if self.directory:
+            try:
+                os.makedirs(self.directory, mode=0o700, exist_ok=True)
+                if not trusted(self.directory):
+                    return
+                # write and rename, so other processes never read a partial program
+                fd, tmp = tempfile.mkstemp(dir=self.directory)
+                with os.fdopen(fd, "wb") as f:
+                    f.write(code)
+                os.replace(tmp, self.path(key))
+            except OSError:
+                pass  # the cache on disk is optional
+
+    def _remember(self, key, code):
+        self.table[key] = code
+        self.table.move_to_end(key)
+        if len(self.table) > self.size:
+            self.table.popitem(last=False)
+
+    def clear(self):
+        self.table.clear()
+
+    def stats(self):
+        return {"programs": len(self.table), "hits": self.hits, "misses": self.misses}
+
+
+bytecode_cache = BytecodeCache(directory=os.environ.get("BITAHOY_BPF_CACHE"))
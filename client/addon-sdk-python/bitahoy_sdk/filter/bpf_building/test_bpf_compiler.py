@@ -0,0 +1,214 @@
+import asyncio
+import operator
+import random
+import shutil
+import struct
+
+import pytest
+from bitahoy_sdk.filter import TrafficFilter, Ethernet, IPv4, TCP, UDP
+from bitahoy_sdk.filter.ast import ASTNode, SymbolicPacket
+from bitahoy_sdk.filter.bpf_building.bpf_builder import get_bpf_bytecode_from_tcpdump
+from bitahoy_sdk.filter.bpf_building.bpf_compiler import ACCEPT, BPF_MAXINSNS, compile_bpf, foreign_traffic
+from bitahoy_sdk.filter.eval import Evaluator
+from bitahoy_sdk.filter.matcher import COMPARISONS, FilterSet, _nodes, _operands
+from bitahoy_sdk.filter.test_ast import p1
+from bitahoy_sdk.filter.test_matcher import FILTERS, random_packets
+
+OWN_IP = b"\xc0\xa8\xb2\x02"
+OWN_MAC = b"\x02\x00\x00\x00\x00\xaa"
+OWN_TRAFFIC = "(not(ether src 02:00:00:00:00:aa || net 10.199.0.0/16 || host 192.168.178.2 || dst 255.255.255.255 || net 224.0.0.0/4 || dst 0.0.0.0 || dst 127.0.0.1))"
+tcpdump = pytest.mark.skipif(shutil.which("tcpdump") is None, reason="tcpdump is not installed")
+
+
+def execute(code, packet, trace=None):
+    """
+    Classic BPF interpreter for the instructions of the compiler and of tcpdump, :return: the return value
+    :param trace: list the index of every executed instruction is appended to
+    """
+    program = [struct.unpack_from("HBBI", code, offset) for offset in range(0, len(code), 8)]
+    a = x = pc = 0
+    memory = [0] * 16
+
+    def load(offset, size):
+        if offset + size > len(packet):
+            raise IndexError
+        return int.from_bytes(packet[offset : offset + size], "big")
+
+    try:
+        while True:
+            op, jt, jf, k = program[pc]
+            if trace is not None:
+                trace.append(pc)
+            pc += 1
+            cls, size = op & 0x07, {0x00: 4, 0x08: 2, 0x10: 1}.get(op & 0x18)
+            if cls == 0x00:  # ld
+                a = {0x20: lambda: load(k, size), 0x40: lambda: load(x + k, size), 0x00: lambda: k, 0x60: lambda: memory[k]}[op & 0xE0]()
+            elif cls == 0x01:  # ldx
+                x = {0xA0: lambda: 4 * (load(k, 1) & 0xF), 0x00: lambda: k, 0x60: lambda: memory[k]}[op & 0xE0]()
+            elif cls in (0x02, 0x03):  # st, stx
+                memory[k] = a if cls == 0x02 else x
+            elif cls == 0x04:  # alu
+                operand = x if op & 0x08 else k
+                alu = {0x50: operator.and_, 0x40: operator.or_, 0x60: operator.lshift, 0x70: operator.rshift, 0x00: operator.add}
+                a = alu[op & 0xF0](a, operand) & 0xFFFFFFFF
+            elif cls == 0x05:  # jmp
+                operand = x if op & 0x08 else k
+                if op & 0xF0 == 0x00:
+                    pc += k
+                    continue
+                condition = {0x10: a == operand, 0x20: a > operand, 0x30: a >= operand, 0x40: bool(a & operand)}[op & 0xF0]
+                pc += jt if condition else jf
+            elif cls == 0x06:  # ret
+                return a if op & 0x18 == 0x10 else k
+            elif cls == 0x07:  # misc
+                a, x = (a, a) if op & 0xF8 == 0x00 else (x, x)
+    except IndexError:
+        return 0
+
+
+def loads_fit(tree, packet):
+    transport = 14 + 4 * (packet[14] & 0xF) if len(packet) > 14 else len(packet)
+    for node in _nodes(tree):
+        if node.op in COMPARISONS:
+            for side in _operands(node):
+                if side.op == "LD" and side.r > len(packet) or side.op == "LDX" and transport + side.r > len(packet):
+                    return False
+    return True
+
+
+@pytest.mark.parametrize("key,trafficfilter", FILTERS)
+def test_programs_match_like_evaluator(key, trafficfilter):
+    code = compile_bpf(trafficfilter.get_ast())
+    for packet in random_packets(300):
+        # the evaluator pads short packets, bpf rejects them
+        if loads_fit(trafficfilter.get_ast(), packet):
+            assert (execute(code, packet) == ACCEPT) == Evaluator(trafficfilter).evaluate(packet)
+
+
+def test_constants_are_folded():
+    never = TrafficFilter(UDP.dst_port == 53).get_ast()
+    never.r.l = 0x10000
+    code = compile_bpf(never)
+    assert code[:8] == struct.pack("HBBI", 0x06, 0, 0, 0)
+    assert execute(code, p1) == 0
+    assert execute(compile_bpf(TrafficFilter(UDP.dst_port < 0x10000).get_ast()), p1) == ACCEPT
+    assert execute(compile_bpf(TrafficFilter(UDP.dst_port > 0x10000).get_ast()), p1) == 0
+
+
+def test_long_jumps_take_a_detour():
+    f = TrafficFilter(UDP.dst_port == 1)
+    for port in range(2, 1000):
+        f = f.add_or_filter(TrafficFilter(UDP.dst_port == port))
+    code = compile_bpf(f.get_ast())
+    assert len(code) // 8 <= BPF_MAXINSNS
+    for port in (1, 53, 999, 1000, 0x1234):
+        packet = p1[:36] + port.to_bytes(2, "big") + p1[38:]
+        assert (execute(code, packet) == ACCEPT) == (port < 1000)
+
+
+def test_sets_compile_to_jump_tables():
+    ports = range(1, 1000, 2)
+    code = compile_bpf(TrafficFilter(UDP.dst_port.isin(ports)).get_ast())
+    # one jeq per port and the jge of the binary search
+    assert len(code) // 8 < len(ports) * 4 // 3
+    for port in (0, 1, 53, 500, 999, 1000, 1001, 0xFFFF):
+        packet = p1[:36] + port.to_bytes(2, "big") + p1[38:]
+        trace = []
+        assert (execute(code, packet, trace) == ACCEPT) == (port in ports)
+        # the loads, 7 levels of jge, up to 4 jeq and the detours
+        assert len(trace) <= 2 + 7 + 4 + 3
+
+
+def test_transport_fields_follow_ip_options():
+    code = compile_bpf(TrafficFilter(Ethernet.assert_ipv4 & IPv4.assert_udp & (UDP.dst_port == 53)).get_ast())
+    assert execute(code, p1) == ACCEPT
+    assert execute(code, p1[:14] + b"\x46" + p1[15:34] + bytes(4) + p1[34:]) == ACCEPT
+    assert execute(code, p1[:14] + b"\x46" + p1[15:]) == 0
+
+
+# the fixed offsets the TCP and UDP fields had before they became relative to the IPv4 header length
+LEGACY_FIELDS = [
+    (UDP.src_port, 34, 36),
+    (UDP.dst_port, 36, 38),
+    (UDP.length, 38, 40),
+    (UDP.checksum, 40, 42),
+    (TCP.src_port, 34, 36),
+    (TCP.dst_port, 36, 38),
+    (TCP.seqence_number, 38, 42),
+    (TCP.acknowledgment_number, 42, 46),
+    (TCP.window_size, 48, 50),
+    (TCP.checksum, 50, 52),
+    (TCP.urgent_pointer, 52, 54),
+]
+
+
+@pytest.mark.parametrize("field,start,end", LEGACY_FIELDS)
+def test_transport_fields_match_the_fixed_offsets_without_ip_options(field, start, end):
+    legacy = SymbolicPacket()[start:end]
+    values = [1, 53, (1 << 8 * (end - start)) - 1]
+    rng = random.Random(start)
+    packets = []
+    for length in (20, 37, 38, 41, 54, 60, 80):
+        for _ in range(20):
+            data = bytearray(rng.getrandbits(8) for _ in range(length))
+            data[12:14] = b"\x08\x00"
+            data[14] = 0x45
+            if length >= end and rng.random() < 0.5:
+                data[start:end] = rng.choice(values).to_bytes(end - start, "big")
+            packets.append(bytes(data))
+    filters = []
+    for value in values:
+        filters += [(field == value, legacy == value), (field >= value, legacy >= value)]
+    for new, old in filters:
+        new, old = TrafficFilter(Ethernet.assert_ipv4 & new), TrafficFilter(Ethernet.assert_ipv4 & old)
+        new_code, old_code = compile_bpf(new.get_ast()), compile_bpf(old.get_ast())
+        assert FilterSet([(0, new)]).match_many(packets) == FilterSet([(0, old)]).match_many(packets)
+        for packet in packets:
+            assert Evaluator(new).evaluate(packet) == Evaluator(old).evaluate(packet)
+            assert execute(new_code, packet) == execute(old_code, packet)
+
+
+def test_program_size_is_limited():
+    f = TrafficFilter(UDP.dst_port == 1)
+    for port in range(2, 3000):
+        f = f.add_or_filter(TrafficFilter(UDP.dst_port == port))
+    with pytest.raises(ValueError):
+        compile_bpf(f.get_ast())
+
+
+def ipv4(src, dst, mac=b"\x02\x00\x00\x00\x00\x01"):
+    return b"\xff" * 6 + mac + b"\x08\x00" + p1[14:26] + bytes(src) + bytes(dst) + p1[34:]
+
+
+FOREIGN = [
+    (ipv4([192, 168, 178, 30], [1, 1, 1, 1]), True),
+    (ipv4([1, 1, 1, 1], [192, 168, 178, 30]), True),
+    (ipv4([192, 168, 178, 30], [1, 1, 1, 1], OWN_MAC), False),
+    (ipv4(OWN_IP, [1, 1, 1, 1]), False),
+    (ipv4([1, 1, 1, 1], OWN_IP), False),
+    (ipv4([192, 168, 178, 30], [255] * 4), False),
+    (ipv4([192, 168, 178, 30], [0] * 4), False),
+    (ipv4([192, 168, 178, 30], [127, 0, 0, 1]), False),
+    (ipv4([192, 168, 178, 30], [239, 255, 255, 250]), False),
+    (ipv4([224, 0, 0, 251], [192, 168, 178, 30]), False),
+    (ipv4([192, 168, 178, 30], [240, 0, 0, 1]), True),
+    (ipv4([10, 199, 3, 4], [1, 1, 1, 1]), False),
+    (ipv4([10, 198, 3, 4], [1, 1, 1, 1]), True),
+]
+
+
+@pytest.mark.parametrize("packet,foreign", FOREIGN)
+def test_foreign_traffic(packet, foreign):
+    code = compile_bpf(foreign_traffic(OWN_IP, OWN_MAC, [(b"\x0a\xc7\x00\x00", 16)]))
+    assert (execute(code, packet) == ACCEPT) == foreign
+
+
+@tcpdump
+@pytest.mark.parametrize("key,trafficfilter", FILTERS)
+def test_programs_match_like_tcpdump(key, trafficfilter):
+    expression = OWN_TRAFFIC + " and " + trafficfilter.get_ast().to_tcpdump_expr()
+    expected = asyncio.run(get_bpf_bytecode_from_tcpdump(expression))
+    tree = foreign_traffic(OWN_IP, OWN_MAC, [(b"\x0a\xc7\x00\x00", 16)])
+    code = compile_bpf(ASTNode("AND", tree, trafficfilter.get_ast()))
+    for packet in random_packets(300) + [packet for packet, _ in FOREIGN]:
+        assert execute(code, packet) == execute(expected, packet)
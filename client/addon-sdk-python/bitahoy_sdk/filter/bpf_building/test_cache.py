@@ -0,0 +1,77 @@
+import asyncio
+import os
+
+from bitahoy_sdk.filter import TrafficFilter, UDP, Ethernet, IPv4
+from bitahoy_sdk.filter.bpf_building.bpf_builder import get_bpf_bytecode_from_tcpdump
+from bitahoy_sdk.filter.bpf_building.bpf_compiler import compile_bpf
+from bitahoy_sdk.filter.bpf_building.cache import BytecodeCache, ast_key, bytecode_cache, normalize, well_formed
+
+ACCEPT_ALL = b"\x06\x00\x00\x00\xff\xff\xff\xff"
+
+
+def dns():
+    return TrafficFilter(Ethernet.assert_ipv4 & IPv4.assert_udp & ((UDP.dst_port == 53) | (UDP.src_port == 53)))
+
+
+def test_least_recently_used_programs_are_evicted():
+    cache = BytecodeCache(size=2)
+    cache.put("a", ACCEPT_ALL)
+    cache.put("b", ACCEPT_ALL)
+    assert cache.get("a") == ACCEPT_ALL
+    cache.put("c", ACCEPT_ALL)
+    assert cache.get("b") is None
+    assert cache.get("a") == cache.get("c") == ACCEPT_ALL
+    assert cache.stats() == {"programs": 2, "hits": 3, "misses": 1}
+
+
+def test_programs_are_shared_on_disk(tmp_path):
+    BytecodeCache(directory=str(tmp_path / "bpf")).put(("tcpdump", "udp"), ACCEPT_ALL)
+    cache = BytecodeCache(directory=str(tmp_path / "bpf"))
+    assert cache.get(("tcpdump", "udp")) == ACCEPT_ALL
+    assert cache.get(("tcpdump", "tcp")) is None
+    assert len(cache) == 1
+
+
+def test_programs_in_foreign_writable_directories_are_ignored(tmp_path):
+    BytecodeCache(directory=str(tmp_path / "bpf")).put(("tcpdump", "udp"), ACCEPT_ALL)
+    os.chmod(tmp_path / "bpf", 0o777)
+    assert BytecodeCache(directory=str(tmp_path / "bpf")).get(("tcpdump", "udp")) is None
+
+
+def test_malformed_programs_are_not_loaded(tmp_path):
+    cache = BytecodeCache(directory=str(tmp_path / "bpf"))
+    cache.put(("tcpdump", "udp"), ACCEPT_ALL)
+    with open(cache.path(("tcpdump", "udp")), "wb") as f:
+        f.write(ACCEPT_ALL[:6])
+    assert BytecodeCache(directory=str(tmp_path / "bpf")).get(("tcpdump", "udp")) is None
+
+
+def test_well_formed():
+    assert well_formed(compile_bpf(dns().get_ast()))
+    assert well_formed(ACCEPT_ALL)
+    assert not well_formed(b"")
+    # ldh [12] does not end the program
+    assert not well_formed(b"\x28\x00\x00\x00\x0c\x00\x00\x00")
+    # jeq #0x800 jumps one instruction past the end
+    assert not well_formed(b"\x15\x00\x01\x00\x00\x08\x00\x00" + ACCEPT_ALL)
+    assert not well_formed(ACCEPT_ALL * 4097)
+
+
+def test_keys_are_normalized():
+    assert normalize(" udp  and\n port 53 ") == "udp and port 53"
+    assert ast_key(dns().get_ast()) == ast_key(dns().get_ast())
+    assert ast_key(dns().get_ast()) != ast_key(dns().negate().get_ast())
+    assert ast_key(UDP.dst_port.isin([53, 853]).ast) != ast_key(UDP.dst_port.isin([53, 5353]).ast)
+
+
+def test_compiled_programs_are_cached():
+    code = compile_bpf(dns().get_ast())
+    hits = bytecode_cache.hits
+    assert compile_bpf(dns().get_ast()) is code
+    assert bytecode_cache.hits == hits + 1
+
+
+def test_tcpdump_is_not_run_for_cached_expressions():
+    bytecode_cache.put(("tcpdump", "ether[1] == 24"), ACCEPT_ALL)
+    code = asyncio.run(get_bpf_bytecode_from_tcpdump("ether[1]  ==  24"))
+    assert code == ACCEPT_ALL
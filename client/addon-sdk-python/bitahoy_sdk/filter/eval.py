@@ -12,9 +12,14 @@ class Evaluator:
             "and": self.__op_and,
             "or": self.__op_or,
             "eq": self.__op_eq,
+            "lt": self.__op_lt,
+            "gt": self.__op_gt,
+            "in": self.__op_in,         # r is a frozenset of ints
+            "meq": self.__op_meq,       # r is (mask, value)
             "not": self.__op_not,
             "true": self.__op_true,
             "ld": self.__op_ld,         # has l, r as range
+            "ldx": self.__op_ldx,       # range behind the IPv4 header
             "ldi": self.__op_ldi,
             "ldb": self.__op_ldb,       # unpacks from l
         }
@@ -46,6 +51,19 @@ class Evaluator:
         rr = self.__eval_op(r)
         return rl == rr
 
+    def __op_lt(self, l, r):
+        return self.__eval_op(l) < self.__eval_op(r)
+
+    def __op_gt(self, l, r):
+        return self.__eval_op(l) > self.__eval_op(r)
+
+    def __op_in(self, l, r):
+        return self.__eval_op(l) in r
+
+    def __op_meq(self, l, r):
+        mask, value = r
+        return self.__eval_op(l) & mask == value
+
     def __op_not(self, l, r):
         return not self.__eval_op(l)
 
@@ -59,6 +77,11 @@ class Evaluator:
         assert r > l
         return unpack(self.packet.ljust(r-l, b"\x00")[l:r])
 
+    def __op_ldx(self, l, r):
+        # the IHL counts 4 byte words
+        offset = 14 + 4 * (self.__op_ld(14, 15) & 0xF)
+        return self.__op_ld(offset + l, offset + r)
+
     def __op_ldi(self, l, r):
         assert isinstance(l, int)
         return l
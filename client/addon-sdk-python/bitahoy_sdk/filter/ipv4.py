@@ -1,4 +1,6 @@
-from bitahoy_sdk.filter.ast import SymbolicPacket
+import ipaddress
+
+from bitahoy_sdk.filter.ast import SymbolicField, SymbolicPacket
 
 __packet = SymbolicPacket()
 
@@ -15,3 +17,9 @@ source = __packet[26:30]
 assert_udp = proto == b'\x11'
 assert_tcp = proto == b'\x06'
 assert_icmp = proto == b'\x01'
+
+
+def in_network(field: SymbolicField, network: str):
+    """The address field is in the network, e.g. in_network(source, "10.0.0.0/8")"""
+    network = ipaddress.IPv4Network(network, strict=False)
+    return (field & int(network.netmask)) == int(network.network_address)
@@ -0,0 +1,202 @@
+from bitahoy_sdk.filter.eval import unpack
+
+# ops that compare a field, the other operand of IN and MEQ is a constant that is not an ASTNode
+COMPARISONS = ("EQ", "LT", "GT", "IN", "MEQ")
+
+
+def _nodes(node):
+    """All nodes of a tree without recursion, the OR chains of many filters are deeper than the recursion limit"""
+    stack = [node]
+    while stack:
+        node = stack.pop()
+        yield node
+        if node.op in ("AND", "OR"):
+            stack.append(node.r)
+            stack.append(node.l)
+        elif node.op == "NOT":
+            stack.append(node.l)
+
+
+def _short_load(packet, l, r):  # noqa: E741
+    # loads beyond the end of the packet, same result as Evaluator
+    return unpack(bytes(packet).ljust(r - l, b"\x00")[l:r])
+
+
+def _transport_load(packet, l, r):  # noqa: E741
+    # the fields behind the IPv4 header, its length in 4 byte words is in the low nibble of its first byte
+    offset = 14 + ((packet[14] & 0xF) << 2) if len(packet) > 14 else 14
+    if len(packet) >= offset + r:
+        return int.from_bytes(packet[offset + l : offset + r], "big")
+    return _short_load(packet, offset + l, offset + r)
+
+
+def _operands(node):
+    """The operands of a comparison that are ASTNodes"""
+    return (node.l,) if node.op in ("IN", "MEQ") else (node.l, node.r)
+
+
+class _SetCompiler:
+    """
+    Generates the source of one Python function for a list of filter ASTs.
+    Every field is loaded once per packet, comparisons that occur more than once are computed once and the filters are
+    short-circuit boolean expressions over these locals.
+    """
+
+    def __init__(self, asts):
+        self.asts = asts
+        self.loads = {}  # (op, l, r) -> local name
+        self.counts = {}  # comparison key -> occurrences
+        self.shared = {}  # comparison key -> local name
+        for tree in asts:
+            self.count(tree)
+
+    def key(self, node):
+        if node.op in ("LD", "LDX"):
+            return (node.op, node.l, node.r)
+        if node.op in ("LDI", "LDB"):
+            return ("C", self.constant(node))
+        if node.op == "TRUE":
+            return ("TRUE",)
+        if node.op in ("IN", "MEQ"):
+            return (node.op, self.key(node.l), node.r)
+        return (node.op, self.key(node.l)) + ((self.key(node.r),) if node.op != "NOT" else ())
+
+    @staticmethod
+    def constant(node):
+        # constant folding, LDB compares as the integer it unpacks to
+        return node.l if node.op == "LDI" else unpack(node.l)
+
+    def count(self, tree):
+        for node in _nodes(tree):
+            if node.op in COMPARISONS:
+                key = self.key(node)
+                self.counts[key] = self.counts.get(key, 0) + 1
+                for side in _operands(node):
+                    if side.op in ("LD", "LDX"):
+                        self.loads.setdefault((side.op, side.l, side.r), "v{}".format(len(self.loads)))
+            elif node.op not in ("AND", "OR", "NOT", "TRUE"):
+                raise ValueError("Unknown operand {}".format(node.op))
+
+    def value(self, node):
+        if node.op in ("LD", "LDX"):
+            return self.loads[(node.op, node.l, node.r)]
+        return repr(self.constant(node))
+
+    def chain(self, node, op):
+        # a chain of the same operator becomes one flat expression, deep trees would exceed the parser's nesting limit
+        operands, stack = [], [node]
+        while stack:
+            node = stack.pop()
+            if node.op == op:
+                stack.append(node.r)
+                stack.append(node.l)
+            else:
+                operands.append(self.expression(node))
+        return operands
+
+    def expression(self, node):
+        if node.op == "TRUE":
+            return "True"
+        if node.op == "NOT":
+            return "(not {})".format(self.expression(node.l))
+        if node.op in COMPARISONS:
+            key = self.key(node)
+            if key in self.shared:
+                return self.shared[key]
+            return self.comparison(node)
+        return "({})".format(" {} ".format(node.op.lower()).join(self.chain(node, node.op)))
+
+    def comparison(self, node):
+        if node.op == "IN":
+            # a set display of constants is compiled to a frozenset constant
+            return "({} in {{{}}})".format(self.value(node.l), ", ".join(map(repr, sorted(node.r)))) if node.r else "False"
+        if node.op == "MEQ":
+            return "(({} & {}) == {})".format(self.value(node.l), *node.r)
+        operator = {"EQ": "==", "LT": "<", "GT": ">"}[node.op]
+        return "({} {} {})".format(self.value(node.l), operator, self.value(node.r))
+
+    def prologue(self, indent):
+        lines = ["n = len(p)"]
+        for (op, l, r), name in self.loads.items():  # noqa: E741
+            if op == "LDX":
+                lines.append("{} = transport_load(p, {}, {})".format(name, l, r))
+            else:
+                lines.append('{} = from_bytes(p[{}:{}], "big") if n >= {} else short_load(p, {}, {})'.format(name, l, r, r, l, r))
+        for key, count in self.counts.items():
+            if count > 1:
+                name = "c{}".format(len(self.shared))
+                lines.append("{} = {}".format(name, self.expression(self.node_of(key))))
+                self.shared[key] = name
+        return [indent + line for line in lines]
+
+    def node_of(self, key):
+        for tree in self.asts:
+            for node in _nodes(tree):
+                if node.op in COMPARISONS and self.key(node) == key:
+                    return node
+
+    def source(self):
+        prologue = self.prologue(" " * 8)
+        lines = ["def match_many(packets):"]
+        lines += ["    m{} = []".format(i) for i in range(len(self.asts))]
+        lines += ["    for i, p in enumerate(packets):"]
+        lines += prologue
+        for i, tree in enumerate(self.asts):
+            lines += ["        if {}:".format(self.expression(tree)), "            m{}.append(i)".format(i)]
+        lines += ["    return [{}]".format(", ".join("m{}".format(i) for i in range(len(self.asts))))]
+        return "\n".join(lines) + "\n"
+
+
+class _FilterCompiler(_SetCompiler):
+    """
+    Generates the source of a function for one filter AST.
+    Fields are loaded where they are compared, so the loads of the operands that short-circuiting skips are skipped too.
+    """
+
+    def value(self, node):
+        if node.op == "LD":
+            return '(from_bytes(p[{0}:{1}], "big") if len(p) >= {1} else short_load(p, {0}, {1}))'.format(node.l, node.r)
+        if node.op == "LDX":
+            return "transport_load(p, {}, {})".format(node.l, node.r)
+        return super().value(node)
+
+    def source(self):
+        return "def match(p):\n    return {}\n".format(self.expression(self.asts[0]))
+
+
+def _function(source, name):
+    namespace = {"from_bytes": int.from_bytes, "short_load": _short_load, "transport_load": _transport_load}
+    exec(compile(source, "<{}>".format(name), "exec"), namespace)  # nosec: generated from the AST only
+    return namespace
+
+
+def compile_filter(tree):
+    """:return: function packet -> bool with the same result as Evaluator for the filter AST"""
+    return _function(_FilterCompiler([tree]).source(), "TrafficFilter")["match"]
+
+
+class FilterSet:
+    """
+    Matches packets against several TrafficFilters in one pass.
+    All filters are compiled into one function, so a field that several filters look at (ethertype, protocol, ports)
+    is loaded once per packet and the packets of a batch are matched in one call.
+    """
+
+    def __init__(self, filters):
+        """:param filters: list of (key, TrafficFilter) pairs, the keys are returned for the matching filters"""
+        self.keys = [key for key, _ in filters]
+        self.filters = [trafficfilter for _, trafficfilter in filters]
+        compiler = _SetCompiler([trafficfilter.get_ast() for trafficfilter in self.filters])
+        self.source = compiler.source()
+        self.__match_many = _function(self.source, "FilterSet")["match_many"]
+
+    def __len__(self):
+        return len(self.keys)
+
+    def match(self, packet):
+        """Keys of all filters that match the packet"""
+        return [key for key, matches in zip(self.keys, self.__match_many([packet])) if matches]
+
+    def match_many(self, packets):
+        """Indexes of the matching packets for each filter that matches any, as dict key -> list of indexes"""
+        return {key: indexes for key, indexes in zip(self.keys, self.__match_many(packets)) if indexes}
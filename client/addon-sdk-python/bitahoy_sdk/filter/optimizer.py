@@ -0,0 +1,246 @@
+"""
+Optimizer for filter ASTs, mostly for the one big filter the interceptor builds from the filters of all addons.
+
+The tree is rewritten into a normal form with n-ary AND/OR nodes and NOTs only in front of comparisons:
+- chains of the same operator are flattened (De Morgan pushes the NOTs down to the comparisons)
+- constants are folded and duplicated operands are removed
+- operands that several branches share are hoisted: (a & b & c) | (a & b & d) becomes a & b & (c | d)
+- comparisons of adjacent fields with constants are merged into one load of 2 or 4 bytes
+- comparisons of one field with several constants are merged into one IN, which compiles to a BPF jump table
+The result is a balanced tree, so recursive walks like to_tcpdump_expr stay shallow.
+"""
+from bitahoy_sdk.filter.ast import ASTNode
+from bitahoy_sdk.filter.eval import unpack
+
+_TRUE = ("TRUE",)
+_FALSE = ("FALSE",)
+_DUAL = {"AND": "OR", "OR": "AND"}
+_LOADS = ("LD", "LDX")
+
+
+class _Literal:
+    """A comparison or its negation"""
+
+    __slots__ = ("negated", "node", "key")
+
+    def __init__(self, negated, node):
+        self.negated = negated
+        self.node = node
+        self.key = ("L", negated, node.op, _operand_key(node.l), _operand_key(node.r))
+
+    def negate(self):
+        return _Literal(not self.negated, self.node)
+
+
+class _Junction:
+    """n-ary AND or OR"""
+
+    __slots__ = ("op", "operands", "key")
+
+    def __init__(self, op, operands):
+        self.op = op
+        self.operands = operands
+        self.key = (op, frozenset(_key(operand) for operand in operands))
+
+
+def _key(term):
+    return term if isinstance(term, tuple) else term.key
+
+
+def _constant(node):
+    return node.l if node.op == "LDI" else unpack(node.l)
+
+
+def _operand_key(node):
+    if not isinstance(node, ASTNode):
+        # the set of IN, the (mask, value) pair of MEQ
+        return ("V", node)
+    if node.op in _LOADS:
+        return (node.op, node.l, node.r)
+    return ("C", _constant(node))
+
+
+def _normalize(node, negated=False):
+    if node.op == "TRUE":
+        return _FALSE if negated else _TRUE
+    if node.op == "NOT":
+        return _normalize(node.l, not negated)
+    if node.op in ("EQ", "LT", "GT"):
+        left, right, op = node.l, node.r, node.op
+        if left.op not in _LOADS and right.op in _LOADS:
+            # the field goes to the left, 5 < x is x > 5
+            left, right, op = right, left, {"EQ": "EQ", "LT": "GT", "GT": "LT"}[op]
+        if left.op not in _LOADS:
+            a, b = _constant(left), _constant(right)
+            return _TRUE if {"EQ": a == b, "LT": a < b, "GT": a > b}[op] != negated else _FALSE
+        return _Literal(negated, ASTNode(op, left, right))
+    if node.op == "IN":
+        values = frozenset(value for value in node.r if value < 256 ** (node.l.r - node.l.l))
+        if not values:
+            return _TRUE if negated else _FALSE
+        if len(values) == 1:
+            (value,) = values
+            return _Literal(negated, ASTNode("EQ", node.l, ASTNode("LDB", value.to_bytes(node.l.r - node.l.l, "big"))))
+        return _Literal(negated, ASTNode("IN", node.l, values))
+    if node.op == "MEQ":
+        return _Literal(negated, node)
+    if node.op in ("AND", "OR"):
+        # a chain of the same operator is flattened in a loop, long chains would exceed the recursion limit
+        operands, stack = [], [node]
+        while stack:
+            operand = stack.pop()
+            if operand.op == node.op:
+                stack += [operand.r, operand.l]
+            else:
+                operands.append(_normalize(operand, negated))
+        return _simplify(_DUAL[node.op] if negated else node.op, operands)
+    raise ValueError("Unknown operand {}".format(node.op))
+
+
+def _simplify(op, operands):
+    neutral, absorbing = (_TRUE, _FALSE) if op == "AND" else (_FALSE, _TRUE)
+    flat, stack = [], list(reversed(operands))
+    while stack:
+        operand = stack.pop()
+        if isinstance(operand, _Junction) and operand.op == op:
+            stack += reversed(operand.operands)
+        else:
+            flat.append(operand)
+    result, keys = [], set()
+    for operand in flat:
+        key = _key(operand)
+        if operand is absorbing:
+            return absorbing
+        if operand is neutral or key in keys:
+            continue
+        if isinstance(operand, _Literal) and operand.negate().key in keys:
+            # x & not x, x | not x
+            return absorbing
+        keys.add(key)
+        result.append(operand)
+    if not result:
+        return neutral
+    if len(result) == 1:
+        return result[0]
+    return _hoist(op, result)
+
+
+def _hoist(op, operands):
+    """Hoist the operand that most of the operands of the dual operator share"""
+    dual = _DUAL[op]
+    parts = [operand.operands if isinstance(operand, _Junction) and operand.op == dual else [operand] for operand in operands]
+    counts = {}
+    for part in parts:
+        for key in {_key(term) for term in part}:
+            counts[key] = counts.get(key, 0) + 1
+    shared = max(counts, key=counts.get)
+    if counts[shared] < 2:
+        return _Junction(op, operands)
+    common = None
+    group, rest, position = [], [], None
+    for operand, part in zip(operands, parts):
+        if any(_key(term) == shared for term in part):
+            common = next(term for term in part if _key(term) == shared)
+            group.append(_simplify(dual, [term for term in part if _key(term) != shared]))
+            position = len(rest) if position is None else position
+        else:
+            rest.append(operand)
+    # (x & a) | (x & b) = x & (a | b)
+    hoisted = _simplify(dual, [common, _simplify(op, group)])
+    return _simplify(op, rest[:position] + [hoisted] + rest[position:])
+
+
+def _mergeable(term):
+    if not isinstance(term, _Literal) or term.negated or term.node.op != "EQ":
+        return False
+    if term.node.l.op != "LD" or term.node.r.op in _LOADS:
+        return False
+    return _constant(term.node.r) < 256 ** (term.node.l.r - term.node.l.l)
+
+
+def _merge_loads(term):
+    """ld[l:m] == a & ld[m:r] == b becomes ld[l:r] == ab for loads of 2 and 4 bytes, the widths tcpdump supports"""
+    if not isinstance(term, _Junction):
+        return term
+    operands = [_merge_loads(operand) for operand in term.operands]
+    merged = term.op == "AND"
+    while merged:
+        merged = False
+        starts = {operand.node.l.l: operand for operand in operands if _mergeable(operand)}
+        for first in starts.values():
+            second = starts.get(first.node.l.r)
+            if second is None or second.node.l.r - first.node.l.l not in (2, 4):
+                continue
+            width = second.node.l.r - second.node.l.l
+            value = _constant(first.node.r) << 8 * width | _constant(second.node.r)
+            load = ASTNode("LD", first.node.l.l, second.node.l.r)
+            literal = _Literal(False, ASTNode("EQ", load, ASTNode("LDB", value.to_bytes(load.r - load.l, "big"))))
+            operands = [literal if operand is first else operand for operand in operands if operand is not second]
+            merged = True
+            break
+    return _simplify(term.op, operands)
+
+
+def _set_member(term, negated):
+    """:return: field and values of an IN or of an EQ with a constant, None for other terms"""
+    if not isinstance(term, _Literal) or term.negated != negated:
+        return None
+    if term.node.op == "IN":
+        return term.node.l, term.node.r
+    if term.node.op == "EQ" and term.node.r.op not in _LOADS:
+        return term.node.l, frozenset([_constant(term.node.r)])
+    return None
+
+
+def _merge_sets(term):
+    """x == a | x == b | x in {c, d} becomes x in {a, b, c, d}, not x == a & not x == b becomes not x in {a, b}"""
+    if not isinstance(term, _Junction):
+        return term
+    operands = [_merge_sets(operand) for operand in term.operands]
+    negated = term.op == "AND"
+    fields = {}
+    for operand in operands:
+        member = _set_member(operand, negated)
+        if member is not None:
+            field, values = member
+            fields.setdefault(_operand_key(field), (field, []))[1].append(values)
+    merged, result = set(), []
+    for operand in operands:
+        member = _set_member(operand, negated)
+        key = member and _operand_key(member[0])
+        if member is None or len(fields[key][1]) < 2:
+            result.append(operand)
+        elif key not in merged:
+            merged.add(key)
+            field, values = fields[key]
+            result.append(_Literal(negated, ASTNode("IN", field, frozenset().union(*values))))
+    return _simplify(term.op, result)
+
+
+def _balanced(op, nodes):
+    if len(nodes) == 1:
+        return nodes[0]
+    middle = len(nodes) // 2
+    return ASTNode(op, _balanced(op, nodes[:middle]), _balanced(op, nodes[middle:]))
+
+
+def _to_ast(term):
+    if term is _TRUE:
+        return ASTNode("TRUE")
+    if term is _FALSE:
+        return ASTNode("NOT", ASTNode("TRUE"))
+    if isinstance(term, _Literal):
+        return ASTNode("NOT", term.node) if term.negated else term.node
+    return _balanced(term.op, [_to_ast(operand) for operand in term.operands])
+
+
+def optimize(tree: ASTNode, merge_loads=True) -> ASTNode:
+    """
+    :param merge_loads: merge the loads of adjacent fields, for packets that are shorter than a merged load the result
+        can differ from the Evaluator, which pads short loads (BPF rejects these packets either way)
+    :return: an equivalent AST
+    """
+    term = _normalize(tree)
+    if merge_loads:
+        term = _merge_loads(term)
+    return _to_ast(_merge_sets(term))
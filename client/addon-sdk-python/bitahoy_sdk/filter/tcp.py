@@ -1,12 +1,13 @@
-from bitahoy_sdk.filter.ast import SymbolicPacket
+from bitahoy_sdk.filter.ast import SymbolicTransportHeader
 
-__packet = SymbolicPacket()
+# offsets behind the IPv4 header, which can have options
+__header = SymbolicTransportHeader()
 
 
-src_port = __packet[34:36]
-dst_port = __packet[36:38]
-seqence_number = __packet[38:42]
-acknowledgment_number = __packet[42:46]
-window_size = __packet[48:50]
-checksum = __packet[50:52]
-urgent_pointer = __packet[52:54]
\ No newline at end of file
+src_port = __header[0:2]
+dst_port = __header[2:4]
+seqence_number = __header[4:8]
+acknowledgment_number = __header[8:12]
+window_size = __header[14:16]
+checksum = __header[16:18]
+urgent_pointer = __header[18:20]
\ No newline at end of file
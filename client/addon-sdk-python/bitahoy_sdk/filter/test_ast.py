@@ -13,4 +13,13 @@ def test_traffic_filter_packet_match():
 
     print(f.get_ast()) # prints out the AST of the filter for debugging
 
-    assert f.evaluate(p1) # evaluates the filter on a packet
\ No newline at end of file
+    assert f.evaluate(p1) # evaluates the filter on a packet
+
+
+def test_ranges_masks_and_sets():
+    assert TrafficFilter(UDP.dst_port.isin([53, 853, 5353])).evaluate(p1)
+    assert not TrafficFilter(UDP.dst_port.isin([b"\x03\x55"])).evaluate(p1)
+    assert TrafficFilter(IPv4.in_network(IPv4.source, "192.168.0.0/16")).evaluate(p1)
+    assert not TrafficFilter(IPv4.in_network(IPv4.source, "10.0.0.0/8")).evaluate(p1)
+    assert TrafficFilter((UDP.src_port > 49151) & (UDP.dst_port < 1024) & (IPv4.ttl >= 64)).evaluate(p1)
+    assert not TrafficFilter(UDP.src_port <= 49151).evaluate(p1)
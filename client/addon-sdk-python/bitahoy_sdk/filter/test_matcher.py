@@ -0,0 +1,87 @@
+import pickle
+import random
+
+from bitahoy_sdk.filter import TrafficFilter, IPv4, UDP, TCP, Ethernet
+from bitahoy_sdk.filter.ast import SymbolicPacket
+from bitahoy_sdk.filter.eval import Evaluator
+from bitahoy_sdk.filter.matcher import FilterSet
+from bitahoy_sdk.filter.test_ast import p1
+
+packet = SymbolicPacket()
+
+FILTERS = [
+    ("dns", TrafficFilter(Ethernet.assert_ipv4 & IPv4.assert_udp & ((UDP.dst_port == 53) | (UDP.src_port == 53)))),
+    ("https", TrafficFilter(Ethernet.assert_ipv4 & IPv4.assert_tcp & (TCP.dst_port == 443))),
+    ("not-dns", TrafficFilter(Ethernet.assert_ipv4 & IPv4.assert_udp & ((UDP.dst_port == 53) | (UDP.src_port == 53))).negate()),
+    ("host", TrafficFilter(Ethernet.assert_ipv4 & (IPv4.source == b"\xc0\xa8\xb2\x1e") & (IPv4.destination == IPv4.source))),
+    ("everything", TrafficFilter()),
+    ("short", TrafficFilter(packet[60:62] == 0x0100)),
+    ("dns-ports", TrafficFilter(Ethernet.assert_ipv4 & IPv4.assert_udp & UDP.dst_port.isin([53, 853, 5353]))),
+    ("ports", TrafficFilter(UDP.src_port.isin(range(2, 500, 3)))),
+    ("private", TrafficFilter(Ethernet.assert_ipv4 & IPv4.in_network(IPv4.source, "192.168.0.0/16"))),
+    ("ephemeral", TrafficFilter(Ethernet.assert_ipv4 & IPv4.assert_tcp & (TCP.src_port > 49151) & (TCP.dst_port < 1024))),
+    ("ordered", TrafficFilter(Ethernet.assert_ipv4 & (UDP.src_port < UDP.dst_port) & (IPv4.ttl >= 64))),
+]
+
+
+def random_packets(count):
+    rng = random.Random(1)
+    packets = [p1, p1[:40], p1[:12], b""]
+    for _ in range(count):
+        data = bytearray(rng.getrandbits(8) for _ in range(rng.choice([10, 37, 60, 80])))
+        if len(data) > 38 and rng.random() < 0.8:
+            data[12:14] = b"\x08\x00"
+            data[14] = rng.choice([0x45, 0x45, 0x46, 0x4F])
+            data[23] = rng.choice([6, 17])
+            port = 14 + 4 * (data[14] & 0xF) + rng.choice([0, 2])
+            if port + 2 <= len(data):
+                data[port : port + 2] = rng.choice([b"\x00\x35", b"\x01\xbb"])
+        packets.append(bytes(data))
+    return packets
+
+
+def test_filter_set_matches_like_evaluate():
+    filter_set = FilterSet(FILTERS)
+    packets = random_packets(300)
+    expected = {key: [i for i, p in enumerate(packets) if f.evaluate(p)] for key, f in FILTERS}
+    assert filter_set.match_many(packets) == {key: indexes for key, indexes in expected.items() if indexes}
+    for p in packets:
+        assert filter_set.match(p) == [key for key, f in FILTERS if f.evaluate(p)]
+
+
+def test_shared_comparisons_are_computed_once():
+    filter_set = FilterSet(FILTERS)
+    assert filter_set.source.count("p[12:14]") == 1
+    assert filter_set.source.count("== 2048") == 1
+
+
+def test_long_filter_chains_compile():
+    f = TrafficFilter(UDP.dst_port == 1)
+    for port in range(2, 1000):
+        f = f.add_or_filter(TrafficFilter(UDP.dst_port == port))
+    filter_set = FilterSet([(0, f), (1, f.negate())])
+    assert filter_set.match(p1[:36] + b"\x03\xe7" + p1[38:]) == [0]
+    assert filter_set.match(p1[:36] + b"\x12\x34" + p1[38:]) == [1]
+
+
+def test_compiled_filters_match_like_evaluator():
+    packets = random_packets(300)
+    for _, f in FILTERS:
+        match = f.compile()
+        assert [match(p) for p in packets] == [Evaluator(f).evaluate(p) for p in packets]
+
+
+def test_compiled_filter_is_cached_and_not_pickled():
+    f = FILTERS[0][1]
+    assert f.compile() is f.compile()
+    copy = pickle.loads(pickle.dumps(f))
+    assert copy.compile() is not f.compile()
+    assert copy.evaluate(p1) == f.evaluate(p1)
+
+
+def test_transport_fields_follow_ip_options():
+    options = p1[:14] + b"\x46" + p1[15:34] + bytes(4) + p1[34:]
+    f = TrafficFilter(Ethernet.assert_ipv4 & IPv4.assert_udp & (UDP.dst_port == 53))
+    assert f.evaluate(p1) and f.evaluate(options) and Evaluator(f).evaluate(options)
+    assert FilterSet([("dns", f)]).match(options) == ["dns"]
+    assert not f.evaluate(p1[:14] + b"\x46" + p1[15:])
@@ -0,0 +1,112 @@
+import random
+
+from bitahoy_sdk.filter import TrafficFilter, IPv4, UDP, TCP, Ethernet
+from bitahoy_sdk.filter.ast import SymbolicPacket
+from bitahoy_sdk.filter.eval import Evaluator
+from bitahoy_sdk.filter.matcher import _nodes
+from bitahoy_sdk.filter.test_ast import p1
+from bitahoy_sdk.filter.test_matcher import FILTERS, random_packets
+
+packet = SymbolicPacket()
+
+
+def depth(tree):
+    stack, deepest = [(tree, 1)], 0
+    while stack:
+        node, level = stack.pop()
+        deepest = max(deepest, level)
+        if node.op in ("AND", "OR"):
+            stack += [(node.l, level + 1), (node.r, level + 1)]
+        elif node.op == "NOT":
+            stack.append((node.l, level + 1))
+    return deepest
+
+
+def comparisons(tree):
+    return sum(node.op == "EQ" for node in _nodes(tree))
+
+
+def interceptor_filter(filters):
+    """The negated OR chain InterceptorModule.on_addonfilters_event builds"""
+    combined = filters[0]
+    for f in filters[1:]:
+        combined = combined.add_or_filter(f)
+    return combined.negate()
+
+
+def random_filter(rng, size):
+    fields = [UDP.dst_port == 53, UDP.src_port == 53, TCP.dst_port == 443, IPv4.assert_udp, IPv4.assert_tcp, Ethernet.assert_ipv4]
+    fields += [packet[60:62] == 0x0100, packet[14] == 0x45, packet[15] == b"\x00"]
+    condition = rng.choice(fields)
+    for _ in range(size):
+        other = rng.choice(fields)
+        if rng.random() < 0.2:
+            other = other.negate()
+        condition = condition & other if rng.random() < 0.5 else condition | other
+    return TrafficFilter(condition)
+
+
+def test_optimized_filters_match_like_evaluator():
+    rng = random.Random(2)
+    packets = random_packets(200)
+    filters = [f for _, f in FILTERS] + [random_filter(rng, rng.randrange(1, 8)) for _ in range(40)]
+    filters.append(interceptor_filter(filters))
+    for f in filters:
+        # without merged loads the result is the same for short packets too
+        exact = Evaluator(f.optimize(merge_loads=False))
+        merged = Evaluator(f.optimize())
+        for p in packets:
+            expected = Evaluator(f).evaluate(p)
+            assert exact.evaluate(p) == expected
+            if len(p) >= 62:
+                assert merged.evaluate(p) == expected
+
+
+def test_shared_conditions_are_hoisted():
+    dns_requests = TrafficFilter(Ethernet.assert_ipv4 & IPv4.assert_udp & (UDP.dst_port == 53))
+    dns_responses = TrafficFilter(Ethernet.assert_ipv4 & IPv4.assert_udp & (UDP.src_port == 53))
+    https = TrafficFilter(Ethernet.assert_ipv4 & IPv4.assert_tcp & (TCP.dst_port == 443))
+    tree = interceptor_filter([dns_requests, dns_responses, https, dns_requests]).optimize().get_ast()
+    # ethertype once, the protocols and the ports
+    assert comparisons(tree) == 1 + 2 + 3
+    # De Morgan leaves NOTs only in front of comparisons
+    assert all(node.l.op == "EQ" for node in _nodes(tree) if node.op == "NOT")
+
+
+def test_constants_and_contradictions_are_folded():
+    always = TrafficFilter((UDP.dst_port == 53) | (UDP.dst_port == 53).negate())
+    assert always.optimize().get_ast().op == "TRUE"
+    never = TrafficFilter(Ethernet.assert_ipv4 & (UDP.dst_port == 53) & (UDP.dst_port == 53).negate())
+    assert Evaluator(never.optimize()).evaluate(bytes(100)) is False
+    assert comparisons(never.optimize().get_ast()) == 0
+
+
+def test_adjacent_loads_are_merged():
+    version = (packet[14] == 0x45) & (packet[15] == b"\x00")
+    assert TrafficFilter(version & (UDP.dst_port == 53)).optimize().get_ast().to_tcpdump_expr() == (
+        "((ether[14:2] == 17664) && (ether[14 + ((ether[14] & 15) << 2) + 2:2] == 53))"
+    )
+    assert TrafficFilter(Ethernet.assert_ipv4 & version).optimize().get_ast().to_tcpdump_expr() == "(ether[12:4] == 134235392)"
+
+
+def test_long_chains_become_balanced():
+    f = TrafficFilter(UDP.dst_port == 1)
+    for port in range(2, 1000):
+        f = f.add_or_filter(TrafficFilter((UDP.dst_port == port) & (UDP.src_port == port)))
+    tree = f.negate().optimize().get_ast()
+    assert depth(tree) <= 14
+    assert comparisons(tree) == 1 + 2 * 998
+    assert Evaluator(f.negate().optimize()).evaluate(p1[:34] + b"\x03\xe7\x03\xe7" + p1[38:]) is False
+    assert Evaluator(f.negate().optimize()).evaluate(p1[:34] + b"\x03\xe8\x03\xe8" + p1[38:]) is True
+
+
+def test_comparisons_with_constants_become_sets():
+    f = TrafficFilter(UDP.dst_port == 1)
+    for port in range(2, 1000):
+        f = f.add_or_filter(TrafficFilter(UDP.dst_port == port))
+    tree = f.negate().optimize().get_ast()
+    assert tree.op == "NOT" and tree.l.op == "IN" and tree.l.r == frozenset(range(1, 1000))
+    dns = TrafficFilter(Ethernet.assert_ipv4 & IPv4.assert_udp & ((UDP.dst_port == 53) | UDP.dst_port.isin([853, 5353])))
+    assert dns.optimize().get_ast().to_tcpdump_expr().count("ether[14 + ") == 3
+    assert TrafficFilter(UDP.dst_port.isin([53])).optimize().get_ast().op == "EQ"
+    assert Evaluator(TrafficFilter(UDP.dst_port.isin([])).optimize()).evaluate(p1) is False
@@ -1,9 +1,10 @@
-from bitahoy_sdk.filter.ast import SymbolicPacket
+from bitahoy_sdk.filter.ast import SymbolicTransportHeader
 
-__packet = SymbolicPacket()
+# offsets behind the IPv4 header, which can have options
+__header = SymbolicTransportHeader()
 
 
-src_port = __packet[34:36]
-dst_port = __packet[36:38]
-length = __packet[38:40]
-checksum = __packet[40:42]
\ No newline at end of file
+src_port = __header[0:2]
+dst_port = __header[2:4]
+length = __header[4:6]
+checksum = __header[6:8]
\ No newline at end of file
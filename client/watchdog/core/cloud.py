@@ -132,6 +132,21 @@ class MonitoringBackend(BaseBackend):
         await self.logger.info("uploadNotifications", resp)
         return resp
 
+    async def submitStatistics(self, statistic, value, deviceid=0):
+        """
+        Submit one value of a statistic ("traffic" or "DDoS"), the backend accepts one update per statistic and hour
+        :return: the response, None if the backend could not be reached
+        """
+        data = {"token": await self.request_token(), "statistic": statistic, "value": value, "deviceid": deviceid}
+        try:
+            async with (await self.session()).get(self.url + "/submitStatistics", json=data) as response:
+                resp = await response.json()
+        except (aiohttp.ClientError, asyncio.exceptions.TimeoutError) as e:
+            await self.logger.warn("submitStatistics", statistic, repr(e))
+            return None
+        await self.logger.verbose("submitStatistics", statistic, value, resp)
+        return resp
+
 
 class AddonBackend(BaseBackend):
     def __init__(self, config, auth_backend: AuthBackend, logger=None):
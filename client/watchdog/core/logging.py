@@ -4,6 +4,7 @@ import traceback
 from datetime import datetime
 from sys import stderr, stdout
 
+from watchdog.core.config import Config
 from watchdog.ipc.event import CLOUDLOGGING, LOG, Event
 from watchdog.ipc.queue import QueueSender
 
@@ -116,7 +117,8 @@ class AsyncLogger(Logger):
         msg = [x if type(x) == str else repr(x) for x in message]
         msg = " ".join(msg)
         if not self.__put:
-            self.__put = await self.queue_async.open().__aenter__()
+            # log messages of async modules can be batched, see QueueSender.open
+            self.__put = await self.queue_async.open(flush_delay=Config().get("logging.flush_delay", None)).__aenter__()
         await self.__put(Event(self.logger, self.name, LOG, {"level": level, "message": msg}))
 
     async def error(self, *message):
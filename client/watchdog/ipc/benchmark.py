@@ -0,0 +1,250 @@
+"""
+Micro benchmarks for the IPC layer.
+Run with `python3 arpjet.py script watchdog.ipc.benchmark`.
+"""
+import os
+import time
+from contextlib import suppress
+from multiprocessing import Process, Value
+
+from watchdog.ipc.event import LOG, NODECONFIG, Event
+from watchdog.ipc.queue import DISPATCH_POLICIES, ZMQueueManager, query_stats
+from watchdog.ipc.serializers import (
+    EventSerializer,
+    FrameDecoder,
+    LengthPrefixedSerializer,
+    MsgpackSerializer,
+    PickleSerializer,
+    Serializer,
+    msgpack,
+)
+from watchdog.ipc.shm import SUPPORTED
+from watchdog.network.utils import IP, MAC, ArpNode, Interface, NetConfig, Network
+
+PAYLOAD_SIZES = [64, 1500, 64 * 1024]
+
+
+def measure(func, iterations, rounds=5):
+    """Run func iterations times per round and return the average time per call of the fastest round in microseconds"""
+    best = float("inf")
+    for _ in range(rounds):
+        start = time.perf_counter()
+        for _ in range(iterations):
+            func()
+        best = min(best, time.perf_counter() - start)
+    return best / iterations * 1e6
+
+
+def bench_framing(framing, size, iterations=2000):
+    payload = os.urandom(size)
+    frame = framing.serialize(payload)
+    stream = frame * 4
+    return {
+        "serialize": measure(lambda: framing.serialize(payload), iterations),
+        "parse": measure(lambda: framing.parse(stream), iterations),
+        "deserialize": measure(lambda: framing.deserialize(frame), iterations),
+    }
+
+
+def bench_decoder(framing, size, chunk=16384, iterations=20):
+    """
+    Decode one frame of the given size that arrives in recv-sized chunks.
+
+    :return: time in microseconds to feed the chunks and copy the frame out and to write them into recv_buffer() and
+    take the payload as view, like QueueClient does
+    """
+    frame = framing.serialize(bytes(size))
+    chunks = [frame[i : i + chunk] for i in range(0, len(frame), chunk)]
+
+    def decode():
+        decoder = FrameDecoder(framing)
+        for data in chunks:
+            decoder.feed(data)
+            for packet in decoder:
+                framing.deserialize(packet)
+
+    def decode_views():
+        decoder = FrameDecoder(framing)
+        for data in chunks:
+            with decoder.recv_buffer() as target:
+                target[: len(data)] = data
+            decoder.commit(len(data))
+            for _ in decoder.payloads():
+                pass
+
+    return measure(decode, iterations), measure(decode_views, iterations)
+
+
+def sample_objects():
+    """Objects as they travel over the master, logger and addon packet queues"""
+    gateway = ArpNode(IP("192.168.1.1"), MAC("aa:bb:cc:00:00:01"))
+    conf = NetConfig(Interface("eth0", 1500), ArpNode(IP("192.168.1.2"), MAC("aa:bb:cc:00:00:02")), gateway, Network("192.168.1.0/24"))
+    nodes = [ArpNode(IP("192.168.1.%d" % (i + 10)), MAC(bytes([0x02, 0, 0, 0, 0, i]))) for i in range(100)]
+    return {
+        "NODECONFIG (100 nodes)": Event(["spoofer", "deviceid", "addons"], "arp-listener", NODECONFIG, {"conf": conf, "nodes": nodes}),
+        "LOG": Event("logger", "interceptor-0", LOG, {"level": 20, "message": "Packet matches filter (addon.a, 3)"}),
+        "packet batch (16 x 1500 B)": {
+            "packets": [(os.urandom(1500), time.time()) for _ in range(16)],
+            "interceptorid": "addon.interceptor",
+            "listenerid": 3,
+        },
+    }
+
+
+def bench_codec(codec, obj, iterations=1000):
+    """:return: dumps and loads time in microseconds and the payload size, None if the codec cannot encode obj"""
+    try:
+        data = codec.dumps(obj)
+    except TypeError:
+        return None
+    return measure(lambda: codec.dumps(obj), iterations), measure(lambda: codec.loads(data), iterations), len(data)
+
+
+def _receive(receiver, count, latency):
+    total = 0.0
+    with receiver.open() as get:
+        for _ in range(count):
+            sent_at, _ = get()
+            total += time.perf_counter() - sent_at
+    latency.value = total / count
+
+
+def bench_transport(transport, size, count, pause=0.0):
+    """
+    Send count messages from this process to a receiver process.
+    transport is a ZMQueueManager transport or "direct" for a brokerless unix socket queue.
+
+    :param pause: time to sleep between two messages, use it to measure latency without queueing delay
+    :return: messages per second and average one-way latency in microseconds
+    """
+    if transport == "direct":
+        manager = ZMQueueManager("benchmark", senders=1, receivers=1)
+    else:
+        manager = ZMQueueManager("benchmark", transport=transport)
+    with manager as queue:
+        latency = Value("d", 0.0)
+        receiver = Process(target=_receive, args=(queue.receiver(), count, latency))
+        receiver.start()
+        payload = os.urandom(size)
+        with queue.sender().open() as put:
+            put((time.perf_counter(), payload))  # warm up the connection
+            start = time.perf_counter()
+            for _ in range(count - 1):
+                put((time.perf_counter(), payload))
+                if pause:
+                    time.sleep(pause)
+            receiver.join()
+        duration = time.perf_counter() - start
+        return (count - 1) / duration, latency.value * 1e6
+
+
+def _receive_batched(receiver, count, done):
+    with receiver.open() as get:
+        received = 0
+        while received < count:
+            received += len(get.get_many(256, max_wait=0.001))
+    done.value = 1
+
+
+def bench_batching(size, count, batch):
+    """
+    Send count messages over a broker queue with put_many batches of the given size and receive them with get_many.
+
+    :return: messages per second
+    """
+    with ZMQueueManager("benchmark") as queue:
+        done = Value("i", 0)
+        receiver = Process(target=_receive_batched, args=(queue.receiver(), count, done))
+        receiver.start()
+        payload = os.urandom(size)
+        with queue.sender().open() as put:
+            start = time.perf_counter()
+            for _ in range(count // batch):
+                put.put_many([payload] * batch)
+            receiver.join()
+        return count / (time.perf_counter() - start)
+
+
+def _receive_counting(receiver, received):
+    with receiver.open() as get:
+        while True:
+            objs = get.get_many(256, max_wait=0.001)
+            with received.get_lock():
+                received.value += len(objs)
+
+
+def bench_dispatch(dispatch, receivers, count, size=64):
+    """
+    Send count messages over a broker queue with the given dispatch policy to several receiver processes.
+
+    :return: messages per second and the share of the busiest receiver
+    """
+    with ZMQueueManager("benchmark", dispatch=dispatch) as queue:
+        shares = [Value("i", 0) for _ in range(receivers)]
+        processes = [Process(target=_receive_counting, args=(queue.receiver(), share)) for share in shares]
+        [p.start() for p in processes]
+        connected = 0
+        while connected < receivers:
+            time.sleep(0.01)
+            with suppress(OSError):
+                connected = query_stats(queue.bq.uds)["receivers"]
+        payload = os.urandom(size)
+        with queue.sender().open(key=lambda obj: obj[:1]) as put:
+            start = time.perf_counter()
+            for i in range(count // 64):
+                put.put_many([bytes([i % 256]) + payload] * 64)
+            while sum(share.value for share in shares) < count // 64 * 64:
+                time.sleep(0.001)
+            duration = time.perf_counter() - start
+        [p.kill() for p in processes]
+        return count / duration, max(share.value for share in shares) / sum(share.value for share in shares)
+
+
+def script_main():
+    print("object codecs (us per object)")  # noqa: T001
+    print("{:<28} {:<18} {:>8} {:>8} {:>8}".format("object", "codec", "dumps", "loads", "bytes"))  # noqa: T001
+    codecs = [PickleSerializer, EventSerializer] + ([MsgpackSerializer] if msgpack is not None else [])
+    for name, obj in sample_objects().items():
+        for codec in codecs:
+            result = bench_codec(codec, obj)
+            if result is None:
+                print("{:<28} {:<18} {:>8}".format(name, codec.__name__, "n/a"))  # noqa: T001
+            else:
+                print("{:<28} {:<18} {:>8.2f} {:>8.2f} {:>8}".format(name, codec.__name__, *result))  # noqa: T001
+    print()  # noqa: T001
+    print("framing codec cost per message (us)")  # noqa: T001
+    print("{:<26} {:>8} {:>10} {:>10} {:>12}".format("framing", "payload", "serialize", "parse", "deserialize"))  # noqa: T001
+    for framing in (Serializer, LengthPrefixedSerializer):
+        for size in PAYLOAD_SIZES:
+            result = bench_framing(framing, size)
+            print(  # noqa: T001
+                "{:<26} {:>8} {:>10.2f} {:>10.2f} {:>12.2f}".format(
+                    framing.__name__, size, result["serialize"], result["parse"], result["deserialize"]
+                )
+            )
+    print()  # noqa: T001
+    print("incremental decoding of one frame in 16 KiB reads (us)")  # noqa: T001
+    print("{:<26} {:>8} {:>10} {:>10}".format("framing", "payload", "copy", "view"))  # noqa: T001
+    for framing in (Serializer, LengthPrefixedSerializer):
+        for size in (64 * 1024, 1024 * 1024, 8 * 1024 * 1024):
+            print("{:<26} {:>8} {:>10.2f} {:>10.2f}".format(framing.__name__, size, *bench_decoder(framing, size)))  # noqa: T001
+    print()  # noqa: T001
+    print("queue transports (sender process -> receiver process)")  # noqa: T001
+    print("{:<6} {:>8} {:>12} {:>14}".format("", "payload", "msgs/s", "latency (us)"))  # noqa: T001
+    for transport in ("uds", "direct", "shm") if SUPPORTED else ("uds", "direct"):
+        for size in PAYLOAD_SIZES:
+            throughput, _ = bench_transport(transport, size, 20000 if size < 4096 else 2000)
+            _, latency = bench_transport(transport, size, 500, pause=0.001)
+            print("{:<6} {:>8} {:>12.0f} {:>14.1f}".format(transport, size, throughput, latency))  # noqa: T001
+    print()  # noqa: T001
+    print("put_many/get_many over the broker (msgs/s)")  # noqa: T001
+    print("{:<6} {:>8} {:>12}".format("batch", "payload", "msgs/s"))  # noqa: T001
+    for batch in (1, 16, 64):
+        for size in (64, 1500):
+            print("{:<6} {:>8} {:>12.0f}".format(batch, size, bench_batching(size, 64000, batch)))  # noqa: T001
+    print()  # noqa: T001
+    print("dispatch policies, 4 receivers (64 B messages)")  # noqa: T001
+    print("{:<18} {:>12} {:>10}".format("dispatch", "msgs/s", "busiest"))  # noqa: T001
+    for dispatch in DISPATCH_POLICIES:
+        throughput, busiest = bench_dispatch(dispatch, 4, 64000)
+        print("{:<18} {:>12.0f} {:>9.0%}".format(dispatch, throughput, busiest))  # noqa: T001
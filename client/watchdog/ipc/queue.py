@@ -1,15 +1,22 @@
 import asyncio
 import collections
+import fcntl
+import json
 import os
 import random
+import select
+import selectors
 import signal
 import socket
+import struct
+import termios
 import time
+import zlib
 from contextlib import suppress
 from io import UnsupportedOperation
 
 import watchdog.core.processes
-from watchdog.ipc.serializers import PickleSerializer, Serializer
+from watchdog.ipc.serializers import SERIALIZERS, FrameDecoder, PickleSerializer, Serializer
 
 
 class DeserializationError(Exception):
@@ -25,11 +32,22 @@ class QueueClosed(Exception):
 
 
 class BaseQueue:
-    def __init__(self, name, no_loss=False):
+    def __init__(self, name, no_loss=False, framing=Serializer, serializer=PickleSerializer):
         self.uds = "/tmp/arpjetqueue_" + str(time.time()) + str(random.randint(10000, 100000))  # nosec
         with suppress(FileNotFoundError):
             os.unlink(self.uds)
         self.name = name
+        self.framing = framing
+        self.serializer = serializer
+        self.listener = None
+        self.direct = False  # the receiver owns the listening socket, see DirectQueue
+        self.keyed = False  # senders send a routing key with every object, see QueueServer
+
+    def __getstate__(self):
+        # the listening socket of a direct queue only lives in the receiver process (inherited by fork)
+        state = dict(self.__dict__)
+        state["listener"] = None
+        return state
 
     def close(self):
         with suppress(FileNotFoundError):
@@ -37,11 +55,17 @@ class BaseQueue:
 
 
 class QueueContext:
-    def __init__(self, bq, qcargs, generator, async_generator):
+    def __init__(self, bq, qcargs, generator, async_generator, key=None):
         self.bq = bq
-        self._qc = QueueClient(*qcargs)
+        if bq.direct and qcargs[0] == b"r":
+            if bq.listener is None:
+                raise UnsupportedOperation("the receiver of direct queue '{}' was pickled, it must be inherited by fork".format(bq.name))
+            self._qc = DirectReceiverClient(bq.listener, *qcargs)
+        else:
+            self._qc = QueueClient(*qcargs, framing=bq.framing, key=key if bq.keyed else None)
         self.generator = generator
         self.async_generator = async_generator
+        self.batcher = None
 
     def __enter__(self):
         assert not self._qc.socket
@@ -57,22 +81,117 @@ class QueueContext:
         self._qc.disconnect_sync()
 
     async def __aexit__(self, exc_type, exc_val, exc_tb):
+        if self.batcher is not None:
+            await self.batcher.flush()
         await self._qc.disconnect()
 
 
+class AutoBatcher:
+    """
+    Nagle-like batching for async senders: put() only buffers the object and the buffered objects are sent with one
+    put_many() call once max_batch objects are buffered or flush_delay seconds after the first one was buffered.
+    Errors of a delayed flush are raised by the next put() or flush().
+    """
+
+    def __init__(self, qc, flush_delay, max_batch):
+        self.qc = qc
+        self.flush_delay = flush_delay
+        self.max_batch = max_batch
+        self.pending = []
+        self.timer = None
+        self.task = None
+        self.error = None
+
+    def _raise_error(self):
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
+
+    async def put(self, obj):
+        self._raise_error()
+        self.pending.append(obj)
+        if len(self.pending) >= self.max_batch:
+            await self.flush()
+        elif self.timer is None:
+            self.timer = asyncio.get_event_loop().call_later(self.flush_delay, self._flush_later)
+
+    def _flush_later(self):
+        self.timer = None
+        self.task = asyncio.get_event_loop().create_task(self._flush())
+        self.task.add_done_callback(self._flush_done)
+
+    def _flush_done(self, task):
+        if not task.cancelled() and task.exception() is not None:
+            self.error = task.exception()
+
+    async def _flush(self):
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        objs, self.pending = self.pending, []
+        if objs:
+            await self.qc.put_many(objs)
+
+    async def flush(self):
+        """Send all buffered objects now"""
+        if self.task is not None and not self.task.done():
+            # a delayed flush that did not start yet would send older objects after ours
+            await asyncio.wait([self.task])
+        self._raise_error()
+        await self._flush()
+
+
+def batching_sender(context, qc, put, flush_delay, max_batch):
+    """Attach put_many (and flush if flush_delay is set) to an async put function, see QueueSender.open"""
+    if flush_delay is None:
+        put.put_many = qc.put_many
+        return put
+
+    batcher = context.batcher = AutoBatcher(qc, flush_delay, max_batch)
+
+    async def put_batched(data, timeout=-1):
+        if timeout != -1:
+            return await asyncio.wait_for(batcher.put(data), timeout)
+        return await batcher.put(data)
+
+    async def put_many(objs):
+        for obj in objs:
+            await batcher.put(obj)
+
+    put_batched.put_many = put_many
+    put_batched.flush = batcher.flush
+    return put_batched
+
+
 class QueueSender:
-    def __init__(self, bq: BaseQueue, serializer=PickleSerializer):
+    def __init__(self, bq: BaseQueue, serializer=None):
+        """:param serializer: object codec, defaults to the codec of the queue. The queue rejects other codecs."""
         self.bq = bq
-        self.qcargs = (b"s", serializer)
+        self.qcargs = (b"s", serializer or bq.serializer)
+
+    def open(self, flush_delay=None, max_batch=64, key=None):  # noqa: A003
+        """
+        put(obj) sends one object, put.put_many(objs) sends a list of objects with a single syscall.
+
+        :param flush_delay: enables auto batching for async senders: objects are buffered for up to flush_delay seconds
+        or until max_batch objects are buffered and then sent together. put.flush() sends the buffered objects at once.
+        :param key: function that returns the routing key of an object, e.g. the flow 5-tuple of a packet or a device
+        MAC. Queues with the "sticky" dispatch policy deliver all objects with the same key to the same receiver, other
+        queues ignore it. See routing_key for the supported key types.
+        """
 
-    def open(self):  # noqa: A003
         def do(qc):
+            if flush_delay is not None:
+                qc.disconnect_sync()
+                raise UnsupportedOperation("Auto batching is not supported for sync queues")
+
             def put(data, timeout=-1):
                 if timeout != -1:
                     raise UnsupportedOperation("Timeout is not supported for sync queues")
                 else:
                     return qc.put_sync(data)
 
+            put.put_many = qc.put_many_sync
             return put
 
         def doasync(qc):
@@ -82,17 +201,24 @@ class QueueSender:
                 else:
                     return await qc.put(data)
 
-            return put
+            return batching_sender(context, qc, put, flush_delay, max_batch)
 
-        return QueueContext(self.bq, self.qcargs, do, doasync)
+        context = QueueContext(self.bq, self.qcargs, do, doasync, key)
+        return context
 
 
 class QueueReceiver:
-    def __init__(self, bq: BaseQueue, serializer=PickleSerializer):
+    def __init__(self, bq: BaseQueue, serializer=None):
+        """:param serializer: object codec, defaults to the codec of the queue. The queue rejects other codecs."""
         self.bq = bq
-        self.qcargs = (b"r", serializer)
+        self.qcargs = (b"r", serializer or bq.serializer)
 
     def open(self):  # noqa: A003
+        """
+        get() returns the next object, get.get_many(max_items, max_wait) waits for the next object and returns it
+        together with up to max_items - 1 further objects that arrive within max_wait seconds.
+        """
+
         def do(qc):
             get_gen = qc.get_sync()
 
@@ -102,6 +228,7 @@ class QueueReceiver:
                 else:
                     return next(get_gen)
 
+            get.get_many = qc.get_many_sync
             return get
 
         def doasync(qc):
@@ -113,20 +240,70 @@ class QueueReceiver:
                 else:
                     return await get_gen.__anext__()
 
+            get.get_many = qc.get_many
             return get
 
         return QueueContext(self.bq, self.qcargs, do, doasync)
 
 
+async def collect_many(qc, max_items, max_wait):
+    """
+    Implementation of get_many for the queue clients. qc.frames holds the received but not yet returned objects,
+    qc._fill(timeout) waits up to timeout seconds for more and qc._pop() returns the next one.
+    """
+    while not qc.frames:
+        await qc._fill()
+    deadline = time.monotonic() + max_wait
+    while len(qc.frames) < max_items:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            break
+        await qc._fill(remaining)
+    return [qc._pop() for _ in range(min(max_items, len(qc.frames)))]
+
+
+def collect_many_sync(qc, max_items, max_wait):
+    """Sync version of collect_many"""
+    while not qc.frames:
+        qc._fill_sync()
+    deadline = time.monotonic() + max_wait
+    while len(qc.frames) < max_items:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            break
+        qc._fill_sync(remaining)
+    return [qc._pop() for _ in range(min(max_items, len(qc.frames)))]
+
+
+def routing_key(key):
+    """:return: the routing key as bytes, bytes and str are taken as they are, other keys (e.g. tuples) by their repr"""
+    if type(key) is bytes:
+        return key
+    if type(key) is str:
+        return key.encode()
+    return repr(key).encode()
+
+
 class QueueClient:
-    def __init__(self, mode, serializer: Serializer):
+    """
+    Connection of a sender or receiver to a queue server.
+    Received data goes straight into the buffer of a FrameDecoder and the payloads are handed to the serializer as
+    memoryviews of that buffer, see FrameDecoder. read_size is the initial size of a read, it adapts to the traffic.
+    A sender with a key function connects as keyed sender (mode byte b"k") and sends a frame with the routing key in
+    front of every object.
+    """
+
+    def __init__(self, mode, serializer: PickleSerializer, framing=Serializer, read_size=16384, key=None):
         self.mode = mode
+        self.key = key
         self.serializer = serializer
+        self.framing = framing
         self.need_data = True
         self.socket = None
         self.loop = None
         self.lock = asyncio.Lock()
-        self.buf: bytes = b""
+        self.decoder = FrameDecoder(framing, read_size)
+        self.frames = collections.deque()
 
     async def connect(self, uds, timeout=0.5):
         assert self.socket is None
@@ -143,7 +320,7 @@ class QueueClient:
             await asyncio.sleep(0.01)
             await self.loop.sock_connect(self.socket, uds)
 
-        await self.loop.sock_sendall(self.socket, self.mode)
+        await self.loop.sock_sendall(self.socket, self._handshake())
         self.need_data = True
 
     def connect_sync(self, uds, timeout=0.5):
@@ -155,78 +332,122 @@ class QueueClient:
         while not os.path.exists(uds) and timeout > 0:
             time.sleep(0.01)
             timeout - 0.01
-        self.socket.connect(uds)
-        self.socket.sendall(self.mode)
+        try:
+            self.socket.connect(uds)
+        except ConnectionRefusedError:
+            # the socket is bound, but the queue server does not listen yet
+            time.sleep(0.01)
+            self.socket.connect(uds)
+        self.socket.sendall(self._handshake())
         self.need_data = True
 
-    async def get(self):
-        assert self.socket is not None
-        assert self.loop is not None
-        assert self.mode == b"r"
+    def _handshake(self):
+        mode = b"k" if self.key is not None and self.mode == b"s" else self.mode
+        return mode + bytes([self.serializer.codec_id])
+
+    def _encode(self, objs):
+        if self.key is None:
+            return b"".join([self.framing.serialize(self.serializer.dumps(obj)) for obj in objs])
+        frames = []
+        for obj in objs:
+            frames.append(self.framing.serialize(routing_key(self.key(obj))))
+            frames.append(self.framing.serialize(self.serializer.dumps(obj)))
+        return b"".join(frames)
+
+    def _received(self, size, requested):
+        if size == 0:
+            raise QueueClosed("connection closed")
+        self.decoder.commit(size, requested)
+        self.frames.extend(self.decoder.payloads())
+
+    async def _fill(self, timeout=None):
+        """Receive once and queue every complete frame, wait at most timeout seconds for data"""
         async with self.lock:
-            while True:
+            with self.decoder.recv_buffer() as target:
                 try:
-                    data = await self.loop.sock_recv(self.socket, 16384)
+                    size = await asyncio.wait_for(self.loop.sock_recv_into(self.socket, target), timeout)
+                except asyncio.TimeoutError:
+                    return
                 except BrokenPipeError as e:
                     raise QueueClosed(e)
-                if data == b"":
-                    raise QueueClosed("connection closed")
-                self.buf += data
-                while self.buf:
-                    inp = self.buf
-                    packet, self.buf = Serializer.parse(self.buf)
-                    if packet is not None:
-                        self.need_data = False
-                        try:
-                            yield self.serializer.deserialize(packet)
-                        except Exception as e:
-                            with open("./failed_payload" + str(time.time()) + "_inp.txt", "wb") as f:
-                                f.write(inp)
-                                f.flush()
-                            with open("./failed_payload" + str(time.time()) + "_buf.txt", "wb") as f:
-                                f.write(self.buf)
-                                f.flush()
-                            raise e
+                requested = len(target)
+            self._received(size, requested)
 
-                    else:
-                        break
+    def _fill_sync(self, timeout=None):
+        if timeout is not None and not select.select([self.socket], [], [], timeout)[0]:
+            return
+        with self.decoder.recv_buffer() as target:
+            try:
+                size = self.socket.recv_into(target)
+            except BrokenPipeError as e:
+                raise QueueClosed(e)
+            requested = len(target)
+        self._received(size, requested)
+
+    def _pop(self):
+        payload = self.frames.popleft()
+        self.need_data = False
+        try:
+            return self.serializer.loads(payload)
+        except Exception as e:
+            with open("./failed_payload" + str(time.time()) + "_inp.txt", "wb") as f:
+                f.write(payload)
+                f.flush()
+            with open("./failed_payload" + str(time.time()) + "_buf.txt", "wb") as f:
+                f.write(self.decoder.pending())
+                f.flush()
+            raise e
+
+    async def get(self):
+        assert self.socket is not None
+        assert self.loop is not None
+        assert self.mode == b"r"
+        while True:
+            while self.frames:
+                yield self._pop()
+            await self._fill()
 
     def get_sync(self):
         assert self.socket is not None
         assert self.loop is None
         assert self.mode == b"r"
         while True:
-            try:
-                data = self.socket.recv(16384)
-            except BrokenPipeError as e:
-                raise QueueClosed(e)
-            if data == b"":
-                raise QueueClosed("connection closed")
-            self.buf += data
-            while self.buf:
-                packet, self.buf = Serializer.parse(self.buf)
-                if packet is not None:
-                    self.need_data = False
-                    yield self.serializer.deserialize(packet)
-                else:
-                    break
+            while self.frames:
+                yield self._pop()
+            self._fill_sync()
+
+    async def get_many(self, max_items, max_wait=0.0):
+        assert self.socket is not None
+        assert self.mode == b"r"
+        return await collect_many(self, max_items, max_wait)
+
+    def get_many_sync(self, max_items, max_wait=0.0):
+        assert self.socket is not None
+        assert self.mode == b"r"
+        return collect_many_sync(self, max_items, max_wait)
 
     async def put(self, obj):
+        await self.put_many([obj])
+
+    async def put_many(self, objs):
         assert self.socket is not None
         if self.loop is None:
             self.loop = asyncio.get_event_loop()
+        assert self.mode == b"s"
+        data = self._encode(objs)
         async with self.lock:
-            assert self.mode == b"s"
-            data = self.serializer.serialize(obj)
             try:
                 await self.loop.sock_sendall(self.socket, data)
             except BrokenPipeError as e:
                 raise QueueClosed(e)
 
     def put_sync(self, obj):
+        self.put_many_sync([obj])
+
+    def put_many_sync(self, objs):
         assert self.socket is not None
         assert self.mode == b"s"
-        data = self.serializer.serialize(obj)
+        data = self._encode(objs)
         try:
             self.socket.sendall(data)
         except BrokenPipeError as e:
@@ -242,14 +463,352 @@ class QueueClient:
         self.loop = None
 
 
+class DirectListener:
+    """
+    Receiving end of a brokerless queue. It owns the listening unix socket of the queue and accepts the sender
+    connections itself. Accepted connections and their partially received frames belong to the listener and not to a
+    receiver context, so a module that restarts in the same process picks them up again.
+    """
+
+    # stop reading from the sockets if that many frames wait for the receiver, the kernel buffers then block the senders
+    max_ready = 1024
+
+    def __init__(self, uds, framing=Serializer, serializer=PickleSerializer, name=None):
+        self.name = name
+        self.framing = framing
+        self.serializer = serializer
+        self.socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.socket.setblocking(False)
+        self.socket.bind(uds)
+        self.socket.listen(128)
+        self.connections = {}  # accepted socket -> FrameDecoder, the received part of the handshake until it is complete
+        self.ready = collections.deque()
+        self.enqueued = 0
+        self.bytes_in = 0
+
+    def stats(self):
+        return {
+            "name": self.name,
+            "type": "direct",
+            "pid": os.getpid(),
+            "queued": len(self.ready),
+            "enqueued": self.enqueued,
+            "senders": sum(1 for decoder in self.connections.values() if type(decoder) is not bytes),
+            "receivers": 1,
+            "bytes_in": self.bytes_in,
+        }
+
+    def accept(self):
+        """:return: list of newly accepted connections"""
+        accepted = []
+        while True:
+            try:
+                sock, _ = self.socket.accept()
+            except BlockingIOError:
+                return accepted
+            sock.setblocking(False)
+            self.connections[sock] = b""
+            accepted.append(sock)
+
+    def read(self, sock):
+        """
+        Read what is available on sock and queue the complete frames.
+
+        :return: False if the connection is closed and should be dropped
+        """
+        decoder = self.connections[sock]
+        if type(decoder) is bytes:
+            # handshake: mode byte and codec id, read separately so the frames are received into the decoder
+            try:
+                data = decoder + sock.recv(2 - len(decoder))
+            except BlockingIOError:
+                return True
+            except ConnectionError:
+                return False
+            if data == decoder:
+                return False
+            if len(data) < 2:
+                self.connections[sock] = data
+                return True
+            if data[:1] == b"m":
+                # the reply is small enough for the socket buffer
+                with suppress(OSError):
+                    sock.send(json.dumps(self.stats()).encode())
+                return False
+            if data[:1] != b"s" or data[1] != self.serializer.codec_id:
+                return False
+            self.connections[sock] = FrameDecoder(self.framing)
+            return True
+        with decoder.recv_buffer() as target:
+            try:
+                size = sock.recv_into(target)
+            except BlockingIOError:
+                return True
+            except ConnectionError:
+                return False
+            requested = len(target)
+        if size == 0:
+            return False
+        self.bytes_in += size
+        decoder.commit(size, requested)
+        ready = len(self.ready)
+        self.ready.extend(decoder.payloads())
+        self.enqueued += len(self.ready) - ready
+        return True
+
+    def drop(self, sock):
+        del self.connections[sock]
+        sock.close()
+
+    def close(self):
+        for sock in list(self.connections):
+            self.drop(sock)
+        self.socket.close()
+
+
+class DirectReceiverClient:
+    """QueueClient replacement for the receiver of a direct queue, it reads from the DirectListener instead of a broker"""
+
+    def __init__(self, listener: DirectListener, mode, serializer: PickleSerializer):
+        assert mode == b"r"
+        self.listener = listener
+        self.frames = listener.ready
+        self.mode = mode
+        self.serializer = serializer
+        self.socket = None
+        self.loop = None
+        self.selector = None
+        self.wakeup = None
+        self.paused = set()
+
+    async def connect(self, uds, timeout=0.5):
+        self.loop = asyncio.get_event_loop()
+        self.wakeup = asyncio.Event()
+        self.loop.add_reader(self.listener.socket, self._on_accept)
+        for sock in self.listener.connections:
+            self.loop.add_reader(sock, self._on_data, sock)
+
+    def connect_sync(self, uds, timeout=0.5):
+        self.loop = None
+        self.selector = selectors.DefaultSelector()
+        self.selector.register(self.listener.socket, selectors.EVENT_READ)
+        for sock in self.listener.connections:
+            self.selector.register(sock, selectors.EVENT_READ)
+
+    def _on_data(self, sock):
+        if not self.listener.read(sock):
+            self.loop.remove_reader(sock)
+            self.listener.drop(sock)
+        elif len(self.frames) >= self.listener.max_ready:
+            self.loop.remove_reader(sock)
+            self.paused.add(sock)
+        self.wakeup.set()
+
+    def _on_accept(self):
+        for sock in self.listener.accept():
+            self.loop.add_reader(sock, self._on_data, sock)
+
+    async def _fill(self, timeout=None):
+        self.wakeup.clear()
+        with suppress(asyncio.TimeoutError):
+            await asyncio.wait_for(self.wakeup.wait(), timeout)
+
+    def _fill_sync(self, timeout=None):
+        for key, _ in self.selector.select(timeout):
+            if key.fileobj is self.listener.socket:
+                for sock in self.listener.accept():
+                    self.selector.register(sock, selectors.EVENT_READ)
+            elif not self.listener.read(key.fileobj):
+                self.selector.unregister(key.fileobj)
+                self.listener.drop(key.fileobj)
+
+    def _pop(self):
+        obj = self.serializer.loads(self.frames.popleft())
+        if self.paused and len(self.frames) < self.listener.max_ready // 2:
+            for sock in self.paused:
+                self.loop.add_reader(sock, self._on_data, sock)
+            self.paused.clear()
+        return obj
+
+    async def get(self):
+        assert self.loop is not None
+        while True:
+            while self.frames:
+                yield self._pop()
+            await self._fill()
+
+    def get_sync(self):
+        assert self.loop is None
+        while True:
+            while self.frames:
+                yield self._pop()
+            self._fill_sync()
+
+    async def get_many(self, max_items, max_wait=0.0):
+        return await collect_many(self, max_items, max_wait)
+
+    def get_many_sync(self, max_items, max_wait=0.0):
+        return collect_many_sync(self, max_items, max_wait)
+
+    async def disconnect(self):
+        self.disconnect_sync()
+
+    def disconnect_sync(self):
+        if self.loop is not None:
+            self.loop.remove_reader(self.listener.socket)
+            for sock in self.listener.connections:
+                self.loop.remove_reader(sock)
+            self.paused.clear()
+        if self.selector is not None:
+            self.selector.close()
+            self.selector = None
+        self.loop = None
+
+
+OVERFLOW_BLOCK = "block"
+OVERFLOW_DROP_OLDEST = "drop_oldest"
+OVERFLOW_DROP_NEWEST = "drop_newest"
+OVERFLOW_SAMPLE = "sample"
+OVERFLOW_POLICIES = (OVERFLOW_BLOCK, OVERFLOW_DROP_OLDEST, OVERFLOW_DROP_NEWEST, OVERFLOW_SAMPLE)
+
+DISPATCH_SHARED = "shared"
+DISPATCH_ROUND_ROBIN = "round_robin"
+DISPATCH_LEAST_OUTSTANDING = "least_outstanding"
+DISPATCH_STICKY = "sticky"
+DISPATCH_POLICIES = (DISPATCH_SHARED, DISPATCH_ROUND_ROBIN, DISPATCH_LEAST_OUTSTANDING, DISPATCH_STICKY)
+
+
+class ReceiverOutbox:
+    """Frames a QueueServer dispatched to one receiver that are not written to its socket yet"""
+
+    def __init__(self, rid, socket):
+        self.rid = rid
+        self.socket = socket
+        self.entries = collections.deque()  # (key, frame)
+        self.enqueued_at = collections.deque()
+        self.size = 0  # bytes in entries
+        self.unread = 0  # bytes in the socket the receiver did not read yet, see update_unread
+        self.ready = asyncio.Event()
+        self.lost = False
+
+    def on_readable(self):
+        # receivers do not send anything after the handshake, the socket only gets readable when they disconnect
+        self.lost = True
+        self.ready.set()
+
+    def update_unread(self):
+        with suppress(OSError):
+            self.unread = struct.unpack("i", fcntl.ioctl(self.socket.fileno(), termios.TIOCOUTQ, b"\0\0\0\0"))[0]
+
+    def outstanding(self):
+        """:return: bytes dispatched to the receiver that it did not read yet"""
+        return self.size + self.unread
+
+
 class QueueServer:  # noqa: SIM119
-    def __init__(self, debug):
-        self.to_send = collections.deque()
+    """
+    Broker of a ZMQueue. It buffers the frames of all senders in to_send until a receiver takes them.
+
+    Clients connect with the mode byte b"s" (sender) or b"r" (receiver) followed by the codec id. A client that sends
+    the mode byte b"m" gets the counters of the queue as JSON instead, see query_stats.
+
+    max_queued bounds to_send (None: unbounded) and overflow selects what happens when it is full:
+    "block" stops reading from the senders until the receivers took a quarter of the frames, so the senders block in
+    sendall once the socket buffers are full. "drop_oldest" drops the oldest queued frame for every new one,
+    "drop_newest" drops the new frames and "sample" queues every sample_every-th new frame in place of the oldest one
+    and drops the others.
+
+    dispatch selects how frames are distributed over several receivers:
+    "shared" lets all receivers take frames from to_send as soon as they can write to their socket, without any
+    fairness. The other policies run a dispatcher that moves the frames from to_send to a bounded outbox per receiver:
+    "round_robin" hands the frames to the receivers in turn and skips receivers whose outbox is full,
+    "least_outstanding" picks the receiver with the fewest bytes in its outbox and unread in its socket and
+    "sticky" picks a receiver by rendezvous hashing of the routing key sent by keyed senders (mode byte b"k"), so all
+    frames with the same key reach the same receiver in order. Frames without key are dispatched round robin.
+    The dispatcher waits while the outbox of the picked receiver is full, a slow sticky receiver therefore delays the
+    others. When a receiver connects, the keys that hash to it move to it. When a receiver disconnects, its outbox goes
+    back to the front of to_send, only then can the frames of one key arrive out of order.
+    """
+
+    # maximum number of frames forwarded to a receiver with one sendall
+    max_batch = 64
+    sample_every = 10
+    # maximum number of frames in the outbox of a receiver
+    outbox_size = 256
+
+    def __init__(
+        self,
+        debug,
+        framing=Serializer,
+        serializer=PickleSerializer,
+        max_queued=None,
+        overflow=OVERFLOW_BLOCK,
+        name=None,
+        dispatch=DISPATCH_SHARED,
+    ):
+        if overflow not in OVERFLOW_POLICIES:
+            raise ValueError("Unknown overflow policy: " + repr(overflow))
+        if dispatch not in DISPATCH_POLICIES:
+            raise ValueError("Unknown dispatch policy: " + repr(dispatch))
+        self.to_send = collections.deque()  # frames, (key, frame) if frames are dispatched to outboxes
+        self.enqueued_at = collections.deque()  # time.monotonic() of every frame in to_send
+        self.name = name
         self.debug = debug
+        self.framing = framing
+        self.serializer = serializer
+        self.max_queued = max_queued
+        self.overflow = overflow
+        self.dispatch = dispatch
+        self.outboxes = {}  # receiver id: ReceiverOutbox, in the order the receivers connected
+        self.next_receiver = 0
+        self.next_round_robin = 0
+        self.owners = {}  # routing key: receiver id, cache of the rendezvous hashing, cleared when the receivers change
+        # counters
+        self.enqueued = 0
+        self.dropped = 0
+        self.forwarded = 0
+        self.blocked = 0
+        self.overflowing = 0
+        self.senders = 0
+        self.receivers = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.frame_sizes = [0] * 33  # histogram, frames of up to 2**i bytes are counted in bucket i
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+
+    def stats(self):
+        return {
+            "name": self.name,
+            "type": "broker",
+            "pid": os.getpid(),
+            "queued": len(self.to_send) + sum(len(outbox.entries) for outbox in self.outboxes.values()),
+            "enqueued": self.enqueued,
+            "forwarded": self.forwarded,
+            "dropped": self.dropped,
+            "blocked": self.blocked,
+            "max_queued": self.max_queued,
+            "overflow": self.overflow,
+            "dispatch": self.dispatch,
+            "outboxes": [len(outbox.entries) for outbox in self.outboxes.values()],
+            "senders": self.senders,
+            "receivers": self.receivers,
+            "bytes_in": self.bytes_in,
+            "bytes_out": self.bytes_out,
+            "frame_sizes": {2**i: count for i, count in enumerate(self.frame_sizes) if count},
+            "wait_total": self.wait_total,
+            "wait_max": self.wait_max,
+            "oldest_wait": time.monotonic() - self.enqueued_at[0] if self.enqueued_at else 0.0,
+        }
 
     async def start(self, uds):
         self.sem = asyncio.Semaphore(0)
+        self.space = asyncio.Event()
+        self.space.set()
+        self.dispatchable = asyncio.Event()  # set when an outbox got space or the receivers changed
         self.loop = asyncio.get_event_loop()
+        if self.dispatch != DISPATCH_SHARED:
+            self.dispatcher = asyncio.create_task(self._dispatcher())
         self.socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
         self.socket.setblocking(False)
         self.socket.bind(uds)
@@ -259,14 +818,42 @@ class QueueServer:  # noqa: SIM119
             asyncio.create_task(self._handshake(sock))
 
     async def _handshake(self, socket):
+        mode = b""
         try:
-            mode = await self.loop.sock_recv(socket, 1)
+            handshake = b""
+            while len(handshake) < 2:
+                data = await self.loop.sock_recv(socket, 2 - len(handshake))
+                if data == b"":
+                    return
+                handshake += data
+            mode, codec = handshake[:1], handshake[1]
+            if mode == b"m":
+                await self.loop.sock_sendall(socket, json.dumps(self.stats()).encode())
+                return
+            if codec != self.serializer.codec_id:
+                # all clients of a queue have to agree on the codec of the queue
+                if self.debug:
+                    print(  # noqa: T001
+                        "rejected {} using {} instead of {}".format(mode.decode(), SERIALIZERS.get(codec, codec), self.serializer.__name__)
+                    )
+                return
             if self.debug:
                 print("connected " + mode.decode())  # noqa: T001
-            if mode == b"s":
-                await self._sender(socket)
+            if mode in (b"s", b"k"):
+                self.senders += 1
+                try:
+                    await self._sender(socket, keyed=mode == b"k")
+                finally:
+                    self.senders -= 1
             elif mode == b"r":
-                await self._receiver(socket)
+                self.receivers += 1
+                try:
+                    if self.dispatch == DISPATCH_SHARED:
+                        await self._receiver(socket)
+                    else:
+                        await self._outbox_receiver(socket)
+                finally:
+                    self.receivers -= 1
         except BrokenPipeError:
             pass
         finally:
@@ -274,38 +861,172 @@ class QueueServer:  # noqa: SIM119
                 print("disconnected " + mode.decode())  # noqa: T001
             socket.close()
 
-    async def send_packet(self, packet):
+    async def send_packet(self, packet, key=None):
+        self.frame_sizes[min(len(packet).bit_length(), 32)] += 1
+        if self.dispatch != DISPATCH_SHARED:
+            packet = (key, packet)
+        if self.max_queued is not None and len(self.to_send) >= self.max_queued and self.overflow != OVERFLOW_BLOCK:
+            self.overflowing += 1
+            if self.overflow == OVERFLOW_DROP_NEWEST or (self.overflow == OVERFLOW_SAMPLE and self.overflowing % self.sample_every):
+                self.dropped += 1
+                return
+            # replace the oldest frame, the semaphore still counts the queued frames
+            self.to_send.popleft()
+            self.enqueued_at.popleft()
+            self.to_send.append(packet)
+            self.enqueued_at.append(time.monotonic())
+            self.dropped += 1
+            self.enqueued += 1
+            return
+        self.overflowing = 0
         self.to_send.append(packet)
+        self.enqueued_at.append(time.monotonic())
+        self.enqueued += 1
         self.sem.release()
 
+    async def _take(self):
+        """Wait for queued frames and take up to max_batch of them from to_send"""
+        await self.sem.acquire()
+        packets = [self.to_send.popleft()]
+        enqueued_at = [self.enqueued_at.popleft()]
+        # take the frames that are already queued, too
+        while len(packets) < self.max_batch and not self.sem.locked():
+            await self.sem.acquire()
+            packets.append(self.to_send.popleft())
+            enqueued_at.append(self.enqueued_at.popleft())
+        if not self.space.is_set() and len(self.to_send) <= self.max_queued * 3 // 4:
+            self.space.set()
+        return packets, enqueued_at
+
+    def _requeue(self, packets, enqueued_at):
+        """Put frames that could not be forwarded back to the front of to_send"""
+        self.to_send.extendleft(reversed(packets))
+        self.enqueued_at.extendleft(reversed(enqueued_at))
+        for _ in packets:
+            self.sem.release()
+
+    def _forwarded(self, count, size, enqueued_at):
+        now = time.monotonic()
+        self.forwarded += count
+        self.bytes_out += size
+        self.wait_total += now * len(enqueued_at) - sum(enqueued_at)
+        self.wait_max = max(self.wait_max, now - enqueued_at[0])
+
     async def _receiver(self, socket):
         while True:
-            await self.sem.acquire()
-            packet = self.to_send.popleft()
+            packets, enqueued_at = await self._take()
             try:
-                await self.loop.sock_sendall(socket, packet)
+                # forward the frames with the same syscall
+                data = b"".join(packets)
+                await self.loop.sock_sendall(socket, data)
+                self._forwarded(len(packets), len(data), enqueued_at)
                 await asyncio.sleep(0)  # load balancing
-                packet = None
+                packets = None
             except BrokenPipeError:
                 return
             finally:
-                if packet:
-                    self.to_send.appendleft(packet)
-                    self.sem.release()
-
-    async def _sender(self, socket):
-        buf = b""
+                if packets:
+                    self._requeue(packets, enqueued_at)
+
+    def _pick(self, key):
+        """:return: the outbox for a frame with the given routing key, None if the frame has to wait"""
+        if self.dispatch == DISPATCH_STICKY and key is not None:
+            rid = self.owners.get(key)
+            if rid is None:
+                if not self.outboxes:
+                    return None
+                # rendezvous hashing: only the keys of a receiver move when it disconnects
+                hashed = zlib.crc32(key)
+                rid = max(self.outboxes, key=lambda rid: hash((hashed, rid)))
+                if len(self.owners) >= 65536:
+                    self.owners.clear()
+                self.owners[key] = rid
+            outbox = self.outboxes[rid]
+            return outbox if len(outbox.entries) < self.outbox_size else None
+        outboxes = [outbox for outbox in self.outboxes.values() if len(outbox.entries) < self.outbox_size]
+        if not outboxes:
+            return None
+        if self.dispatch == DISPATCH_LEAST_OUTSTANDING:
+            return min(outboxes, key=ReceiverOutbox.outstanding)
+        outbox = min(outboxes, key=lambda outbox: (outbox.rid < self.next_round_robin, outbox.rid))
+        self.next_round_robin = outbox.rid + 1
+        return outbox
+
+    async def _dispatcher(self):
         while True:
-            data = await self.loop.sock_recv(socket, 16384)
-            if data == b"":
+            entries, enqueued_at = await self._take()
+            if self.dispatch == DISPATCH_LEAST_OUTSTANDING:
+                for outbox in self.outboxes.values():
+                    outbox.update_unread()
+            for (key, packet), at in zip(entries, enqueued_at):
+                outbox = self._pick(key)
+                while outbox is None:
+                    self.dispatchable.clear()
+                    await self.dispatchable.wait()
+                    outbox = self._pick(key)
+                outbox.entries.append((key, packet))
+                outbox.enqueued_at.append(at)
+                outbox.size += len(packet)
+                outbox.ready.set()
+
+    async def _outbox_receiver(self, socket):
+        outbox = ReceiverOutbox(self.next_receiver, socket)
+        self.next_receiver += 1
+        self.outboxes[outbox.rid] = outbox
+        self.owners.clear()
+        self.dispatchable.set()
+        self.loop.add_reader(socket.fileno(), outbox.on_readable)
+        entries = enqueued_at = []
+        try:
+            while not outbox.lost:
+                if not outbox.entries:
+                    outbox.ready.clear()
+                    await outbox.ready.wait()
+                    continue
+                count = min(len(outbox.entries), self.max_batch)
+                entries = [outbox.entries.popleft() for _ in range(count)]
+                enqueued_at = [outbox.enqueued_at.popleft() for _ in range(count)]
+                data = b"".join([packet for _, packet in entries])
+                outbox.size -= len(data)
+                self.dispatchable.set()
+                await self.loop.sock_sendall(socket, data)
+                self._forwarded(count, len(data), enqueued_at)
+                entries = enqueued_at = []
+        except BrokenPipeError:
+            return
+        finally:
+            self.loop.remove_reader(socket.fileno())
+            del self.outboxes[outbox.rid]
+            self.owners.clear()
+            # the frames of a lost receiver are dispatched to the remaining receivers
+            self._requeue(entries + list(outbox.entries), enqueued_at + list(outbox.enqueued_at))
+            self.dispatchable.set()
+
+    async def _sender(self, socket, keyed=False):
+        """:param keyed: every frame is preceded by a frame with its routing key"""
+        decoder = FrameDecoder(self.framing)
+        key = None
+        while True:
+            if self.overflow == OVERFLOW_BLOCK and self.max_queued is not None and len(self.to_send) >= self.max_queued:
+                # backpressure: leave the data in the socket until the receivers caught up
+                self.blocked += 1
+                self.space.clear()
+                await self.space.wait()
+                continue
+            # the frames are forwarded as bytes, so the decoder buffer is reused for every read
+            with decoder.recv_buffer() as target:
+                size = await self.loop.sock_recv_into(socket, target)
+                requested = len(target)
+            if size == 0:
                 return
-            buf += data
-            while buf:
-                packet, buf = Serializer.parse(buf)
-                if packet:
-                    await self.send_packet(packet)
-                else:
-                    break
+            self.bytes_in += size
+            decoder.commit(size, requested)
+            for packet in decoder:
+                if keyed and key is None:
+                    key = self.framing.deserialize(packet)
+                    continue
+                await self.send_packet(packet, key)
+                key = None
 
 
 class ZMQueue:
@@ -314,14 +1035,28 @@ class ZMQueue:
     Kill ZMQueues by sending a SIGKILL or calling __exit__()
     """
 
-    def __init__(self, name, debug):
+    def __init__(
+        self,
+        name,
+        debug,
+        framing=Serializer,
+        serializer=PickleSerializer,
+        max_queued=None,
+        overflow=OVERFLOW_BLOCK,
+        dispatch=DISPATCH_SHARED,
+    ):
+        if overflow not in OVERFLOW_POLICIES:
+            raise ValueError("Unknown overflow policy: " + repr(overflow))
+        if dispatch not in DISPATCH_POLICIES:
+            raise ValueError("Unknown dispatch policy: " + repr(dispatch))
         self.debug = debug
-        self.bq = BaseQueue(name)
+        self.bq = BaseQueue(name, framing=framing, serializer=serializer)
+        self.bq.keyed = dispatch == DISPATCH_STICKY
 
         def run():
             signal.signal(signal.SIGINT, signal.SIG_IGN)
             try:
-                qs = QueueServer(debug)
+                qs = QueueServer(debug, framing, serializer, max_queued, overflow, name, dispatch)
                 asyncio.run(qs.start(self.bq.uds))
             except KeyboardInterrupt:
                 return
@@ -348,20 +1083,114 @@ class ZMQueue:
             os.kill(self.process.pid, signal.SIGKILL)
 
 
+class DirectQueue:
+    """
+    Brokerless queue with exactly one receiver: the receiver accepts the sender connections on the queue's unix socket
+    itself, which saves the QueueServer process and one hop per message.
+    The socket is bound when the queue is created, so senders can connect and send before the receiver process runs.
+    The receiver handle must reach the receiver process by fork (e.g. as argument of a Process), it cannot be pickled.
+    """
+
+    def __init__(self, name, debug, framing=Serializer, serializer=PickleSerializer):
+        self.debug = debug
+        self.bq = BaseQueue(name, framing=framing, serializer=serializer)
+        self.bq.listener = DirectListener(self.bq.uds, framing, serializer, name)
+        self.bq.direct = True
+        self.process = None
+        self.has_receiver = False
+
+    def receiver(self) -> QueueReceiver:
+        assert not self.has_receiver, "direct queues support only one receiver"
+        self.has_receiver = True
+        return QueueReceiver(self.bq)
+
+    def sender(self) -> QueueSender:
+        return QueueSender(self.bq)
+
+    def close(self):
+        self.bq.listener.close()
+        self.bq.close()
+
+
 class ZMQueueManager:
-    def __init__(self, name, debug=False):
+    """
+    Creates and closes a queue.
+    transport selects how messages travel: "uds" uses a unix stream socket, "shm" a brokerless shared memory ring
+    buffer (watchdog.ipc.shm.ShmQueue, at most one receiver).
+    senders and receivers describe the topology of the queue if it is known. A "uds" queue with exactly one sender and
+    one receiver is created as DirectQueue without broker, every other topology gets a QueueServer broker process.
+    serializer is the object codec of the queue (see watchdog.ipc.serializers.SERIALIZERS), EventSerializer is the
+    fastest one for queues that carry Events.
+    max_queued and overflow bound the frames a QueueServer buffers, see QueueServer. Direct and shm queues are always
+    bounded and block their senders when they are full.
+    dispatch distributes the frames of a QueueServer over its receivers, see QueueServer. Queues with a single receiver
+    ignore it.
+    """
+
+    def __init__(
+        self,
+        name,
+        debug=False,
+        framing=Serializer,
+        transport="uds",
+        senders=None,
+        receivers=None,
+        serializer=PickleSerializer,
+        max_queued=None,
+        overflow=OVERFLOW_BLOCK,
+        dispatch=DISPATCH_SHARED,
+    ):
         self.queue: ZMQueue = None
         self.name: str = name
         self.debug = debug
+        self.framing = framing
+        self.transport = transport
+        self.senders = senders
+        self.receivers = receivers
+        self.serializer = serializer
+        self.max_queued = max_queued
+        self.overflow = overflow
+        self.dispatch = dispatch
 
     def __enter__(self):
-        self.queue = ZMQueue(self.name, self.debug)
+        if self.transport == "shm":
+            from watchdog.ipc.shm import ShmQueue
+
+            self.queue = ShmQueue(self.name, self.debug, serializer=self.serializer)
+        elif self.transport == "uds" and self.senders == 1 and self.receivers == 1:
+            self.queue = DirectQueue(self.name, self.debug, self.framing, self.serializer)
+        elif self.transport == "uds":
+            self.queue = ZMQueue(self.name, self.debug, self.framing, self.serializer, self.max_queued, self.overflow, self.dispatch)
+        else:
+            raise ValueError("Unknown queue transport: " + repr(self.transport))
         return self.queue
 
     def __exit__(self, exc_type, exc_val, exc_tb):
         self.queue.close()
 
 
+def query_stats(uds, timeout=1.0):
+    """
+    Ask the queue behind a unix socket for its counters (QueueServer.stats or DirectListener.stats).
+    Direct queues only answer while their receiver is reading.
+
+    :raises OSError: if the queue does not answer within timeout
+    """
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.settimeout(timeout)
+        sock.connect(uds)
+        sock.sendall(b"m\x00")
+        data = b""
+        while True:
+            chunk = sock.recv(65536)
+            if chunk == b"":
+                break
+            data += chunk
+    if not data:
+        raise ConnectionError("queue closed the connection without stats")
+    return json.loads(data.decode())
+
+
 class MultiQueueManager:
     def __init__(self, name):
         self.queue: ZMQueue = None
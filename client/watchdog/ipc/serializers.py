@@ -2,81 +2,472 @@ import json
 import pickle  # nosec
 import time
 from binascii import hexlify, unhexlify
+from struct import Struct, pack, unpack_from
+
+from watchdog.ipc.event import LOG, NODECONFIG, Event
+from watchdog.network.utils import IP, MAC, ArpNode
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+ESCAPE = b"\x13"
+ESCAPED_ESCAPE = b"\x13\x13"
+TERMINATOR = b"\x13\x00"
 
 
 class Serializer:
+    """
+    Escape framing, the default wire format of all queues.
+    Every 0x13 in the payload is doubled and a frame is terminated by 0x13 0x00.
+    Escaping and scanning are done with bulk bytes operations instead of walking the payload byte by byte.
+    """
+
     @staticmethod
     def serialize(data):
-        out = []
-        for char in data:
-            if char == 0x13:
-                out.append(0x13)
-            out.append(char)
-        out.append(0x13)
-        out.append(0)
-        result = bytes(out)
-        return result
+        return bytes(data).replace(ESCAPE, ESCAPED_ESCAPE) + TERMINATOR
+
+    @staticmethod
+    def find_terminator(data, start=0, frame_start=0, end=None):
+        """
+        Find the end of the first frame in data.
+
+        :param data: buffer that contains the frame starting at frame_start
+        :param start: index to start scanning at, everything before it is known to contain no terminator
+        :param frame_start: index of the first byte of the frame
+        :param end: end of the valid data in the buffer, defaults to its length
+        :return: index after the terminator or -1 if the frame is incomplete
+        """
+        index = data.find(TERMINATOR, max(start, frame_start), end)
+        while index != -1:
+            # the terminator is only valid if the 0x13 in front of the 0x00 is not escaped itself,
+            # i.e. the run of 0x13 ending at index has an odd length
+            run = index
+            while run > frame_start and data[run - 1] == 0x13:
+                run -= 1
+            if (index - run) % 2 == 0:
+                return index + 2
+            index = data.find(TERMINATOR, index + 1, end)
+        return -1
+
+    @staticmethod
+    def frame_length(data, frame_start, end):
+        """:return: length of the frame starting at frame_start if it is known before the frame is complete, else None"""
+        return None
 
     @staticmethod
     def parse(data):
-        escape = False
-        for index, char in enumerate(data):
-            if escape and char == 0:
-                return data[: index + 1], data[index + 1 :]
-            escape = char == 0x13 and not escape
-        return None, data
+        end = Serializer.find_terminator(data)
+        if end == -1:
+            return None, data
+        return data[:end], data[end:]
 
     @staticmethod
     def deserialize(data):
-        out = []
-        escape = False
-        end = False
-        for char in data:
-            if escape and char == 0:
-                end = True
-                continue
-            if char == 0x13:
-                if escape:
-                    if char == 0x13:
-                        pass
-                    else:
-                        raise AssertionError()
-                else:
-                    escape = True
-                    continue
-            escape = False
-            assert not end
-            out.append(char)
-        assert end
-        return bytes(out)
+        assert data[-2:] == TERMINATOR
+        payload = bytes(data[:-2])
+        if ESCAPE in payload:
+            payload = payload.replace(ESCAPED_ESCAPE, ESCAPE)
+        return payload
+
+    @staticmethod
+    def payload(buf, start, end):
+        """Payload of the frame buf[start:end], a memoryview of buf unless escapes have to be removed"""
+        if buf.find(ESCAPE, start, end - 2) == -1:
+            return memoryview(buf)[start : end - 2]
+        return bytes(memoryview(buf)[start : end - 2]).replace(ESCAPED_ESCAPE, ESCAPE)
 
 
-class PickleSerializer(Serializer):
+class LengthPrefixedSerializer(Serializer):
+    """
+    Length-prefixed framing: every frame starts with the payload length as 32 bit unsigned integer (network byte order).
+    The payload is never copied or scanned, but it is not compatible with the escape framing, so every client and the
+    queue server of a queue have to use it. Select it per queue with ZMQueueManager(name, framing=LengthPrefixedSerializer).
+    """
+
+    header = Struct("!I")
+
     @staticmethod
-    def serialize(obj):
-        data = pickle.dumps(obj)
-        return Serializer.serialize(data)
+    def serialize(data):
+        return LengthPrefixedSerializer.header.pack(len(data)) + data
+
+    @staticmethod
+    def find_terminator(data, start=0, frame_start=0, end=None):
+        length = LengthPrefixedSerializer.frame_length(data, frame_start, len(data) if end is None else end)
+        if length is None or frame_start + length > (len(data) if end is None else end):
+            return -1
+        return frame_start + length
+
+    @staticmethod
+    def frame_length(data, frame_start, end):
+        header = LengthPrefixedSerializer.header
+        if end - frame_start < header.size:
+            return None
+        return header.size + header.unpack_from(data, frame_start)[0]
+
+    @staticmethod
+    def parse(data):
+        end = LengthPrefixedSerializer.find_terminator(data)
+        if end == -1:
+            return None, data
+        return data[:end], data[end:]
 
     @staticmethod
     def deserialize(data):
-        data = Serializer.deserialize(data)
+        assert LengthPrefixedSerializer.header.unpack_from(data)[0] == len(data) - LengthPrefixedSerializer.header.size
+        return bytes(data[LengthPrefixedSerializer.header.size :])
+
+    @staticmethod
+    def payload(buf, start, end):
+        return memoryview(buf)[start + LengthPrefixedSerializer.header.size : end]
+
+
+class FrameDecoder:
+    """
+    Incremental frame parser for a byte stream.
+
+    Data is received straight into a preallocated bytearray (recv_buffer and commit) or copied in with feed(). Frames
+    are cut out at a read cursor and a scan cursor remembers how far the buffer was already searched for a frame end,
+    so every byte is scanned once no matter how many reads a frame spans.
+    next_payload() hands out payloads as memoryview slices of the buffer where the framing allows it. A buffer is
+    therefore never resized or overwritten while such views are alive: when it runs out of space, the unconsumed bytes
+    move to the start of the buffer if no views exist and to a new, larger buffer otherwise.
+    The free space reserved for a read adapts to the observed reads between min_read and max_read.
+    The decoder does no I/O, so the asyncio and the sync receive paths share it.
+    """
+
+    min_read = 4096
+    max_read = 1 << 20
+
+    def __init__(self, framing=Serializer, read_size=16384):
+        self.framing = framing
+        self.read_size = read_size
+        self.buf = bytearray(read_size)
+        self.start = 0  # first byte of the next frame
+        self.scan = 0
+        self.end = 0  # end of the received data
+
+    def __len__(self):
+        return self.end - self.start
+
+    def _exported(self):
+        """:return: True if memoryviews of the buffer are alive"""
+        try:
+            self.buf.append(0)
+        except BufferError:
+            return True
+        self.buf.pop()
+        return False
+
+    def _reserve(self, size):
+        """Make room for at least size bytes after the received data"""
+        if len(self.buf) - self.end >= size:
+            return
+        pending = self.end - self.start
+        if len(self.buf) >= pending + size and not self._exported():
+            self.buf[:pending] = self.buf[self.start : self.end]
+        else:
+            buf = bytearray(max(pending + size, 2 * pending, len(self.buf)))
+            buf[:pending] = memoryview(self.buf)[self.start : self.end]
+            self.buf = buf
+        self.scan -= self.start
+        self.start = 0
+        self.end = pending
+
+    def recv_buffer(self):
+        """
+        :return: memoryview of the free space of the buffer to receive into (socket.recv_into), call commit() with the
+        number of received bytes afterwards and release the view.
+        """
+        size = self.read_size
+        length = self.framing.frame_length(self.buf, self.start, self.end)
+        if length is not None:
+            # read the rest of a large frame at once
+            size = max(size, length - (self.end - self.start))
+        self._reserve(size)
+        return memoryview(self.buf)[self.end :]
+
+    def commit(self, size, requested=None):
+        """
+        Add size bytes that were received into recv_buffer().
+
+        :param requested: size of the buffer that was passed to the read, used to adapt the read size
+        """
+        self.end += size
+        if requested is not None:
+            if size == requested:
+                self.read_size = min(self.read_size * 2, self.max_read)
+            elif size < self.read_size // 8:
+                self.read_size = max(self.read_size // 2, self.min_read)
+
+    def feed(self, data):
+        self._reserve(len(data))
+        self.buf[self.end : self.end + len(data)] = data
+        self.end += len(data)
+
+    def _next_end(self):
+        end = self.framing.find_terminator(self.buf, self.scan, self.start, self.end)
+        if end == -1:
+            # the last byte may be the first half of a terminator
+            self.scan = max(self.start, self.end - 1)
+        return end
+
+    def next_frame(self):
+        """
+        Cut the next complete frame out of the buffer.
+
+        :return: the frame including its framing as bytes or None if no complete frame is buffered
+        """
+        end = self._next_end()
+        if end == -1:
+            return None
+        frame = bytes(memoryview(self.buf)[self.start : end])
+        self.start = self.scan = end
+        return frame
+
+    def next_payload(self):
+        """
+        Cut the next complete frame out of the buffer without copying.
+
+        :return: the payload of the frame, usually as memoryview of the buffer, or None if no complete frame is buffered
+        """
+        end = self._next_end()
+        if end == -1:
+            return None
+        payload = self.framing.payload(self.buf, self.start, end)
+        self.start = self.scan = end
+        return payload
+
+    def pending(self):
+        """:return: buffered bytes that are not part of a complete frame yet"""
+        return bytes(self.buf[self.start : self.end])
+
+    def __iter__(self):
+        frame = self.next_frame()
+        while frame is not None:
+            yield frame
+            frame = self.next_frame()
+
+    def payloads(self):
+        payload = self.next_payload()
+        while payload is not None:
+            yield payload
+            payload = self.next_payload()
+
+
+class PickleSerializer(Serializer):
+    """
+    Object codecs turn the objects sent over a queue into payloads (dumps/loads) and are picked per queue.
+    codec_id identifies the codec in the queue handshake, see SERIALIZERS.
+    """
+
+    codec_id = 0
+
+    @staticmethod
+    def dumps(obj):
+        return pickle.dumps(obj)
+
+    @staticmethod
+    def loads(data):
         return pickle.loads(data)  # nosec
 
+    @classmethod
+    def serialize(cls, obj):
+        return Serializer.serialize(cls.dumps(obj))
+
+    @classmethod
+    def deserialize(cls, data):
+        return cls.loads(Serializer.deserialize(data))
+
+
+class VerbosePickleSerializer(PickleSerializer):
+    codec_id = 1
 
-class VerbosePickleSerializer(Serializer):
     @staticmethod
-    def serialize(obj):
+    def dumps(obj):
         data = pickle.dumps(obj)
         data = {
             "data": hexlify(data).decode(),
             "len": len(data),
             "time": int(time.time()),
         }
-        return Serializer.serialize(json.dumps(data).encode())
+        return json.dumps(data).encode()
 
     @staticmethod
-    def deserialize(data):
-        data = json.loads(Serializer.deserialize(data).decode())
+    def loads(data):
+        data = json.loads(bytes(data))
         raw_data = unhexlify(data["data"].encode())
         assert len(raw_data) == data["len"]
         return pickle.loads(raw_data)  # nosec
+
+
+LENGTH = Struct("!I")
+# tag, event type, number of receivers (SINGLE_RECEIVER if `to` is a str), data codec, followed by the name lengths
+EVENT_HEADER = Struct("!BBBB")
+LOG_HEADER = Struct("!i")
+NODE_SIZE = 10  # 4 bytes ip, 6 bytes mac
+
+TAG_EVENT = 1
+
+DATA_PICKLE = 0
+DATA_LOG = 1
+DATA_NODECONFIG = 2
+
+SINGLE_RECEIVER = 255
+
+
+class EventSerializer(PickleSerializer):
+    """
+    Schema-aware binary codec for Events.
+
+    Events are packed field by field and their data with a codec that depends on the event type: LOG messages and the
+    nodes of NODECONFIG events are packed as structs, the data of other events is pickled. Objects that are not Events
+    or do not match these schemas exactly are pickled as a whole, pickles start with the PROTO opcode 0x80 so they are
+    told apart from packed Events by their first byte without an extra tag.
+    """
+
+    codec_id = 2
+
+    @staticmethod
+    def dumps(obj):
+        if type(obj) is Event:
+            payload = EventSerializer._dump_event(obj)
+            if payload is not None:
+                return payload
+        return pickle.dumps(obj, protocol=pickle.HIGHEST_PROTOCOL)
+
+    @staticmethod
+    def loads(data):
+        if data[0] == TAG_EVENT:
+            return EventSerializer._load_event(data)
+        return pickle.loads(data)  # nosec
+
+    @staticmethod
+    def _dump_event(event):
+        if type(event.type) is not int or not 0 <= event.type < 256 or type(event.sender) is not str:
+            return None
+        if type(event.to) is str:
+            names = [event.to.encode(), event.sender.encode()]
+            count = SINGLE_RECEIVER
+        elif type(event.to) is list and len(event.to) < SINGLE_RECEIVER and all(type(to) is str for to in event.to):
+            names = [to.encode() for to in event.to]
+            names.append(event.sender.encode())
+            count = len(event.to)
+        else:
+            return None
+        data = event.data
+        is_dict = type(data) is dict and len(data) == 2
+        if event.type == LOG and is_dict and type(data.get("level")) is int and type(data.get("message")) is str:
+            codec = DATA_LOG
+            body = LOG_HEADER.pack(data["level"]) + data["message"].encode()
+        elif event.type == NODECONFIG and is_dict and "conf" in data and type(data.get("nodes")) is list:
+            nodes = data["nodes"]
+            if not all(type(node) is ArpNode for node in nodes):
+                return None
+            codec = DATA_NODECONFIG
+            conf = pickle.dumps(data["conf"])
+            body = b"".join([LENGTH.pack(len(conf)), conf] + [bytes(node.ip) + bytes(node.mac) for node in nodes])
+        else:
+            codec = DATA_PICKLE
+            body = pickle.dumps(data)
+        header = pack("!BBBB%dH" % len(names), TAG_EVENT, event.type, count, codec, *map(len, names))
+        return b"".join([header, *names, body])
+
+    @staticmethod
+    def _load_event(data):
+        _, event_type, count, codec = EVENT_HEADER.unpack_from(data)
+        names = 1 if count == SINGLE_RECEIVER else count
+        offset = EVENT_HEADER.size + 2 * (names + 1)
+        receivers = []
+        for size in unpack_from("!%dH" % (names + 1), data, EVENT_HEADER.size):
+            receivers.append(str(data[offset : offset + size], "utf-8"))
+            offset += size
+        sender = receivers.pop()
+        if codec == DATA_LOG:
+            event_data = {"level": LOG_HEADER.unpack_from(data, offset)[0], "message": str(data[offset + LOG_HEADER.size :], "utf-8")}
+        elif codec == DATA_NODECONFIG:
+            size = LENGTH.unpack_from(data, offset)[0]
+            offset += LENGTH.size
+            conf = pickle.loads(data[offset : offset + size])  # nosec
+            offset += size
+            nodes = [
+                ArpNode(IP(bytes(data[i : i + 4])), MAC(bytes(data[i + 4 : i + NODE_SIZE]))) for i in range(offset, len(data), NODE_SIZE)
+            ]
+            event_data = {"conf": conf, "nodes": nodes}
+        else:
+            event_data = pickle.loads(data[offset:])  # nosec
+        return Event(receivers[0] if count == SINGLE_RECEIVER else receivers, sender, event_type, event_data)
+
+
+class RawBytesSerializer(PickleSerializer):
+    """
+    Passes bytes through unchanged, for queues that only carry raw packets.
+    loads returns the received payload without a copy, usually a memoryview of the receive buffer of the queue.
+    """
+
+    codec_id = 3
+
+    @staticmethod
+    def dumps(obj):
+        if type(obj) is bytes:
+            return obj
+        if isinstance(obj, (bytearray, memoryview)):
+            return bytes(obj)
+        raise TypeError("RawBytesSerializer can only send bytes, not {}".format(type(obj).__name__))
+
+    @staticmethod
+    def loads(data):
+        return data
+
+
+MSGPACK_EVENT = 1
+
+
+def _msgpack_default(obj):
+    if type(obj) is Event:
+        return msgpack.ExtType(MSGPACK_EVENT, msgpack.packb([obj.to, obj.sender, obj.type, obj.data], default=_msgpack_default))
+    raise TypeError("msgpack cannot serialize {}".format(type(obj).__name__))
+
+
+def _msgpack_ext_hook(code, data):
+    if code == MSGPACK_EVENT:
+        return Event(*msgpack.unpackb(data, ext_hook=_msgpack_ext_hook, strict_map_key=False))
+    return msgpack.ExtType(code, data)
+
+
+class MsgpackSerializer(PickleSerializer):
+    """
+    msgpack codec, requires the optional msgpack package.
+    It only supports msgpack types and Events, tuples arrive as lists.
+    """
+
+    codec_id = 4
+
+    @staticmethod
+    def dumps(obj):
+        if msgpack is None:
+            raise ImportError("MsgpackSerializer requires the msgpack package")
+        return msgpack.packb(obj, default=_msgpack_default)
+
+    @staticmethod
+    def loads(data):
+        if msgpack is None:
+            raise ImportError("MsgpackSerializer requires the msgpack package")
+        return msgpack.unpackb(data, ext_hook=_msgpack_ext_hook, strict_map_key=False)
+
+
+# codec id -> object codec, the client sends the codec id after the mode byte when it connects to a queue
+SERIALIZERS = {}
+
+
+def register_serializer(serializer):
+    """Make an object codec (a PickleSerializer subclass with an unused codec_id) known to the queues"""
+    assert 0 <= serializer.codec_id < 256
+    assert SERIALIZERS.get(serializer.codec_id, serializer) is serializer, "codec id {} is already used".format(serializer.codec_id)
+    SERIALIZERS[serializer.codec_id] = serializer
+    return serializer
+
+
+for _serializer in (PickleSerializer, VerbosePickleSerializer, EventSerializer, RawBytesSerializer, MsgpackSerializer):
+    register_serializer(_serializer)
@@ -0,0 +1,556 @@
+"""
+Shared memory transport for queues.
+
+A ShmQueue is one multiprocessing.shared_memory segment that is split into a fixed number of slots.
+Every slot is a single-producer single-consumer ring buffer; each sender claims a slot for as long as its context is
+open, so many senders and one receiver form an MPSC queue without any per-message locking and without a broker process.
+Messages are copied once into the ring by the sender and once out of it by the receiver.
+
+Wakeups work like a futex: a receiver that finds all rings empty sets the waiting flag in the segment header and
+sleeps on a unix datagram "doorbell" socket. Senders only ring the doorbell if that flag is set, so a busy receiver
+costs the senders no syscall at all.
+
+Memory ordering: Python has no atomics, so the counters and the waiting flag are accessed through the __atomic_*
+functions of libatomic (ctypes). A sender publishes its tail with a release store after the payload bytes, the receiver
+loads it with acquire before it reads them, and the head travels back the same way before the sender reuses the space.
+The waiting flag and the tails form a Dekker handshake (the receiver stores the flag and loads the tails, a sender
+stores its tail and loads the flag), so both sides use sequentially consistent stores and loads; otherwise a store
+could be reordered after the following load and a wakeup would be lost.
+libatomic falls back to process local locks for sizes without lock-free instructions, which do not work across
+processes. ShmQueues are only available if 4 and 8 byte atomics are lock-free (SUPPORTED), as on x86-64, AArch64 and
+ARMv7.
+"""
+import asyncio
+import collections
+import ctypes
+import ctypes.util
+import errno
+import fcntl
+import os
+import socket
+import time
+from contextlib import suppress
+from io import UnsupportedOperation
+from multiprocessing import resource_tracker, shared_memory
+from struct import Struct
+
+from watchdog.ipc.queue import BaseQueue, QueueClosed, batching_sender, collect_many, collect_many_sync
+from watchdog.ipc.serializers import PickleSerializer
+
+# segment header: waiting flag, number of slots, ring capacity, codec id of the queue's serializer
+HEADER = Struct("IIII")
+HEADER_SIZE = 64
+# slot header: head (consumer position), tail (producer position). Both are ever-increasing byte counters.
+COUNTER = Struct("Q")
+SLOT_HEADER_SIZE = 64
+LENGTH = Struct("I")
+
+# __atomic memory orders, see the module docstring
+ACQUIRE = 2
+RELEASE = 3
+SEQ_CST = 5
+
+
+def _load_atomics():
+    """:return: the load and store functions for 4 and 8 byte integers of libatomic or None if they are not lock-free"""
+    path = ctypes.util.find_library("atomic")
+    if path is None:
+        return None
+    try:
+        lib = ctypes.CDLL(path)
+    except OSError:
+        return None
+    is_lock_free = getattr(lib, "__atomic_is_lock_free")
+    is_lock_free.restype = ctypes.c_bool
+    is_lock_free.argtypes = [ctypes.c_size_t, ctypes.c_void_p]
+    if not (is_lock_free(4, None) and is_lock_free(8, None)):
+        return None
+    functions = []
+    for size, ctype in ((4, ctypes.c_uint32), (8, ctypes.c_uint64)):
+        load = getattr(lib, "__atomic_load_{}".format(size))
+        load.restype = ctype
+        load.argtypes = [ctypes.c_void_p, ctypes.c_int]
+        store = getattr(lib, "__atomic_store_{}".format(size))
+        store.restype = None
+        store.argtypes = [ctypes.c_void_p, ctype, ctypes.c_int]
+        functions += [load, store]
+    return functions
+
+
+_ATOMICS = _load_atomics()
+SUPPORTED = _ATOMICS is not None
+if SUPPORTED:
+    load32, store32, load64, store64 = _ATOMICS
+
+
+def address(buf):
+    """
+    :return: a ctypes object that exports buf and its address. The segment cannot be closed while the object lives.
+    """
+    base = ctypes.c_char.from_buffer(buf)
+    return base, ctypes.addressof(base)
+
+# how long a sleeping receiver waits before it polls the rings anyway
+WAKEUP_TIMEOUT = 0.05
+# backoff of a sender waiting for a full ring to drain
+MAX_BACKOFF = 0.01
+
+
+def _untracked_shared_memory(**kwargs):
+    """
+    Open a segment without leaving it to the resource tracker, which would unlink it as soon as the process that
+    attached to it exits. ShmQueue.close() is responsible for unlinking the segment.
+    """
+    try:
+        return shared_memory.SharedMemory(track=False, **kwargs)
+    except TypeError:  # python < 3.13
+        shm = shared_memory.SharedMemory(**kwargs)
+        resource_tracker.unregister(shm._name, "shared_memory")
+        return shm
+
+
+def attach_shared_memory(name):
+    return _untracked_shared_memory(name=name)
+
+
+def create_shared_memory(size):
+    return _untracked_shared_memory(create=True, size=size)
+
+
+def unlink_shared_memory(shm):
+    if not hasattr(shm, "_track"):  # python < 3.13, unlink() unregisters the segment again
+        resource_tracker.register(shm._name, "shared_memory")
+    shm.unlink()
+
+
+class Ring:
+    """View on one SPSC ring buffer inside the segment. Frames are a 32 bit length followed by the payload."""
+
+    def __init__(self, buf, offset, capacity):
+        self.buf = buf
+        self.base, base = address(buf)
+        self.head_address = base + offset
+        self.tail_address = base + offset + COUNTER.size
+        self.data_offset = offset + SLOT_HEADER_SIZE
+        self.capacity = capacity
+        # every counter has a single writer, which keeps its own copy. The sender refreshes its copy of the head only
+        # when the ring looks full, which saves the atomic loads on the fast path.
+        self.own_tail = None
+        self.seen_head = None
+        self.own_head = None
+
+    @property
+    def head(self):
+        return load64(self.head_address, ACQUIRE)
+
+    @property
+    def tail(self):
+        # sequentially consistent for the waiting flag handshake, see the module docstring
+        return load64(self.tail_address, SEQ_CST)
+
+    def _write(self, position, data):
+        start = position % self.capacity
+        first = min(len(data), self.capacity - start)
+        self.buf[self.data_offset + start : self.data_offset + start + first] = data[:first]
+        if first < len(data):
+            self.buf[self.data_offset : self.data_offset + len(data) - first] = data[first:]
+
+    def _read(self, position, size):
+        start = position % self.capacity
+        first = min(size, self.capacity - start)
+        data = bytes(self.buf[self.data_offset + start : self.data_offset + start + first])
+        if first < size:
+            data += bytes(self.buf[self.data_offset : self.data_offset + size - first])
+        return data
+
+    def push(self, payloads):
+        """
+        Append as many payloads as fit into the ring.
+
+        :return: number of payloads written
+        """
+        if self.own_tail is None:
+            self.own_tail, self.seen_head = self.tail, self.head
+        tail = self.own_tail
+        free = self.capacity - (tail - self.seen_head)
+        if payloads and LENGTH.size + len(payloads[0]) > free:
+            self.seen_head = self.head
+            free = self.capacity - (tail - self.seen_head)
+        written = 0
+        for payload in payloads:
+            size = LENGTH.size + len(payload)
+            if size > self.capacity:
+                raise ValueError("message of {} bytes exceeds the ring capacity of {} bytes".format(len(payload), self.capacity))
+            if size > free:
+                break
+            self._write(tail, LENGTH.pack(len(payload)))
+            self._write(tail + LENGTH.size, payload)
+            tail += size
+            free -= size
+            written += 1
+        if written:
+            # publish the frames only after they were written completely
+            store64(self.tail_address, tail, SEQ_CST)
+            self.own_tail = tail
+        return written
+
+    def pop_all(self):
+        if self.own_head is None:
+            self.own_head = self.head
+        head, tail = self.own_head, self.tail
+        payloads = []
+        while head < tail:
+            size = LENGTH.unpack(self._read(head, LENGTH.size))[0]
+            payloads.append(self._read(head + LENGTH.size, size))
+            head += LENGTH.size + size
+        if payloads:
+            # the payloads were copied out, the sender may overwrite them
+            store64(self.head_address, head, RELEASE)
+            self.own_head = head
+        return payloads
+
+
+class ShmQueueClient:
+    def __init__(self, bq, mode, serializer):
+        self.bq = bq
+        self.mode = mode
+        self.serializer = serializer
+        self.shm = None
+        self.buf = None
+        self.header = None
+        self.waiting_address = None
+        self.rings = []
+        self.lockfd = None
+        self.slot = None
+        self.bell = None
+        self.loop = None
+        self.frames = collections.deque()
+
+    def connect(self):
+        assert self.shm is None
+        self.shm = attach_shared_memory(self.bq.shm_name)
+        self.buf = self.shm.buf
+        self.header, self.waiting_address = address(self.buf)
+        _, slots, capacity, codec = HEADER.unpack_from(self.buf, 0)
+        self.rings = [Ring(self.buf, HEADER_SIZE + i * (SLOT_HEADER_SIZE + capacity), capacity) for i in range(slots)]
+        self.bell = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self.bell.setblocking(False)
+        if codec != self.serializer.codec_id:
+            self.disconnect()
+            raise QueueClosed("queue '{}' does not use {}".format(self.bq.name, self.serializer.__name__))
+        if self.mode == b"s":
+            self.slot = self._claim(range(slots))
+            if self.slot is None:
+                self.disconnect()
+                raise QueueClosed("all {} sender slots of queue '{}' are in use".format(slots, self.bq.name))
+        else:
+            # the receiver lock lives behind the sender slots
+            if self._claim([slots]) is None:
+                self.disconnect()
+                raise QueueClosed("queue '{}' already has a receiver".format(self.bq.name))
+            with suppress(FileNotFoundError):
+                os.unlink(self.bq.doorbell)
+            self.bell.bind(self.bq.doorbell)
+
+    def _claim(self, candidates):
+        """
+        Claim a slot by locking its lock file. flock() locks belong to the open file, so two contexts in one process
+        cannot claim the same slot and the kernel releases the lock if the process dies.
+        """
+        for slot in candidates:
+            fd = os.open(self.bq.lockfile + str(slot), os.O_RDWR | os.O_CREAT, 0o600)
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                os.close(fd)
+                continue
+            self.lockfd = fd
+            return slot
+        return None
+
+    def disconnect(self):
+        if self.shm is None:
+            return
+        if self.mode == b"r" and self.bell.getsockname():
+            with suppress(FileNotFoundError):
+                os.unlink(self.bq.doorbell)
+        self.bell.close()
+        if self.lockfd is not None:
+            os.close(self.lockfd)
+            self.lockfd = None
+        # drop the exports of the segment before it is closed
+        self.rings = []
+        self.header = None
+        self.waiting_address = None
+        self.buf = None
+        self.shm.close()
+        self.shm = None
+        self.loop = None
+
+    def _ring_doorbell(self):
+        if load32(self.waiting_address, SEQ_CST):
+            try:
+                self.bell.sendto(b"\x00", self.bq.doorbell)
+            except OSError as e:
+                # no receiver (yet) or the receiver already has wakeups pending
+                if e.errno not in (errno.ENOENT, errno.ECONNREFUSED, errno.EAGAIN):
+                    raise
+
+    def _receiver_alive(self):
+        """
+        The receiver holds the flock of the slot behind the sender slots, the kernel releases it if the receiver dies.
+        Only called while the ring is full, the probe briefly holds the lock itself.
+        """
+        fd = os.open(self.bq.lockfile + str(len(self.rings)), os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            return True
+        finally:
+            os.close(fd)
+        return False
+
+    def _full(self):
+        """The ring is full, :raise QueueClosed: if no receiver will drain it"""
+        if not self._receiver_alive():
+            raise QueueClosed("queue '{}' has no receiver".format(self.bq.name))
+
+    def _set_waiting(self, waiting):
+        store32(self.waiting_address, waiting, SEQ_CST)
+
+    def _push(self, payloads):
+        if self.shm is None:
+            raise QueueClosed("queue is not connected")
+        written = self.rings[self.slot].push(payloads)
+        if written:
+            self._ring_doorbell()
+        return written
+
+    def put_sync(self, obj):
+        self.put_many_sync([obj])
+
+    def put_many_sync(self, objs):
+        payloads = [self.serializer.dumps(obj) for obj in objs]
+        backoff = 0.0001
+        while payloads:
+            written = self._push(payloads)
+            if written:
+                payloads = payloads[written:]
+                backoff = 0.0001
+            else:
+                self._full()
+                time.sleep(backoff)
+                backoff = min(backoff * 2, MAX_BACKOFF)
+
+    async def put(self, obj):
+        await self.put_many([obj])
+
+    async def put_many(self, objs):
+        payloads = [self.serializer.dumps(obj) for obj in objs]
+        backoff = 0.0001
+        while payloads:
+            written = self._push(payloads)
+            if written:
+                payloads = payloads[written:]
+                backoff = 0.0001
+            else:
+                self._full()
+                await asyncio.sleep(backoff)
+                backoff = min(backoff * 2, MAX_BACKOFF)
+
+    def _poll(self):
+        if self.shm is None:
+            raise QueueClosed("queue is not connected")
+        for ring in self.rings:
+            for payload in ring.pop_all():
+                self.frames.append(self.serializer.loads(payload))
+        return bool(self.frames)
+
+    def _drain_doorbell(self):
+        with suppress(BlockingIOError):
+            while True:
+                self.bell.recv(64)
+
+    def _fill_sync(self, timeout=None):
+        """Poll the rings and sleep on the doorbell for at most timeout seconds if they are empty"""
+        if self._poll():
+            return
+        self._set_waiting(1)
+        if not self._poll():
+            self.bell.settimeout(WAKEUP_TIMEOUT if timeout is None else min(timeout, WAKEUP_TIMEOUT))
+            with suppress(socket.timeout):
+                self.bell.recv(64)
+            self.bell.setblocking(False)
+        self._set_waiting(0)
+        self._drain_doorbell()
+        self._poll()
+
+    async def _fill(self, timeout=None):
+        if self.loop is None:
+            self.loop = asyncio.get_event_loop()
+        if self._poll():
+            return
+        self._set_waiting(1)
+        if not self._poll():
+            with suppress(asyncio.TimeoutError):
+                wait = WAKEUP_TIMEOUT if timeout is None else min(timeout, WAKEUP_TIMEOUT)
+                await asyncio.wait_for(self.loop.sock_recv(self.bell, 64), wait)
+        self._set_waiting(0)
+        self._drain_doorbell()
+        self._poll()
+
+    def _pop(self):
+        return self.frames.popleft()
+
+    def get_sync(self):
+        while True:
+            while self.frames:
+                yield self.frames.popleft()
+            self._fill_sync()
+
+    async def get(self):
+        while True:
+            while self.frames:
+                yield self.frames.popleft()
+            await self._fill()
+
+    def get_many_sync(self, max_items, max_wait=0.0):
+        return collect_many_sync(self, max_items, max_wait)
+
+    async def get_many(self, max_items, max_wait=0.0):
+        return await collect_many(self, max_items, max_wait)
+
+
+class ShmQueueContext:
+    def __init__(self, bq, mode, serializer, generator, async_generator):
+        self._qc = ShmQueueClient(bq, mode, serializer)
+        self.generator = generator
+        self.async_generator = async_generator
+        self.batcher = None
+
+    def __enter__(self):
+        self._qc.connect()
+        return self.generator(self._qc)
+
+    async def __aenter__(self):
+        self._qc.connect()
+        return self.async_generator(self._qc)
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self._qc.disconnect()
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        if self.batcher is not None:
+            await self.batcher.flush()
+        self._qc.disconnect()
+
+
+class ShmQueueSender:
+    def __init__(self, bq: BaseQueue, serializer=None):
+        self.bq = bq
+        self.serializer = serializer or bq.serializer
+
+    def open(self, flush_delay=None, max_batch=64, key=None):  # noqa: A003
+        """Same API as QueueSender.open, key is ignored as shm queues have a single receiver"""
+
+        def do(qc):
+            if flush_delay is not None:
+                qc.disconnect()
+                raise UnsupportedOperation("Auto batching is not supported for sync queues")
+
+            def put(data, timeout=-1):
+                if timeout != -1:
+                    raise UnsupportedOperation("Timeout is not supported for sync queues")
+                return qc.put_sync(data)
+
+            put.put_many = qc.put_many_sync
+            return put
+
+        def doasync(qc):
+            async def put(data, timeout=-1):
+                if timeout != -1:
+                    return await asyncio.wait_for(qc.put(data), timeout)
+                return await qc.put(data)
+
+            return batching_sender(context, qc, put, flush_delay, max_batch)
+
+        context = ShmQueueContext(self.bq, b"s", self.serializer, do, doasync)
+        return context
+
+
+class ShmQueueReceiver:
+    def __init__(self, bq: BaseQueue, serializer=None):
+        self.bq = bq
+        self.serializer = serializer or bq.serializer
+
+    def open(self):  # noqa: A003
+        """Same API as QueueReceiver.open"""
+
+        def do(qc):
+            get_gen = qc.get_sync()
+
+            def get(timeout=-1):
+                if timeout != -1:
+                    raise UnsupportedOperation("Timeout is not supported for sync queues")
+                return next(get_gen)
+
+            get.get_many = qc.get_many_sync
+            return get
+
+        def doasync(qc):
+            get_gen = qc.get()
+
+            async def get(timeout=-1):
+                if timeout != -1:
+                    return await asyncio.wait_for(get_gen.__anext__(), timeout)
+                return await get_gen.__anext__()
+
+            get.get_many = qc.get_many
+            return get
+
+        return ShmQueueContext(self.bq, b"r", self.serializer, do, doasync)
+
+
+class ShmQueue:
+    """
+    Brokerless queue on top of shared memory with the same sender()/receiver() API as ZMQueue.
+    It supports up to `slots` concurrently open senders and a single receiver.
+    Kill ShmQueues by calling close(), which unlinks the segment.
+    """
+
+    def __init__(self, name, debug, slots=8, capacity=1 << 22, serializer=PickleSerializer):
+        if not SUPPORTED:
+            raise UnsupportedOperation("shared memory queues need lock-free 4 and 8 byte atomics from libatomic")
+        if capacity % COUNTER.size:
+            # keeps the counters of every slot aligned
+            raise ValueError("the ring capacity must be a multiple of {}".format(COUNTER.size))
+        self.debug = debug
+        self.bq = BaseQueue(name, serializer=serializer)
+        self.shm = create_shared_memory(HEADER_SIZE + slots * (SLOT_HEADER_SIZE + capacity))
+        HEADER.pack_into(self.shm.buf, 0, 0, slots, capacity, serializer.codec_id)
+        for i in range(slots):
+            offset = HEADER_SIZE + i * (SLOT_HEADER_SIZE + capacity)
+            COUNTER.pack_into(self.shm.buf, offset, 0)
+            COUNTER.pack_into(self.shm.buf, offset + COUNTER.size, 0)
+        self.bq.shm_name = self.shm.name
+        self.bq.lockfile = self.bq.uds + ".lock"
+        self.bq.doorbell = self.bq.uds + ".bell"
+        self.slots = slots
+
+    def receiver(self) -> ShmQueueReceiver:
+        return ShmQueueReceiver(self.bq)
+
+    def sender(self) -> ShmQueueSender:
+        return ShmQueueSender(self.bq)
+
+    def close(self):
+        if self.shm is None:
+            return
+        self.shm.close()
+        with suppress(FileNotFoundError):
+            unlink_shared_memory(self.shm)
+        self.shm = None
+        for path in [self.bq.lockfile + str(slot) for slot in range(self.slots + 1)] + [self.bq.doorbell]:
+            with suppress(FileNotFoundError):
+                os.unlink(path)
+        self.bq.close()
@@ -0,0 +1,107 @@
+"""
+Live table of the queues on this machine.
+Run with `python3 arpjet.py script watchdog.ipc.stats`, add `--once` to print the table a single time.
+
+Every broker (QueueServer) and every direct queue with a running receiver answers the stats request sent by
+watchdog.ipc.queue.query_stats on its unix socket. Rates are computed from the difference of two samples.
+"""
+import glob
+import os
+import stat
+import sys
+import time
+
+from watchdog.ipc.queue import query_stats
+
+QUEUE_SOCKETS = "/tmp/arpjetqueue_*"  # nosec
+
+
+def find_queues():
+    """:return: paths of the unix sockets of all queues"""
+    queues = []
+    for path in glob.glob(QUEUE_SOCKETS):
+        # shm queues only own a doorbell socket, it does not answer stats requests
+        if path.endswith(".bell"):
+            continue
+        try:
+            if stat.S_ISSOCK(os.stat(path).st_mode):
+                queues.append(path)
+        except FileNotFoundError:
+            continue
+    return queues
+
+
+def collect(timeout=0.2):
+    """:return: dict of socket path -> stats, None for queues that did not answer"""
+    result = {}
+    for uds in find_queues():
+        try:
+            result[uds] = query_stats(uds, timeout)
+        except (OSError, ValueError):
+            result[uds] = None
+    return result
+
+
+def format_size(size):
+    for unit in ("B", "K", "M", "G"):
+        if size < 1024:
+            return "{:.0f}{}".format(size, unit)
+        size /= 1024
+    return "{:.0f}T".format(size)
+
+
+def format_table(current, previous, interval):
+    header = "{:<40} {:<6} {:>7} {:>9} {:>9} {:>8} {:>4} {:>4} {:>9} {:>9} {:>9} {:>7}".format(
+        "queue", "type", "queued", "in/s", "out/s", "dropped", "snd", "rcv", "avg wait", "max wait", "oldest", "frame"
+    )
+    lines = [header, "-" * len(header)]
+    answered = [(uds, stats) for uds, stats in current.items() if stats is not None]
+    for uds, stats in sorted(answered, key=lambda item: -item[1]["queued"]):
+        before = (previous or {}).get(uds) or {}
+        enqueued = stats["enqueued"]
+        forwarded = stats.get("forwarded", enqueued - stats["queued"])
+        in_rate = (enqueued - before.get("enqueued", enqueued)) / interval
+        out_rate = (forwarded - before.get("forwarded", forwarded)) / interval
+        if "wait_total" in stats and forwarded:
+            avg_wait = "{:.2f}ms".format(stats["wait_total"] / forwarded * 1000)
+            max_wait = "{:.2f}ms".format(stats["wait_max"] * 1000)
+            oldest = "{:.2f}ms".format(stats["oldest_wait"] * 1000)
+        else:
+            avg_wait = max_wait = oldest = "-"
+        frame = format_size(stats["bytes_in"] / enqueued) if enqueued else "-"
+        lines.append(
+            "{:<40} {:<6} {:>7} {:>9.0f} {:>9.0f} {:>8} {:>4} {:>4} {:>9} {:>9} {:>9} {:>7}".format(
+                (stats["name"] or os.path.basename(uds))[:40],
+                stats["type"],
+                stats["queued"],
+                in_rate,
+                out_rate,
+                stats.get("dropped", 0),
+                stats["senders"],
+                stats["receivers"],
+                avg_wait,
+                max_wait,
+                oldest,
+                frame,
+            )
+        )
+    silent = len(current) - len(answered)
+    if silent:
+        lines.append("{} queue(s) did not answer (direct queues without a reading receiver or stale sockets)".format(silent))
+    return "\n".join(lines)
+
+
+def script_main():
+    once = "--once" in sys.argv
+    interval = 1.0
+    previous = None
+    while True:
+        current = collect()
+        table = format_table(current, previous, interval)
+        if once:
+            print(table)  # noqa: T001
+            return
+        print("\x1b[2J\x1b[H" + time.strftime("%H:%M:%S"), "queues:", len(current))  # noqa: T001
+        print(table)  # noqa: T001
+        previous = current
+        time.sleep(interval)
@@ -1,13 +1,24 @@
 import asyncio
 import os
+import pickle  # nosec
 import signal
 import time
 from dataclasses import dataclass
+from io import UnsupportedOperation
 from multiprocessing import Barrier, Process, Value
 
 import pytest
 
-from watchdog.ipc.queue import QueueReceiver, ZMQueueManager
+from watchdog.ipc.event import LOG, Event
+from watchdog.ipc.queue import (
+    DirectQueue,
+    QueueClosed,
+    QueueReceiver,
+    ZMQueue,
+    ZMQueueManager,
+    query_stats,
+)
+from watchdog.ipc.serializers import EventSerializer, LengthPrefixedSerializer, PickleSerializer, RawBytesSerializer, Serializer
 
 
 @pytest.fixture
@@ -233,3 +244,365 @@ def test_multiple_sender_and_receivers(queues):
     time.sleep(0.2)
     with counter.get_lock():
         assert counter.value == SENDERS
+
+
+def test_length_prefixed_framing_events_arrive_sync():
+    manager = ZMQueueManager("pytest - length prefixed", framing=LengthPrefixedSerializer)
+    queue = manager.__enter__()
+    counter = Value("i", 0)
+
+    def multiprocess(recv_queue, ctr):
+        sucker = CountingEventSucker(recv_queue, ctr)
+        sucker.run()
+
+    proc = Process(target=multiprocess, args=(queue.receiver(), counter))
+    proc.start()
+    with queue.sender().open() as put:
+        for i in range(100):
+            put(i)
+    time.sleep(0.5)
+    try:
+        with counter.get_lock():
+            assert counter.value == 100
+    finally:
+        # TEARDOWM
+        if proc.is_alive():
+            os.kill(proc.pid, signal.SIGKILL)
+        manager.__exit__(0, 0, 0)
+
+
+def test_topology_hints_select_direct_queue():
+    with ZMQueueManager("pytest - direct hints", senders=1, receivers=1) as queue:
+        assert isinstance(queue, DirectQueue)
+    with ZMQueueManager("pytest - broker hints", senders=1, receivers=2) as queue:
+        assert isinstance(queue, ZMQueue)
+
+
+def test_direct_queue_events_arrive_in_order_sync():
+    manager = ZMQueueManager("pytest - direct", senders=1, receivers=1)
+    queue = manager.__enter__()
+    counter = Value("i", 0)
+
+    def multiprocess(recv_queue, ctr):
+        sucker = CountingEventSucker(recv_queue, ctr)
+        sucker.run()
+
+    receiver = queue.receiver()
+    with queue.sender().open() as put:
+        # the socket is bound by the queue, so sending works before the receiver process runs
+        put(0)
+        proc = Process(target=multiprocess, args=(receiver, counter))
+        proc.start()
+        for i in range(1, 1000):
+            put(i)
+    time.sleep(0.5)
+    try:
+        with counter.get_lock():
+            assert counter.value == 1000
+    finally:
+        # TEARDOWM
+        if proc.is_alive():
+            os.kill(proc.pid, signal.SIGKILL)
+        manager.__exit__(0, 0, 0)
+
+
+@pytest.mark.asyncio
+async def test_direct_queue_multiple_senders_async():
+    SENDERS = 3
+
+    def mp_sender(sender):
+        with sender.open() as put:
+            for i in range(100):
+                put(i)
+
+    with ZMQueueManager("pytest - direct async", senders=1, receivers=1) as queue:
+        senders = [Process(target=mp_sender, args=(queue.sender(),)) for _ in range(SENDERS)]
+        [s.start() for s in senders]
+        async with queue.receiver().open() as get:
+            received = [await asyncio.wait_for(get(), 2) for _ in range(SENDERS * 100)]
+        [s.join() for s in senders]
+    assert sorted(received) == sorted(list(range(100)) * SENDERS)
+
+
+def test_direct_queue_restarted_receiver_keeps_connections():
+    with ZMQueueManager("pytest - direct restart", senders=1, receivers=1) as queue:
+        receiver = queue.receiver()
+        with queue.sender().open() as put:
+            put("first")
+            put("second")
+            with receiver.open() as get:
+                assert get() == "first"
+            # a restarted module opens the same receiver again
+            with receiver.open() as get:
+                assert get() == "second"
+                put("third")
+                assert get() == "third"
+
+
+def test_direct_queue_sender_is_picklable():
+    with ZMQueueManager("pytest - direct pickle", senders=1, receivers=1) as queue:
+        sender = pickle.loads(pickle.dumps(queue.sender()))  # nosec
+        assert sender.bq.listener is None
+        assert queue.bq.listener is not None
+
+
+def test_direct_queue_pickled_receiver_fails():
+    with ZMQueueManager("pytest - direct pickled receiver", senders=1, receivers=1) as queue:
+        receiver = pickle.loads(pickle.dumps(queue.receiver()))  # nosec
+        with pytest.raises(UnsupportedOperation):
+            receiver.open()
+
+
+@pytest.mark.parametrize("hints", [{}, {"senders": 1, "receivers": 1}])
+def test_put_many_get_many_sync(hints):
+    with ZMQueueManager("pytest - batched", **hints) as queue:
+        receiver = queue.receiver()
+        with queue.sender().open() as put, receiver.open() as get:
+            put.put_many(list(range(10)))
+            put(10)
+            received = get.get_many(4, max_wait=0.5)
+            assert received == [0, 1, 2, 3]
+            while len(received) < 11:
+                received += get.get_many(100, max_wait=0.1)
+            assert received == list(range(11))
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("hints", [{}, {"senders": 1, "receivers": 1}])
+async def test_put_many_get_many_async(hints):
+    with ZMQueueManager("pytest - batched async", **hints) as queue:
+        receiver = queue.receiver()
+        async with queue.sender().open() as put, receiver.open() as get:
+            await put.put_many(list(range(10)))
+            received = await asyncio.wait_for(get.get_many(100, max_wait=0.2), 2)
+            assert received == list(range(10))
+            await put(10)
+            assert await asyncio.wait_for(get(), 2) == 10
+
+
+@pytest.mark.asyncio
+async def test_auto_batching_flushes_after_deadline():
+    with ZMQueueManager("pytest - auto batching") as queue:
+        async with queue.sender().open(flush_delay=0.05, max_batch=100) as put, queue.receiver().open() as get:
+            for i in range(5):
+                await put(i)
+            received = await asyncio.wait_for(get.get_many(5, max_wait=0.5), 2)
+            assert received == list(range(5))
+            for i in range(100):
+                await put(i)  # max_batch reached, sent without waiting for the deadline
+            received = await asyncio.wait_for(get.get_many(100, max_wait=0.5), 2)
+            assert received == list(range(100))
+            await put("last")
+            await put.flush()
+            assert await asyncio.wait_for(get(), 2) == "last"
+
+
+def test_auto_batching_is_async_only():
+    with ZMQueueManager("pytest - auto batching sync") as queue:
+        with pytest.raises(UnsupportedOperation):
+            with queue.sender().open(flush_delay=0.01):
+                pass
+
+
+@pytest.mark.parametrize("hints", [{}, {"senders": 1, "receivers": 1}])
+def test_event_serializer_queue(hints):
+    events = [Event("logger", "pytest", LOG, {"level": i, "message": str(i)}) for i in range(10)] + [("not", "an", "event")]
+    with ZMQueueManager("pytest - event codec", serializer=EventSerializer, **hints) as queue:
+        with queue.sender().open() as put, queue.receiver().open() as get:
+            put.put_many(events)
+            assert [get() for _ in events] == events
+
+
+def test_queue_rejects_other_codecs():
+    with ZMQueueManager("pytest - codec mismatch", serializer=EventSerializer) as queue:
+        with pytest.raises(QueueClosed):
+            with QueueReceiver(queue.bq, PickleSerializer).open() as get:
+                get()
+
+
+@pytest.mark.parametrize("hints", [{}, {"senders": 1, "receivers": 1}])
+@pytest.mark.parametrize("framing", [Serializer, LengthPrefixedSerializer])
+def test_raw_bytes_queue_receives_payload_views(hints, framing):
+    payloads = [os.urandom(40000), b"", b"\x13\x00" * 10, b"\x01" * 60000]
+    with ZMQueueManager("pytest - raw bytes", framing=framing, serializer=RawBytesSerializer, **hints) as queue:
+        with queue.sender().open() as put, queue.receiver().open() as get:
+            put.put_many(payloads)
+            received = [get() for _ in payloads]
+    assert [bytes(payload) for payload in received] == payloads
+    assert type(received[-1]) is memoryview  # payloads without escapes are not copied
+
+
+@pytest.mark.parametrize(
+    "overflow,expected",
+    # sample: frames 0-9 fill the queue, every 10th of the overflowing frames replaces the oldest one
+    [("drop_oldest", list(range(90, 100))), ("drop_newest", list(range(10))), ("sample", [9] + list(range(19, 100, 10)))],
+)
+def test_bounded_queue_drops_frames(overflow, expected):
+    with ZMQueueManager("pytest - bounded", max_queued=10, overflow=overflow) as queue:
+        with queue.sender().open() as put:
+            put.put_many(list(range(100)))
+            time.sleep(0.3)  # no receiver is connected, the queue server has to buffer
+            with queue.receiver().open() as get:
+                received = get.get_many(100, max_wait=0.3)
+                put("after the overflow")
+                while received[-1] != "after the overflow":
+                    received += get.get_many(100, max_wait=0.1)
+    assert received[:-1] == expected
+
+
+def test_bounded_queue_blocks_senders():
+    MESSAGES = 200
+
+    def mp_sender(sender, sent):
+        with sender.open() as put:
+            for i in range(MESSAGES):
+                put((i, b"x" * 65536))
+                with sent.get_lock():
+                    sent.value += 1
+
+    with ZMQueueManager("pytest - blocking", max_queued=10) as queue:
+        sent = Value("i", 0)
+        proc = Process(target=mp_sender, args=(queue.sender(), sent))
+        proc.start()
+        try:
+            time.sleep(0.5)
+            with sent.get_lock():
+                assert sent.value < MESSAGES
+            with queue.receiver().open() as get:
+                assert [get()[0] for _ in range(MESSAGES)] == list(range(MESSAGES))
+            proc.join(2)
+            with sent.get_lock():
+                assert sent.value == MESSAGES
+        finally:
+            # TEARDOWM
+            if proc.is_alive():
+                os.kill(proc.pid, signal.SIGKILL)
+
+
+def test_unknown_overflow_policy():
+    with pytest.raises(ValueError):
+        ZMQueueManager("pytest - overflow", max_queued=1, overflow="explode").__enter__()
+
+
+def test_broker_stats():
+    with ZMQueueManager("pytest - stats", max_queued=5, overflow="drop_newest") as queue:
+        with queue.sender().open() as put:
+            put.put_many([b"x" * 100] * 10)
+            time.sleep(0.2)
+            stats = query_stats(queue.bq.uds)
+            assert stats["name"] == "pytest - stats"
+            assert (stats["queued"], stats["enqueued"], stats["dropped"]) == (5, 5, 5)
+            assert (stats["senders"], stats["receivers"]) == (1, 0)
+            assert stats["frame_sizes"] == {"128": 10}
+            with queue.receiver().open() as get:
+                assert len(get.get_many(10, max_wait=0.2)) == 5
+                stats = query_stats(queue.bq.uds)
+        assert (stats["queued"], stats["forwarded"], stats["receivers"]) == (0, 5, 1)
+        assert stats["bytes_out"] * 2 == stats["bytes_in"]
+        assert stats["wait_max"] >= 0.2 > stats["oldest_wait"]
+
+
+def test_direct_queue_stats():
+    with ZMQueueManager("pytest - direct stats", senders=1, receivers=1) as queue:
+        counter = Value("i", 0)
+
+        def multiprocess(recv_queue, ctr):
+            sucker = CountingEventSucker(recv_queue, ctr)
+            sucker.run()
+
+        proc = Process(target=multiprocess, args=(queue.receiver(), counter))
+        proc.start()
+        try:
+            with queue.sender().open() as put:
+                put.put_many(list(range(10)))
+                time.sleep(0.3)
+                stats = query_stats(queue.bq.uds)
+            assert (stats["name"], stats["type"], stats["enqueued"], stats["senders"]) == ("pytest - direct stats", "direct", 10, 1)
+        finally:
+            # TEARDOWM
+            if proc.is_alive():
+                os.kill(proc.pid, signal.SIGKILL)
+
+
+def wait_for_receivers(queue, count):
+    for _ in range(100):
+        if query_stats(queue.bq.uds)["receivers"] == count:
+            return
+        time.sleep(0.01)
+    raise TimeoutError("receivers did not connect")
+
+
+def test_round_robin_dispatch():
+    with ZMQueueManager("pytest - round robin", dispatch="round_robin") as queue:
+        with queue.receiver().open() as get1, queue.receiver().open() as get2, queue.receiver().open() as get3:
+            wait_for_receivers(queue, 3)
+            with queue.sender().open() as put:
+                put.put_many(list(range(30)))
+            received = [get.get_many(100, max_wait=0.2) for get in (get1, get2, get3)]
+    assert [len(objs) for objs in received] == [10, 10, 10]
+    assert all(objs == list(range(objs[0], 30, 3)) for objs in received)
+
+
+def test_sticky_dispatch_keeps_flows_together_and_in_order():
+    flows = [("10.0.0.%d" % i, 443, "tcp") for i in range(20)]
+    with ZMQueueManager("pytest - sticky", dispatch="sticky", serializer=EventSerializer) as queue:
+        with queue.receiver().open() as get1, queue.receiver().open() as get2, queue.receiver().open() as get3:
+            wait_for_receivers(queue, 3)
+            with queue.sender().open(key=lambda obj: obj[0]) as put:
+                for seq in range(10):
+                    put.put_many([(flow, seq) for flow in flows])
+            received = [get.get_many(1000, max_wait=0.2) for get in (get1, get2, get3)]
+    assert sorted(len(objs) for objs in received) != [0, 0, 200]
+    for objs in received:
+        for flow in {flow for flow, _ in objs}:
+            assert [seq for other, seq in objs if other == flow] == list(range(10))
+    assert sum(len(objs) for objs in received) == 200
+
+
+def test_sticky_dispatch_moves_keys_of_lost_receivers():
+    with ZMQueueManager("pytest - sticky failover", dispatch="sticky") as queue:
+        with queue.receiver().open() as get:
+            lost = queue.receiver().open()
+            lost.__enter__()
+            wait_for_receivers(queue, 2)
+            lost.__exit__(0, 0, 0)
+            wait_for_receivers(queue, 1)
+            with queue.sender().open(key=str) as put:
+                put.put_many(list(range(50)))
+            received = get.get_many(100, max_wait=0.3)
+            while len(received) < 50:
+                received += get.get_many(100, max_wait=0.3)
+    assert received == list(range(50))
+
+
+def test_least_outstanding_dispatch_avoids_stalled_receivers():
+    def multiprocess(recv_queue, ctr):
+        with recv_queue.open() as get:
+            while True:
+                get()
+                with ctr.get_lock():
+                    ctr.value += 1
+
+    with ZMQueueManager("pytest - least outstanding", dispatch="least_outstanding") as queue:
+        counter = Value("i", 0)
+        proc = Process(target=multiprocess, args=(queue.receiver(), counter))
+        proc.start()
+        try:
+            with queue.receiver().open():  # never reads
+                wait_for_receivers(queue, 2)
+                with queue.sender().open() as put:
+                    for _ in range(100):
+                        put(b"x" * 1000)
+                        time.sleep(0.002)
+                time.sleep(0.2)
+                with counter.get_lock():
+                    assert counter.value >= 95
+        finally:
+            # TEARDOWM
+            if proc.is_alive():
+                os.kill(proc.pid, signal.SIGKILL)
+
+
+def test_unknown_dispatch_policy():
+    with pytest.raises(ValueError):
+        ZMQueueManager("pytest - dispatch", dispatch="random").__enter__()
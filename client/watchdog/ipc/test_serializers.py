@@ -0,0 +1,182 @@
+import pytest
+
+from watchdog.ipc.event import ADDONFILTERS, LOG, NODECONFIG, Event
+from watchdog.ipc.serializers import (
+    SERIALIZERS,
+    EventSerializer,
+    FrameDecoder,
+    LengthPrefixedSerializer,
+    MsgpackSerializer,
+    PickleSerializer,
+    RawBytesSerializer,
+    Serializer,
+    register_serializer,
+)
+from watchdog.network.utils import IP, MAC, ArpNode
+
+tricky_payloads = [b"", b"\x00", b"\x13", b"\x13\x00", b"\x13\x13\x00", b"a\x13\x13\x13\x00b", bytes(range(256)) * 4]
+
+
+def legacy_serialize(data):
+    out = []
+    for char in data:
+        if char == 0x13:
+            out.append(0x13)
+        out.append(char)
+    return bytes(out + [0x13, 0])
+
+
+@pytest.mark.parametrize("payload", tricky_payloads)
+def test_escape_framing_is_wire_compatible(payload):
+    assert Serializer.serialize(payload) == legacy_serialize(payload)
+
+
+@pytest.mark.parametrize("framing", [Serializer, LengthPrefixedSerializer])
+@pytest.mark.parametrize("payload", tricky_payloads)
+def test_framing_roundtrip(framing, payload):
+    frame = framing.serialize(payload)
+    assert framing.deserialize(frame) == payload
+
+
+@pytest.mark.parametrize("framing", [Serializer, LengthPrefixedSerializer])
+def test_parse_splits_stream(framing):
+    stream = b"".join(framing.serialize(p) for p in tricky_payloads)
+    frames = []
+    while stream:
+        frame, stream = framing.parse(stream)
+        assert frame is not None
+        frames.append(framing.deserialize(frame))
+    assert frames == tricky_payloads
+
+
+@pytest.mark.parametrize("framing", [Serializer, LengthPrefixedSerializer])
+def test_parse_incomplete_frame(framing):
+    frame = framing.serialize(b"\x13\x13hello\x13")
+    for end in range(len(frame)):
+        assert framing.parse(frame[:end]) == (None, frame[:end])
+
+
+def test_pickle_serializer_keeps_escape_framing():
+    frame = PickleSerializer.serialize({"a": b"\x13\x00"})
+    assert frame.endswith(b"\x13\x00")
+    assert PickleSerializer.deserialize(frame) == {"a": b"\x13\x00"}
+
+
+@pytest.mark.parametrize("framing", [Serializer, LengthPrefixedSerializer])
+@pytest.mark.parametrize("chunk", [1, 2, 3, 7, 4096])
+def test_frame_decoder_reassembles_chunked_stream(framing, chunk):
+    stream = b"".join(framing.serialize(p) for p in tricky_payloads)
+    decoder = FrameDecoder(framing)
+    frames = []
+    for i in range(0, len(stream), chunk):
+        decoder.feed(stream[i : i + chunk])
+        frames += [framing.deserialize(frame) for frame in decoder]
+    assert frames == tricky_payloads
+    assert len(decoder) == 0
+
+
+def test_frame_decoder_reuses_consumed_space():
+    decoder = FrameDecoder(read_size=16)
+    frame = Serializer.serialize(b"x" * 10)
+    for _ in range(100):
+        decoder.feed(frame + frame[:5])
+        assert decoder.next_frame() == frame
+        decoder.feed(frame[5:])
+        assert decoder.next_frame() == frame
+        assert decoder.next_frame() is None
+    assert len(decoder.buf) < 4 * len(frame)
+
+
+@pytest.mark.parametrize("framing", [Serializer, LengthPrefixedSerializer])
+def test_frame_decoder_payload_views_stay_valid(framing):
+    decoder = FrameDecoder(framing, read_size=64)
+    payloads = []
+    for i in range(50):
+        decoder.feed(framing.serialize(bytes([i]) * 40))
+        payloads += list(decoder.payloads())
+    assert [bytes(payload) for payload in payloads] == [bytes([i]) * 40 for i in range(50)]
+    # only escaped payloads have to be copied
+    assert all(type(payload) is memoryview for i, payload in enumerate(payloads) if i != 0x13 or framing is LengthPrefixedSerializer)
+    payloads = None
+    decoder.feed(framing.serialize(b"\x13\x00"))
+    assert bytes(decoder.next_payload()) == b"\x13\x00"
+
+
+@pytest.mark.parametrize("framing", [Serializer, LengthPrefixedSerializer])
+def test_frame_decoder_recv_into(framing):
+    stream = b"".join(framing.serialize(p) for p in tricky_payloads) + framing.serialize(b"\x01" * 100000)
+    decoder = FrameDecoder(framing, read_size=1024)
+    payloads = []
+    offset = 0
+    while offset < len(stream):
+        with decoder.recv_buffer() as target:
+            size = min(len(target), 3000, len(stream) - offset)
+            target[:size] = stream[offset : offset + size]
+        offset += size
+        decoder.commit(size)
+        payloads += [bytes(payload) for payload in decoder.payloads()]
+    assert payloads == tricky_payloads + [b"\x01" * 100000]
+
+
+def test_frame_decoder_adapts_read_size():
+    decoder = FrameDecoder(read_size=16384)
+    with decoder.recv_buffer() as target:
+        decoder.commit(len(target), len(target))
+    assert decoder.read_size == 32768
+    decoder.commit(10000, 32768)
+    assert decoder.read_size == 32768
+    for _ in range(10):
+        decoder.commit(1, 32768)
+    assert decoder.read_size == decoder.min_read
+    with decoder.recv_buffer() as target:
+        assert len(target) >= decoder.min_read
+
+
+events = [
+    Event("logger", "interceptor", LOG, {"level": 20, "message": "h\u00e4llo \x13\x00"}),
+    Event(["spoofer", "deviceid"], "arp", NODECONFIG, {"conf": None, "nodes": [ArpNode(IP("192.168.1.1"), MAC("aa:bb:cc:dd:ee:ff"))]}),
+    Event(["spoofer"], "arp-listener", NODECONFIG, {"conf": {"any": "object"}, "nodes": []}),
+    Event("addons", "master", ADDONFILTERS, [{"listenerid": 1}]),
+    Event([], "master", None, None),
+    Event("logger", "x", LOG, {"level": "not an int", "message": "falls back to pickle"}),
+    {"packets": [(b"\x00\x01" * 100, 1.5), (b"", 2.0)], "interceptorid": "addon.interceptor", "listenerid": 7},
+    {"packets": [(bytearray(b"not bytes"), 1.5)], "interceptorid": "addon.interceptor", "listenerid": 7},
+    ("anything", "else", 1),
+]
+
+
+@pytest.mark.parametrize("obj", events)
+def test_event_serializer_roundtrip(obj):
+    assert EventSerializer.loads(EventSerializer.dumps(obj)) == obj
+    assert EventSerializer.deserialize(EventSerializer.serialize(obj)) == obj
+
+
+def test_event_serializer_packs_log_events_without_pickle():
+    data = EventSerializer.dumps(events[0])
+    assert b"logger" in data and b"interceptor" in data
+    assert len(data) < len(PickleSerializer.dumps(events[0])) / 2
+
+
+def test_raw_bytes_serializer():
+    assert RawBytesSerializer.loads(RawBytesSerializer.dumps(b"\x13\x00")) == b"\x13\x00"
+    assert RawBytesSerializer.dumps(bytearray(b"ab")) == b"ab"
+    with pytest.raises(TypeError):
+        RawBytesSerializer.dumps("str")
+
+
+def test_msgpack_serializer():
+    pytest.importorskip("msgpack")
+    event = Event(["a", "b"], "c", LOG, {"level": 1, "message": "m", "raw": b"\x00"})
+    assert MsgpackSerializer.loads(MsgpackSerializer.dumps(event)) == event
+    assert MsgpackSerializer.loads(MsgpackSerializer.dumps({1: (b"x", 1.5)})) == {1: [b"x", 1.5]}
+
+
+def test_serializer_registry():
+    assert SERIALIZERS[EventSerializer.codec_id] is EventSerializer
+    assert len({serializer.codec_id for serializer in SERIALIZERS.values()}) == len(SERIALIZERS)
+
+    class Clash(PickleSerializer):
+        codec_id = EventSerializer.codec_id
+
+    with pytest.raises(AssertionError):
+        register_serializer(Clash)
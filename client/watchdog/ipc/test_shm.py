@@ -0,0 +1,181 @@
+import asyncio
+import os
+import signal
+import time
+from multiprocessing import Process, Value
+
+import pytest
+
+from watchdog.ipc.queue import QueueClosed, ZMQueueManager
+from watchdog.ipc.serializers import EventSerializer, PickleSerializer
+from watchdog.ipc.shm import SUPPORTED, Ring, ShmQueue, ShmQueueSender
+
+pytestmark = pytest.mark.skipif(not SUPPORTED, reason="shared memory queues need lock-free atomics")
+
+
+@pytest.fixture
+def shm_queue():
+    manager = ZMQueueManager("pytest - shm", transport="shm")
+    queue = manager.__enter__()
+    yield queue
+    manager.__exit__(0, 0, 0)
+
+
+def count_increasing(recv_queue, counter):
+    with recv_queue.open() as get:
+        expected = 0
+        while True:
+            if get() != expected:
+                break
+            expected += 1
+            with counter.get_lock():
+                counter.value += 1
+
+
+def test_ring_wraps_around():
+    ring = Ring(bytearray(64 + 32), 0, 32)
+    for i in range(20):
+        payload = bytes([i]) * (i % 7 + 1)
+        assert ring.push([payload]) == 1
+        assert ring.pop_all() == [payload]
+
+
+def test_ring_full():
+    ring = Ring(bytearray(64 + 32), 0, 32)
+    assert ring.push([b"x" * 10, b"y" * 10, b"z" * 10]) == 2
+    assert ring.pop_all() == [b"x" * 10, b"y" * 10]
+    with pytest.raises(ValueError):
+        ring.push([b"x" * 40])
+
+
+def test_ring_views_of_sender_and_receiver():
+    buf = bytearray(64 + 32)
+    sender, receiver = Ring(buf, 0, 32), Ring(buf, 0, 32)
+    for i in range(20):
+        payload = bytes([i]) * (i % 7 + 1)
+        assert sender.push([payload]) == 1
+        # no room until the receiver pops the payload, the sender then reloads the head
+        assert sender.push([b"x" * 28]) == 0
+        assert receiver.pop_all() == [payload]
+    assert sender.push([b"x" * 28]) == 1
+    assert receiver.pop_all() == [b"x" * 28]
+
+
+def test_shm_events_arrive_in_order_sync(shm_queue):
+    counter = Value("i", 0)
+    proc = Process(target=count_increasing, args=(shm_queue.receiver(), counter))
+    proc.start()
+    with shm_queue.sender().open() as put:
+        for i in range(1000):
+            put(i)
+    time.sleep(0.5)
+    try:
+        with counter.get_lock():
+            assert counter.value == 1000
+    finally:
+        # TEARDOWM
+        if proc.is_alive():
+            os.kill(proc.pid, signal.SIGKILL)
+
+
+@pytest.mark.asyncio
+async def test_shm_events_arrive_async(shm_queue):
+    def multiprocess(recv_queue, ctr):
+        async def run():
+            async with recv_queue.open() as get:
+                while True:
+                    await get()
+                    with ctr.get_lock():
+                        ctr.value += 1
+
+        asyncio.new_event_loop().run_until_complete(run())
+
+    counter = Value("i", 0)
+    proc = Process(target=multiprocess, args=(shm_queue.receiver(), counter))
+    proc.start()
+    async with shm_queue.sender().open() as put:
+        await put("ASYNC HeyHeyHeyyyyyy")
+        await asyncio.sleep(0.2)  # let the receiver fall asleep so the doorbell is used
+        await put("ASYNC BITCONNNEEEEEEEEEEEEEEECT")
+    await asyncio.sleep(0.3)
+    try:
+        with counter.get_lock():
+            assert counter.value == 2
+    finally:
+        # TEARDOWM
+        if proc.is_alive():
+            os.kill(proc.pid, signal.SIGKILL)
+
+
+def test_shm_multiple_senders(shm_queue):
+    SENDERS = 4
+
+    def mp_sender(sender):
+        with sender.open() as put:
+            for i in range(100):
+                put(i)
+
+    senders = [Process(target=mp_sender, args=(shm_queue.sender(),)) for _ in range(SENDERS)]
+    [s.start() for s in senders]
+    [s.join() for s in senders]
+    with shm_queue.receiver().open() as get:
+        received = [get() for _ in range(SENDERS * 100)]
+    assert sorted(received) == sorted(list(range(100)) * SENDERS)
+
+
+def test_shm_single_receiver():
+    queue = ShmQueue("pytest - shm receivers", False, slots=1)
+    try:
+        with queue.receiver().open():
+            with pytest.raises(QueueClosed):
+                queue.receiver().open().__enter__()
+        with queue.sender().open():
+            with pytest.raises(QueueClosed):
+                queue.sender().open().__enter__()
+    finally:
+        queue.close()
+
+
+def test_shm_put_many_get_many(shm_queue):
+    with shm_queue.sender().open() as put, shm_queue.receiver().open() as get:
+        put.put_many(list(range(10)))
+        assert get.get_many(4) == [0, 1, 2, 3]
+        assert get.get_many(100, max_wait=0.1) == list(range(4, 10))
+
+
+def test_shm_rejects_other_codecs():
+    queue = ShmQueue("pytest - shm codec", False, serializer=EventSerializer)
+    try:
+        with queue.sender().open() as put, queue.receiver().open() as get:
+            put(("tuple", 1))
+            assert get() == ("tuple", 1)
+        with pytest.raises(QueueClosed):
+            ShmQueueSender(queue.bq, PickleSerializer).open().__enter__()
+    finally:
+        queue.close()
+
+
+@pytest.mark.parametrize("receiver_was_open", [True, False])
+def test_shm_full_ring_without_receiver_closes(receiver_was_open):
+    queue = ShmQueue("pytest - shm dead receiver", False, slots=1, capacity=1024)
+    try:
+        if receiver_was_open:
+            with queue.receiver().open():
+                pass
+        with queue.sender().open() as put:
+            with pytest.raises(QueueClosed):
+                put.put_many([b"x" * 100] * 20)
+    finally:
+        queue.close()
+
+
+@pytest.mark.asyncio
+async def test_shm_full_ring_without_receiver_closes_async():
+    queue = ShmQueue("pytest - shm dead receiver async", False, slots=1, capacity=1024)
+    try:
+        async with queue.sender().open() as put:
+            with pytest.raises(QueueClosed):
+                for _ in range(20):
+                    await put(b"x" * 100)
+    finally:
+        queue.close()
@@ -0,0 +1,19 @@
+import time
+
+from watchdog.ipc.queue import ZMQueueManager
+from watchdog.ipc.stats import collect, find_queues, format_table
+
+
+def test_stats_table_lists_queues():
+    with ZMQueueManager("pytest - stats table") as queue:
+        with queue.sender().open() as put:
+            put.put_many(list(range(3)))
+            time.sleep(0.2)
+            assert queue.bq.uds in find_queues()
+            first = collect()
+            put.put_many(list(range(7)))
+            time.sleep(0.2)
+            second = collect()
+    assert second[queue.bq.uds]["queued"] == 10
+    row = [line for line in format_table(second, first, 1.0).splitlines() if line.startswith("pytest - stats table")][0]
+    assert row.split()[4:7] == ["broker", "10", "7"]
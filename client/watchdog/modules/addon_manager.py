@@ -9,11 +9,14 @@ import traceback
 
 from bitahoy_sdk.backend import BackendWS
 from bitahoy_sdk.filter import TrafficFilter
+from bitahoy_sdk.filter.ast import ASTNode
+from bitahoy_sdk.filter.bpf_building.bpf_compiler import compile_bpf, foreign_traffic
 from bitahoy_sdk.stubs.addon import RegisteredFilter
 
 import watchdog.core.processes
 from watchdog.core.addon import AddonReference, cleanup
 from watchdog.core.cloud import AuthBackend
+from watchdog.core.config import Config
 from watchdog.core.modules import Module
 from watchdog.ipc.event import (
     ADDONCONFIG,
@@ -27,15 +30,14 @@ from watchdog.ipc.event import (
     EventListener,
 )
 from watchdog.ipc.queue import ZMQueueManager
+from watchdog.ipc.serializers import EventSerializer
+from watchdog.ipc.shm import SUPPORTED as SHM_SUPPORTED
 from watchdog.modules.deviceid import Devices
-from watchdog.network.bpf import attach_custom_tcpdump_filter
-from watchdog.network.checksums import fix_tcp_checksum, fix_udp_checksum
-from watchdog.network.correct import (
-    correct_ethernet_header_receive,
-    correct_ethernet_header_send,
-)
-from watchdog.network.packet import FailedLookup, fragment
-from watchdog.network.utils import IP, MAC
+from watchdog.network.batchio import BatchSocket
+from watchdog.network.bpf import attach_custom_bpf
+from watchdog.network.correct import RewriteTable
+from watchdog.network.packet import FailedLookup, PacketBuffer
+from watchdog.network.packetring import RxRing
 
 
 class AddonFilterManager:
@@ -121,30 +123,29 @@ class AddonFilterManager:
                     rf.socket.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 2 ** 30)
                     rf.socket.setblocking(False)
 
-                    tcpdump_filter = (
-                        f"(not(ether src {str(MAC(self.__sender_conf.box.mac))} || host {str(IP(self.__sender_conf.box.ip))} || net 224.0.0.0/4 || dst 255.255.255.255 || dst 0.0.0.0 || dst 127.0.0.1)) and "
-                        + trafficfilter.get_ast().to_tcpdump_expr()
-                    )
-                    await self.logger.info("attaching socket ", tcpdump_filter)
-                    await attach_custom_tcpdump_filter(rf.socket, tcpdump_filter)
+                    own_traffic = foreign_traffic(bytes(self.__sender_conf.box.ip), bytes(self.__sender_conf.box.mac))
+                    await self.logger.info("attaching socket ", trafficfilter.get_ast().to_tcpdump_expr())
+                    attach_custom_bpf(rf.socket, compile_bpf(ASTNode("AND", own_traffic, trafficfilter.optimize().get_ast())))
+                    # the rewritten frames are copies, so the frames of a PACKET_MMAP ring do not escape
+                    if Config().get("addons.capture", "socket") == "ring":
+                        receiver = RxRing(rf.socket)
+                    else:
+                        receiver = BatchSocket(rf.socket, snaplen=Config().get("addons.snaplen", None))
 
                     iface = self.__sender_iface
                     rf.socket.bind((iface, 0))
 
                     try:
                         while iface == self.__sender_iface:
-                            eth = await loop.sock_recv(rf.socket, 0xFFFF)
-                            try:
-                                eth = (
-                                    correct_ethernet_header_receive(
-                                        eth, self.__sender_conf.gateway.mac, self.__sender_macs, self.__sender_conf.network
-                                    ),
-                                    time.time(),
-                                )
-                                loop.create_task(on_packet(eth))
-                            except FailedLookup:
-                                pass
+                            for eth in await receiver.recv():
+                                try:
+                                    eth = (bytes(self.__sender_rewrite.receive(eth)), time.time())
+                                    loop.create_task(on_packet(eth))
+                                except FailedLookup:
+                                    pass
                     finally:
+                        if isinstance(receiver, RxRing):
+                            receiver.close()
                         rf.socket.close()
                         rf.socket = None
                 except Exception:
@@ -174,15 +175,17 @@ class AddonFilterManager:
         if not self.__sender_s:
             return errorset
         for sp in packets:
+            # one copy of the packet, the header rewrite, the checksums and the fragmentation modify it in place
+            buffer = PacketBuffer(sp)
             try:
-                sp = self.correct_target(sp)
+                self.correct_target(buffer.data)
             except FailedLookup:
                 errorset += sp
                 continue
-            sp = fix_udp_checksum(sp)
-            sp = fix_tcp_checksum(sp)
-            for packet in fragment(sp):
-                await self.__sender_loop.sock_sendall(self.__sender_s, packet)
+            buffer.fix_udp_checksum()
+            buffer.fix_tcp_checksum()
+            for packet in buffer.fragment():
+                await self.__sender_loop.sock_sendall(self.__sender_s, packet.data)
         return errorset
 
     async def addon__block_traffic(self, trafficfilter: TrafficFilter):
@@ -241,6 +244,7 @@ class AddonFilterManager:
         ownip = bytes(conf.box.ip)
         ownmac = conf.box.mac
         self.__sender_macs = {bytes(node.ip): node.mac for node in nodes}
+        self.__sender_rewrite = RewriteTable(conf.gateway.mac, conf.box.mac, self.__sender_macs, conf.network)
         if self.__sender_ownip != ownip or self.__sender_iface != conf.dev.name or self.__sender_ownmac != ownmac:
             self.__sender_reload = True
             self.__sender_ownip = ownip
@@ -249,9 +253,7 @@ class AddonFilterManager:
             self.__sender_conf = conf
 
     def correct_target(self, eth):
-        return correct_ethernet_header_send(
-            eth, self.__sender_conf.gateway.mac, self.__sender_conf.box.mac, self.__sender_macs, self.__sender_conf.network
-        )
+        return self.__sender_rewrite.send(eth)
 
     async def packet_sender(self):
         while True:
@@ -277,6 +279,7 @@ class AddonFilterManager:
         self.__sender_iface = None
         self.__sender_ownmac = None
         self.__sender_s = None
+        self.__sender_rewrite = None
         self.__sender_loop = asyncio.get_event_loop()
         self.event_listener = EventListener(self.events_queue.receiver(), self.logger.inherit("AddonEventListener").asyncio())
         self.event_listener.on_event[NODECONFIG] = self.on_nodeconfig_event
@@ -356,6 +359,11 @@ class AddonManagerModule(Module):
             ref = self.ref
 
             afm = AddonFilterManager(self.logger.inherit(interceptor.name + "(API)"))
+            packet_queue_transport = Config().get("addons.packet_queue_transport", "uds")
+            if packet_queue_transport == "shm" and not SHM_SUPPORTED:
+                # see watchdog.ipc.shm, the rings need lock-free atomics from libatomic
+                await self.logger.warn("shm packet queues need libatomic, using uds")
+                packet_queue_transport = "uds"
 
             def run(logger, afm: AddonFilterManager, events_out_queue):
                 with contextlib.redirect_stdout(logger.get_file()), contextlib.redirect_stderr(logger.get_file(logger.ERROR)):
@@ -367,9 +375,17 @@ class AddonManagerModule(Module):
                         for elem in interceptor.path.split(".")[1:]:
                             interceptor_clazz = getattr(interceptor_clazz, elem)
                         with ZMQueueManager(
-                            "addon_pckq({})".format(ref.hash[5:] + "." + interceptor.name[15:])
+                            "addon_pckq({})".format(ref.hash[5:] + "." + interceptor.name[15:]),
+                            transport=packet_queue_transport,
+                            serializer=EventSerializer,
+                            # unbounded and lossless by default, a limit keeps a stuck addon from filling the memory
+                            max_queued=Config().get("addons.packet_queue_limit", None),
+                            overflow=Config().get("addons.packet_queue_overflow", "block"),
                         ) as afm.packet_queue, ZMQueueManager(
-                            "addon_evq({})".format(ref.hash[5:] + "." + interceptor.name[15:])
+                            "addon_evq({})".format(ref.hash[5:] + "." + interceptor.name[15:]),
+                            senders=1,
+                            receivers=1,
+                            serializer=EventSerializer,
                         ) as afm.events_queue:
                             interceptor_instance = interceptor_clazz()
                             loop = asyncio.new_event_loop()
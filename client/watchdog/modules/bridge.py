@@ -17,6 +17,7 @@ from watchdog.ipc.event import (
     CLOUDLOGGING,
     DEVICEID_NEWDEVICE,
     NOTIFICATION,
+    PACKETSTATS,
     WHITELIST,
     Event,
     EventListener,
@@ -24,6 +25,10 @@ from watchdog.ipc.event import (
 from watchdog.network.utils import MAC
 
 
+# seconds between two submissions of the traffic statistic
+STATISTICS_INTERVAL = 3600
+
+
 class Bridge(Module):
     async def reload_deviceinfo(self, response=None):
         await self.async_logger.debug("reload device info")
@@ -147,6 +152,24 @@ class Bridge(Module):
     async def on_notification_event(self, event):
         await self.monitoring.uploadNotifications(event.data["data"])
 
+    async def on_packetstats_event(self, event):
+        """
+        Sum up the bytes of the counter snapshots of the interceptors and submit them as "traffic" statistic in KiB,
+        at most once per STATISTICS_INTERVAL as the monitoring backend accepts one update per hour.
+        Only the traffic that passes the interceptors is counted, flows forwarded by the kernel fast path are not.
+        """
+        if not self.config.get("bridge.upload_statistics", False):
+            return
+        # every frame is counted as up for its source and as down for its destination, so one direction is the total
+        self.traffic += sum(device["up_bytes"] for device in event.data["devices"])
+        if time.time() - self.statistics_submitted < STATISTICS_INTERVAL:
+            return
+        # the value column is a 32 bit int
+        resp = await self.monitoring.submitStatistics("traffic", min(self.traffic // 1024, 2 ** 31 - 1))
+        if resp and resp.get("success"):
+            self.traffic = 0
+        self.statistics_submitted = time.time()
+
     async def run(self):
         self.worker_cond = asyncio.Condition()
         self.worker_queue = []
@@ -157,10 +180,13 @@ class Bridge(Module):
         self.addon = AddonBackend(self.config.get("cloud.addon"), self.auth, self.logger.inherit("addon"))
         self.monitoring = MonitoringBackend(self.config.get("cloud.monitoring"), self.auth, self.logger.inherit("monitoring"))
         self.devicecontrol_info = {}
+        self.traffic = 0
+        self.statistics_submitted = time.time()
         self.event_listener = EventListener(self.events_in_queue, self.async_logger)
         self.event_listener.on_event[DEVICEID_NEWDEVICE] = self.on_deviceid_newdevice_event
         self.event_listener.on_event[CLOUDLOGGING] = self.on_cloudlogging_event
         self.event_listener.on_event[NOTIFICATION] = self.on_notification_event
+        self.event_listener.on_event[PACKETSTATS] = self.on_packetstats_event
         async with self.events_out_queue.open() as self.put_event:
             await asyncio.gather(
                 self.control.ws.authenticate(),
@@ -1,17 +1,25 @@
 import asyncio
 import socket
 
+from bitahoy_sdk.filter.ast import ASTNode
+from bitahoy_sdk.filter.bpf_building.bpf_compiler import compile_bpf, foreign_traffic
+from bitahoy_sdk.filter.bpf_building.cache import bytecode_cache
+from bitahoy_sdk.filter.matcher import FilterSet
+
 from watchdog.core.config import Config
 from watchdog.core.modules import Module
 from watchdog.hardware.setup import setup_interface
-from watchdog.ipc.event import ADDONFILTERS, NODECONFIG, EventListener
+from watchdog.ipc.event import ADDONFILTERS, NODECONFIG, PACKETSTATS, Event, EventListener
 from watchdog.ipc.queue import QueueClosed
-from watchdog.network.bpf import attach_custom_tcpdump_filter
-from watchdog.network.correct import (
-    correct_ethernet_header_receive,
-    correct_ethernet_header_send,
-)
-from watchdog.network.packet import FailedLookup, fragment
+from watchdog.network.batchio import BatchSocket
+from watchdog.network.bpf import attach_custom_bpf
+from watchdog.network.correct import RewriteTable
+from watchdog.network.counters import PacketCounters
+from watchdog.network.fanout import join_fanout
+from watchdog.network.fastpath import KernelFastPath
+from watchdog.network.flows import FlowCache, flow_key, header_only
+from watchdog.network.packet import FailedLookup, PacketBuffer
+from watchdog.network.packetring import RxRing, TxRing
 from watchdog.network.utils import IP, MAC
 
 
@@ -23,16 +31,13 @@ ENABLE_SANITY_CHECKS = True and False  # noqa: SIM223
 
 
 class InterceptorModule(Module):
-    def get_own_ip_tcpdump_filter(self):
+    def get_own_ip_filter(self):
         """
-        Create tcpdump filter for the own ip and id.
-        The filtering per id is based on the modulo of the checksum of the ip packet and enables load balancing.
-        :return: tcpdump filter
+        Create the filter for the traffic that is not from or to the own ip.
+        Load balancing between the interceptors is done by the PACKET_FANOUT group of the recv sockets, not by the filter.
+        :return: filter AST, it can only be compiled to BPF
         """
-        return (
-            f"(not(ether src {MAC(self.ownmac)} || net 10.199.0.0/16 || src {IP(self.ownip)} || dst {IP(self.ownip)} || dst 255.255.255.255 || net 224.0.0.0/4 || "
-            f"dst 0.0.0.0 || dst 127.0.0.1)) and (ip[10] & {self.queues['total_ids'] - 1} == {self.queues['id']})"
-        )
+        return foreign_traffic(self.ownip, bytes(self.ownmac), [(bytes(IP("10.199.0.0")), 16)])
 
     async def on_nodeconfig_event(self, event):
         nodes = event.data["nodes"]
@@ -40,7 +45,12 @@ class InterceptorModule(Module):
         ownip = bytes(conf.box.ip)
         ownmac = conf.box.mac
         self.macs = {bytes(node.ip): node.mac for node in nodes}
+        self.flow_cache = None
         self.ips = {bytes(node.mac): node.ip for node in nodes}
+        # the only place the header rewrites are computed, the packet path just looks them up
+        self.rewrite = RewriteTable(conf.gateway.mac, conf.box.mac, self.macs, conf.network)
+        if self.counters is not None:
+            self.counters.assign(self.macs)
         if self.ownip != ownip or self.iface != conf.dev.name or self.ownmac != ownmac:
             self.reload = True
             self.ownip = ownip
@@ -49,6 +59,7 @@ class InterceptorModule(Module):
             self.conf = conf
             async with self.config_condition:
                 self.config_condition.notify_all()
+        await self.update_fastpath()
 
     async def on_addonfilters_event(self, event):
         # Await nodeconfig before creating the filter as we need to know our own IP
@@ -58,25 +69,52 @@ class InterceptorModule(Module):
                     await self.config_condition.wait()
             self.filters = event.data["block_filters"] + event.data["active_filters"]
             self.listeners = event.data["passive_filters"]
+            # compiled again by match_filters when it is needed
+            self.filter_set = None
+            self.flow_cache = None
             if self.filters:
-                # Since we get a list of filters we create an tcpdump filter, compile it to bpf and apply it to the socket
+                # Since we get a list of filters we combine them, compile them to bpf and apply it to the socket
                 trafficfilter = self.filters[0]["trafficfilter"]
                 for listener in self.filters[1:]:
                     trafficfilter = trafficfilter.add_or_filter(listener["trafficfilter"])
-                trafficfilter = trafficfilter.negate()
-                # this is the translation of get_ownip to a tcpdump rule due to concatenation problems
-                # and missing bitwise and in the trafficFilter class
-                tcpdump_filter_update = self.get_own_ip_tcpdump_filter() + "and " + trafficfilter.get_ast().to_tcpdump_expr()
-                await attach_custom_tcpdump_filter(self.recv_socket, tcpdump_filter_update)
-                await self.async_logger.info("Applied tcpdump filter to recv socket: " + tcpdump_filter_update)
+                # the filters of the addons share most of their conditions, the optimizer checks them once
+                trafficfilter = trafficfilter.negate().optimize()
+                attach_custom_bpf(self.recv_socket, compile_bpf(ASTNode("AND", self.get_own_ip_filter(), trafficfilter.get_ast())))
+                await self.async_logger.info("Applied filter to recv socket: " + trafficfilter.get_ast().to_tcpdump_expr())
             else:
                 # Replace the existing filter with the default one
-                await attach_custom_tcpdump_filter(self.recv_socket, self.get_own_ip_tcpdump_filter())
-                await self.async_logger.info("Applied default tcpdump filter to recv socket")
+                attach_custom_bpf(self.recv_socket, compile_bpf(self.get_own_ip_filter()))
+                await self.async_logger.info("Applied default filter to recv socket")
 
         except Exception as e:
             await self.async_logger.error("Failed to apply addonfilters: {}".format(e))
             await self.async_logger.traceback()
+        await self.update_fastpath()
+
+    async def update_fastpath(self):
+        """
+        Forward the spoofed traffic that no addon filter matches in the kernel, see watchdog.network.fastpath.
+        Passive listeners count as well, their addons would not see the traffic that bypasses the interceptor.
+        If the rules can not be installed, the fast path is disabled and the interceptor forwards all traffic.
+        Both event handlers call this, the lock keeps their tc command sequences from interleaving.
+        """
+        async with self.fastpath_lock:
+            if self.fastpath is None or self.queues["id"] != 0 or self.rewrite is None or not self.ownip:
+                return
+            tree = self.get_own_ip_filter()
+            filters = self.filters + self.listeners
+            if filters:
+                trafficfilter = filters[0]["trafficfilter"]
+                for pfilter in filters[1:]:
+                    trafficfilter = trafficfilter.add_or_filter(pfilter["trafficfilter"])
+                tree = ASTNode("AND", tree, trafficfilter.negate().optimize().get_ast())
+            try:
+                code = compile_bpf(tree)
+                await self.fastpath.update(self.iface, code, self.ownmac, self.conf.gateway.mac, self.macs, self.conf.network)
+            except Exception as e:
+                await self.async_logger.warn("Disabled the kernel fast path: {}".format(e))
+                await self.fastpath.remove()
+                self.fastpath = None
 
     def correct_target_mac(self, eth):
         """
@@ -84,7 +122,7 @@ class InterceptorModule(Module):
         whereas the packet should look like a traffic capture between the 2 devices.
         Therefore we rewrite the addresses in the Ethernet header to mimic this behavior
         """
-        return correct_ethernet_header_receive(eth, self.conf.gateway.mac, self.macs, self.conf.network)
+        return self.rewrite.receive(eth)
 
     def correct_target_mac_send(self, eth):
         """
@@ -92,21 +130,63 @@ class InterceptorModule(Module):
         Since the packet was patched in correct_target_mac we need to restore it,
         so it looks like it was sent from us, because the spoofed device thinks we are the real communication partner
         """
-        return correct_ethernet_header_send(eth, self.conf.gateway.mac, self.conf.box.mac, self.macs, self.conf.network)
-
-    async def apply_filter(self, pfilter, packets):
-        packets_list = []
-        timestamps_list = []
-        for packet, packet_timestamp in packets:
-            packets_list.append(packet)
-            timestamps_list.append(packet_timestamp)
-        # get all matching
-        matching = []
-        for packet_tuple in packets:
-            packet, packet_timestamp = packet_tuple
-            if pfilter["trafficfilter"].evaluate(packet):
-                matching.append(packet_tuple)
-        if matching:
+        return self.rewrite.send(eth)
+
+    def match_filters(self, packets):
+        """
+        Match a batch of packets against all filters, packets of flows with a cached verdict are not matched again.
+        Blocked and active traffic is dropped by the kernel filter of the recv socket, so this only runs for the sanity checks.
+        The FilterSet and the flow cache are only built on the first call after the filters or the nodes changed, so
+        they take no memory while nothing matches in Python.
+        :return: dict index in self.filters -> indexes of the matching packets
+        """
+        if self.filter_set is None:
+            self.filter_set = FilterSet([(index, pfilter["trafficfilter"]) for index, pfilter in enumerate(self.filters)])
+            # the verdicts are cached per flow if no filter looks beyond the header fields of the flow key
+            self.flow_cacheable = all(header_only(pfilter["trafficfilter"]) for pfilter in self.filters)
+        if not self.flow_cacheable:
+            return self.filter_set.match_many(packets)
+        if self.flow_cache is None:
+            self.flow_cache = FlowCache(
+                self.config.get("interceptor.flow_cache.size", 65536), self.config.get("interceptor.flow_cache.ttl", 30)
+            )
+        matches = {}
+        missed, keys = [], []
+        for i, packet in enumerate(packets):
+            key = flow_key(packet)
+            verdict = None if key is None else self.flow_cache.get(key)
+            if verdict is None:
+                missed.append(i)
+                keys.append(key)
+                continue
+            for index in verdict:
+                matches.setdefault(index, []).append(i)
+        if missed:
+            verdicts = {}
+            for index, indexes in self.filter_set.match_many([packets[i] for i in missed]).items():
+                for j in indexes:
+                    verdicts.setdefault(j, []).append(index)
+            for j, (i, key) in enumerate(zip(missed, keys)):
+                verdict = tuple(verdicts.get(j, ()))
+                if key is not None:
+                    self.flow_cache.put(key, verdict)
+                for index in verdict:
+                    matches.setdefault(index, []).append(i)
+        for indexes in matches.values():
+            indexes.sort()
+        return matches
+
+    async def apply_filters(self, packets):
+        """
+        Send the packets that match the filter of an addon to its queue.
+        All filters are matched together in one pass over the batch of (packet, timestamp) tuples.
+        Not called yet: the addons capture their traffic with their own sockets (see AddonFilterManager).
+        :return: the matching packets per index in self.filters
+        """
+        matches = {}
+        for index, indexes in self.match_filters([packet for packet, _ in packets]).items():
+            pfilter = self.filters[index]
+            matching = matches[index] = [packets[i] for i in indexes]
             if pfilter["interceptorid"] not in self.addon_queues:
                 queue = pfilter["queue"]
                 self.addon_queues[pfilter["interceptorid"]] = (queue, await queue.open().__aenter__())
@@ -116,8 +196,7 @@ class InterceptorModule(Module):
                 )
             except QueueClosed:
                 del self.addon_queues[pfilter["interceptorid"]]
-        return matching
-        # await self.logger.verbose("Packet matches filter ({}, }): {}".format(pfilter["interceptorid"], pfilter["listenerid"], repr(packet)))
+        return matches
 
     async def sanity_check(self, packet):
         """
@@ -127,8 +206,6 @@ class InterceptorModule(Module):
         src = packet[0x1A : 0x1A + 4]
         dst = packet[0x1A + 4 : 0x1A + 8]
         src_mac = packet[6:12]
-        # if (packet[25] % self.queues["total_ids"]) != self.queues["id"]:
-        #    await self.async_logger.error(f"Load balancing failed {packet[25] % self.queues['total_ids']} != {self.queues['id']}")
         if src == self.ownip or dst == self.ownip:
             await self.async_logger.error("BPF should only allow foreign packets :/ ip packed pased through")
             return
@@ -148,18 +225,18 @@ class InterceptorModule(Module):
 
         try:
             if ENABLE_SANITY_CHECKS:
-                for pfilter in self.filters:
-                    if pfilter["trafficfilter"].evaluate(packet):
-                        await self.async_logger.verbose(
-                            "blocked packet based on filter {}".format(pfilter["trafficfilter"].get_ast().to_tcpdump_expr())
-                        )
-                        try:
-                            from scapy.all import Ether
-
-                            await self.async_logger.verbose(f"{Ether(packet).show()}")
-                        except Exception:
-                            await self.async_logger.verbose("could not parse packet")
-                        return
+                for index in self.match_filters([packet]):
+                    pfilter = self.filters[index]
+                    await self.async_logger.verbose(
+                        "blocked packet based on filter {}".format(pfilter["trafficfilter"].get_ast().to_tcpdump_expr())
+                    )
+                    try:
+                        from scapy.all import Ether
+
+                        await self.async_logger.verbose(f"{Ether(packet).show()}")
+                    except Exception:
+                        await self.async_logger.verbose("could not parse packet")
+                    return
 
             if packet[6:12] == packet[0:6]:
                 await self.async_logger.warn(
@@ -168,26 +245,32 @@ class InterceptorModule(Module):
                     )
                 )
             if self.print_stats:
-                smac = "{} -> {}".format(MAC(packet[6:12]), MAC(packet[0:6]))
-                if smac in self.by_sender:
-                    self.by_sender[smac] += 1
-                else:
-                    self.by_sender[smac] = 1
-
                 self.pcount += 1
+            if self.counters is not None:
+                self.counters.count(packet)
             await self.send_packet(packet)
         except FailedLookup as _:
+            if self.counters is not None:
+                self.counters.failed_lookups += 1
+                self.counters.drops += 1
             await self.async_logger.warn("Failed lookup:", _)
 
     async def send_packet(self, packet):
+        """Rewrite the packet and queue its fragments, packet_listener sends them together with the rest of the batch"""
+        buffer = PacketBuffer(packet)
         try:
-            pckt = self.correct_target_mac_send(packet)
+            self.correct_target_mac_send(buffer.data)
         except FailedLookup:
+            if self.counters is not None:
+                self.counters.failed_lookups += 1
+                self.counters.drops += 1
             return
 
-        for sp in fragment(pckt):
-            if self.send_socket:
-                await self.loop.sock_sendall(self.send_socket, sp)
+        fragments = buffer.fragment()
+        if self.counters is not None and len(fragments) > 1:
+            self.counters.fragmented += 1
+            self.counters.fragments += len(fragments)
+        self.outgoing.extend(fragment.data for fragment in fragments)
 
     async def packet_listener(self):
         while True:
@@ -205,21 +288,40 @@ class InterceptorModule(Module):
             self.send_socket = socket.socket(socket.AF_PACKET, socket.SOCK_RAW, socket.htons(0x800))
 
             # as we only enter this loop rarely, we can overwrite the other filters
-            await self.async_logger.info("Attaching tcpdump filter to recvsocket: " + self.get_own_ip_tcpdump_filter())
-            await attach_custom_tcpdump_filter(self.recv_socket, self.get_own_ip_tcpdump_filter())
+            await self.async_logger.info("Attaching default filter to recvsocket")
+            attach_custom_bpf(self.recv_socket, compile_bpf(self.get_own_ip_filter()))
 
             self.recv_socket.setblocking(False)
             self.send_socket.setblocking(False)
 
+            # "socket" drains up to batch_size frames per wakeup and sends the rewritten frames with one syscall,
+            # "ring" exchanges the frames through PACKET_MMAP rings and hands out the received frames as memoryviews
+            if self.config.get("interceptor.capture", "socket") == "ring":
+                receiver = RxRing(self.recv_socket)
+                sender = TxRing(self.send_socket)
+            else:
+                batch_size = self.config.get("interceptor.batch_size", 64)
+                receiver = BatchSocket(self.recv_socket, batch_size, self.config.get("interceptor.snaplen", None))
+                sender = BatchSocket(self.send_socket, batch_size)
+
             self.recv_socket.bind((self.iface, 0))
             self.send_socket.bind((self.iface, 0))
+            if self.queues["total_ids"] > 1:
+                # the kernel hands every frame to exactly one interceptor of the group
+                join_fanout(self.recv_socket, self.queues["fanout_group"], self.config.get("interceptor.fanout", "hash"))
 
             self.reload = False
 
             while not self.reload:
-                packet = await self.loop.sock_recv(self.recv_socket, 0xFFFF)
-                await self.handle_incoming_packet(packet)
-
+                for packet in await receiver.recv():
+                    await self.handle_incoming_packet(packet)
+                if self.outgoing:
+                    outgoing, self.outgoing = self.outgoing, []
+                    await sender.send(outgoing)
+
+            if isinstance(receiver, RxRing):
+                receiver.close()
+                sender.close()
             self.recv_socket.close()
             self.send_socket.close()
 
@@ -235,7 +337,31 @@ class InterceptorModule(Module):
                     % (avg(history[-1:]), avg(history[-6:]), avg(history[-12:]), avg(history))
                 )
                 await self.async_logger.info(history)
-                await self.async_logger.info(self.by_sender)
+                if self.counters is not None:
+                    await self.async_logger.info(self.counters.snapshot())
+                # the cache only exists while match_filters is used, i.e. with the sanity checks
+                if self.flow_cache is not None:
+                    flows = self.flow_cache.stats()
+                    await self.async_logger.info(
+                        "Flow cache: %d flows, hit rate %.1f%%, %d evictions, %.1f KiB"
+                        % (flows["flows"], 100 * flows["hit_rate"], flows["evictions"], flows["memory"] / 1024)
+                    )
+                programs = bytecode_cache.stats()
+                await self.async_logger.info(
+                    "BPF cache: %d programs, %d hits, %d misses" % (programs["programs"], programs["hits"], programs["misses"])
+                )
+
+    async def publish_counters(self):
+        """Send the counters of every interval to the bridge, which uploads them to the monitoring backend"""
+        interval = self.config.get("interceptor.counters.interval", 60)
+        if self.counters is None or not interval:
+            return
+        async with self.events_out_queue.open() as put:
+            while True:
+                await asyncio.sleep(interval)
+                snapshot = self.counters.snapshot(reset=True)
+                snapshot["interceptor"] = self.queues["id"]
+                await put(Event(["bridge"], self.name, PACKETSTATS, snapshot))
 
     async def run(self):
         self.loop = asyncio.get_event_loop()
@@ -249,14 +375,30 @@ class InterceptorModule(Module):
         self.ownmac = None
         self.pcount = 0
         self.packets = []
+        self.outgoing = []
         self.filters = []
+        self.filter_set = None
+        self.flow_cacheable = True
+        self.flow_cache = None
         self.listeners = []
         self.exclusive_filters = []
-        self.by_sender = {}
+        self.rewrite = None
         self.addon_queues = {}
         self.config = Config()
         self.print_stats = self.config.get("interceptor.stats", False)
+        # the compiled filters on disk survive restarts of the interceptors
+        bytecode_cache.directory = self.config.get("interceptor.bpf_cache", bytecode_cache.directory)
+        self.counters = None
+        if self.config.get("interceptor.counters.enabled", True):
+            self.counters = PacketCounters(self.config.get("interceptor.counters.devices", 256))
+        # opt-in, the rules are shared by all interceptors and managed by the first one
+        self.fastpath = KernelFastPath() if self.config.get("interceptor.kernel_fastpath", False) else None
+        self.fastpath_lock = asyncio.Lock()
         self.event_listener = EventListener(self.events_in_queue, self.async_logger)
         self.event_listener.on_event[NODECONFIG] = self.on_nodeconfig_event
         self.event_listener.on_event[ADDONFILTERS] = self.on_addonfilters_event
-        await asyncio.gather(self.event_listener.listen(), self.packet_listener(), self.stats())
+        await asyncio.gather(self.event_listener.listen(), self.packet_listener(), self.stats(), self.publish_counters())
+
+    async def on_terminate(self):
+        if getattr(self, "fastpath", None) is not None:
+            await self.fastpath.remove()
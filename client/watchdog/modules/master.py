@@ -29,6 +29,7 @@ from watchdog.ipc.queue import (
     ZMQueue,
     ZMQueueManager,
 )
+from watchdog.ipc.serializers import EventSerializer
 
 
 class Worker:
@@ -52,7 +53,7 @@ class Worker:
         async def do(self):
             self.module = module
             self.name = name
-            self.queue_manager = ZMQueueManager("worker_queue (%s)" % (name,))
+            self.queue_manager = ZMQueueManager("worker_queue (%s)" % (name,), senders=1, receivers=1, serializer=EventSerializer)
             self.queue = self.queue_manager.__enter__()
             self._sender = self.queue.sender().open()
             self.send = await self._sender.__aenter__()
@@ -146,13 +147,17 @@ class Master:
         self.packet_out_queue: ZMQueue = None
         self.packets_out_queues = []
         self.WORKERS = multiprocessing.cpu_count()
-        self.RECEIVERS = 4
-        assert self.RECEIVERS in [2 ** i for i in range(1, 8)]
+        self.config = Config()
+        # number of interceptors, "auto" starts one per cpu
+        receivers = self.config.get("master.receivers", 4)
+        self.RECEIVERS = self.WORKERS if receivers == "auto" else int(receivers)
+        assert self.RECEIVERS >= 1
+        # the interceptors share the traffic through a PACKET_FANOUT group, its id has to be unique on the host
+        self.FANOUT_GROUP = os.getpid() & 0xFFFF
         self.SENDERS_PER_WORKER = 2
         self.processors = []
         self.senders = []
         self.addons = {}
-        self.config = Config()
         self.packets_out_queues_managers: List[ZMQueueManager] = []
         self.receivers: List[Worker] = []
         self.logger_module: Worker = None
@@ -201,7 +206,7 @@ class Master:
         self.receivers = [
             await self.new_worker(
                 watchdog.modules.interceptor.InterceptorModule,
-                {"id": i, "total_ids": self.RECEIVERS},
+                {"id": i, "total_ids": self.RECEIVERS, "fanout_group": self.FANOUT_GROUP},
                 "interceptor_{}".format(i),
             )
             for i in range(self.RECEIVERS)
@@ -281,9 +286,11 @@ class Master:
                 )
 
     async def runasync(self):
-        with ZMQueueManager("master_queue") as self.master_queue, ZMQueueManager("packets_queue") as self.packets_queue, ZMQueueManager(
-            "logger_queue"
-        ) as self.logger_queue, ZMQueueManager("packet_out_queue") as self.packet_out_queue:
+        with ZMQueueManager("master_queue", serializer=EventSerializer) as self.master_queue, ZMQueueManager(
+            "packets_queue"
+        ) as self.packets_queue, ZMQueueManager("logger_queue", serializer=EventSerializer) as self.logger_queue, ZMQueueManager(
+            "packet_out_queue"
+        ) as self.packet_out_queue:
             self.logger = watchdog.core.logging.Logger(self.logger_queue.sender(), "modulemaster")
             await self.start_workers()
             try:
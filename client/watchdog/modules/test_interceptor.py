@@ -0,0 +1,37 @@
+from bitahoy_sdk.filter import TCP, UDP, Ethernet, IPv4, TrafficFilter
+
+from watchdog.core.config import Config
+from watchdog.modules.interceptor import InterceptorModule
+from watchdog.network.test_packet import udp_packet
+
+
+def interceptor(filters):
+    # only the state match_filters uses, the module is not started
+    module = InterceptorModule.__new__(InterceptorModule)
+    module.filters = [{"trafficfilter": f} for f in filters]
+    module.filter_set = None
+    module.flow_cache = None
+    module.config = Config()
+    return module
+
+
+def test_match_filters_serves_flows_from_the_cache():
+    dns = TrafficFilter(Ethernet.assert_ipv4 & IPv4.assert_udp & (UDP.dst_port == 53))
+    tcp = TrafficFilter(Ethernet.assert_ipv4 & IPv4.assert_tcp)
+    module = interceptor([dns, tcp, TrafficFilter()])
+    dns_packet = udp_packet(20)
+    other = dns_packet[:36] + b"\x12\x34" + dns_packet[38:]
+    packets = [other, dns_packet, dns_packet, b"short", other]
+    expected = {0: [1, 2], 2: [0, 1, 2, 3, 4]}
+    assert module.match_filters(packets) == expected
+    assert module.filter_set is not None
+    # the batch is looked up before its verdicts are cached, two flows and a packet without a flow key
+    assert module.flow_cache.hits == 0 and len(module.flow_cache) == 2
+    assert module.match_filters(packets) == expected
+    assert module.flow_cache.hits == 4
+
+
+def test_filters_beyond_the_header_are_not_cached():
+    module = interceptor([TrafficFilter(TCP.window_size == 1)])
+    module.match_filters([udp_packet(20)])
+    assert not module.flow_cacheable and module.flow_cache is None
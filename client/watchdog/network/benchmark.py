@@ -0,0 +1,346 @@
+"""
+Packets per second of the interceptor forwarding path (receive, rewrite the ethernet header, send).
+Unix datagram socket pairs stand in for the AF_PACKET sockets, so no interface and no root are needed.
+Run with `python3 arpjet.py script watchdog.network.benchmark`.
+"""
+import asyncio
+import socket
+import struct
+import time
+from functools import partial
+from multiprocessing import Process
+
+from bitahoy_sdk.filter import TCP, UDP, Ethernet, IPv4, TrafficFilter
+from bitahoy_sdk.filter.bpf_building.bpf_compiler import compile_bpf
+from bitahoy_sdk.filter.eval import Evaluator
+from bitahoy_sdk.filter.matcher import FilterSet
+
+from watchdog.network.batchio import BatchSocket
+from watchdog.network.checksums import (
+    fix_tcp_checksum,
+    fix_udp_checksum,
+    internet_checksum,
+    ocooc,
+    update_checksum,
+)
+from watchdog.network.correct import RewriteTable, correct_ethernet_header_send
+from watchdog.network.counters import PacketCounters
+from watchdog.network.packet import PacketBuffer, fragment
+from watchdog.network.utils import IP, MAC, Network
+
+NETWORK = Network("192.168.1.0/24")
+GATEWAY = MAC("aa:bb:cc:00:00:01")
+BOX = MAC("aa:bb:cc:00:00:02")
+MACS = {bytes(IP("192.168.1.%d" % i)): MAC(bytes([0x02, 0, 0, 0, 0, i])) for i in range(10, 60)}
+TABLE = RewriteTable(GATEWAY, BOX, MACS, NETWORK)
+
+
+def sample_frame(size, i):
+    """Ethernet + IPv4 frame from the internet to one of the spoofed devices"""
+    ip = b"\x45\x00" + (size - 14).to_bytes(2, "big") + b"\x00\x00\x40\x00\x40\x06\x00\x00" + bytes(IP("1.1.1.1"))
+    ip += bytes(IP("192.168.1.%d" % (10 + i % 50)))
+    return bytes(BOX) + bytes(GATEWAY) + b"\x08\x00" + ip + bytes(size - 34)
+
+
+def _produce(sock, frames, count):
+    async def produce():
+        sender = BatchSocket(sock, len(frames))
+        for _ in range(count // len(frames)):
+            await sender.send(frames)
+
+    sock.setblocking(False)
+    asyncio.run(produce())
+
+
+def _consume(sock, count):
+    async def consume():
+        receiver = BatchSocket(sock, 64)
+        received = 0
+        while received < count:
+            received += len(await receiver.recv())
+
+    sock.setblocking(False)
+    asyncio.run(consume())
+
+
+def rewrite(packet):
+    return correct_ethernet_header_send(packet, GATEWAY, BOX, MACS, NETWORK)
+
+
+async def forward_single(loop, rx, tx, count):
+    """One sock_recv and one sock_sendall per frame and the uncompiled rewrite like the interceptor did before batching"""
+    for _ in range(count):
+        packet = await loop.sock_recv(rx, 0xFFFF)
+        await loop.sock_sendall(tx, rewrite(packet))
+
+
+async def forward_batched(loop, rx, tx, count, mmsg):
+    receiver = BatchSocket(rx, 64, mmsg=mmsg)
+    sender = BatchSocket(tx, 64, mmsg=mmsg)
+    forwarded = 0
+    while forwarded < count:
+        packets = await receiver.recv()
+        await sender.send([TABLE.send(packet) for packet in packets])
+        forwarded += len(packets)
+
+
+def bench_forwarding(mode, size=100, count=200000):
+    """
+    :param mode: "single", "batched" (recvmmsg/sendmmsg) or "loop" (batched with recv/send loops)
+    :return: forwarded packets per second
+    """
+    rx_in, rx = socket.socketpair(socket.AF_UNIX, socket.SOCK_DGRAM)
+    tx, tx_out = socket.socketpair(socket.AF_UNIX, socket.SOCK_DGRAM)
+    for sock in (rx_in, tx_out):
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 1 << 22)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 1 << 22)
+    rx.setblocking(False)
+    tx.setblocking(False)
+    frames = [sample_frame(size, i) for i in range(50)]
+    producer = Process(target=_produce, args=(rx_in, frames, count))
+    consumer = Process(target=_consume, args=(tx_out, count))
+    loop = asyncio.new_event_loop()
+    try:
+        consumer.start()
+        producer.start()
+        start = time.perf_counter()
+        if mode == "single":
+            loop.run_until_complete(forward_single(loop, rx, tx, count))
+        else:
+            loop.run_until_complete(forward_batched(loop, rx, tx, count, mode == "batched"))
+        consumer.join()
+        return count / (time.perf_counter() - start)
+    finally:
+        loop.close()
+        producer.join()
+        for sock in (rx_in, rx, tx, tx_out):
+            sock.close()
+
+
+def bench_rewrite(size=100, count=200000):
+    """:return: rewrites per second of correct_ethernet_header_send and of the compiled RewriteTable"""
+    frames = [sample_frame(size, i) for i in range(50)] * (count // 50)
+    start = time.perf_counter()
+    for packet in frames:
+        rewrite(packet)
+    function = time.perf_counter() - start
+    start = time.perf_counter()
+    send = TABLE.send
+    for packet in frames:
+        send(packet)
+    table = time.perf_counter() - start
+    return len(frames) / function, len(frames) / table
+
+
+def addon_send_bytes(packet):
+    """The addon send path on bytes: every step slices and concatenates the frame"""
+    packet = fix_tcp_checksum(fix_udp_checksum(rewrite(packet)))
+    return fragment(packet)
+
+
+def addon_send_buffer(packet):
+    buffer = PacketBuffer(packet)
+    TABLE.send(buffer.data)
+    buffer.fix_udp_checksum()
+    buffer.fix_tcp_checksum()
+    return buffer.fragment()
+
+
+def bench_send_path(size, count=2000):
+    """:return: packets per second of the addon send path (rewrite, checksums, fragmentation) on bytes and on a PacketBuffer"""
+    frames = [sample_frame(size, i).replace(b"\x40\x06", b"\x40\x11", 1) for i in range(50)] * (count // 50)
+    results = []
+    for send in (addon_send_bytes, addon_send_buffer):
+        start = time.perf_counter()
+        for packet in frames:
+            send(packet)
+        results.append(len(frames) / (time.perf_counter() - start))
+    return results
+
+
+def bench_checksum(size, count=2000):
+    """
+    :return: checksums per second of ocooc and internet_checksum over size bytes and of update_checksum for a
+        rewritten IP address
+    """
+    data = sample_frame(size + 14, 0)[14:]
+    old, new = data[16:20], bytes(IP("192.168.1.99"))
+    results = []
+    for checksum in (ocooc, internet_checksum, lambda d: update_checksum(0x1234, old, new)):
+        start = time.perf_counter()
+        for _ in range(count):
+            checksum(data)
+        results.append(count / (time.perf_counter() - start))
+    return results
+
+
+def count_by_sender(by_sender, packet):
+    # the statistics of the interceptor before PacketCounters
+    smac = "{} -> {}".format(MAC(packet[6:12]), MAC(packet[0:6]))
+    if smac in by_sender:
+        by_sender[smac] += 1
+    else:
+        by_sender[smac] = 1
+
+
+def bench_counters(count=200000):
+    """:return: packets per second counted by sender strings and by PacketCounters"""
+    frames = [sample_frame(100, i) for i in range(256)]
+    counters = PacketCounters()
+    counters.assign(MACS)
+    results = []
+    for count_packet in (partial(count_by_sender, {}), counters.count):
+        start = time.perf_counter()
+        for i in range(count):
+            count_packet(frames[i & 0xFF])
+        results.append(count / (time.perf_counter() - start))
+    return results
+
+
+def addon_filters(count):
+    """Filters like the ones of count addons: DNS, a TCP service and traffic of one device each"""
+    filters = []
+    for i in range(count):
+        dns = Ethernet.assert_ipv4 & IPv4.assert_udp & ((UDP.dst_port == 53) | (UDP.src_port == 53))
+        service = Ethernet.assert_ipv4 & IPv4.assert_tcp & (TCP.dst_port == 8000 + i)
+        device = Ethernet.assert_ipv4 & (IPv4.destination == bytes(IP("192.168.1.%d" % (10 + i))))
+        filters.append(TrafficFilter([dns, service, device][i % 3]))
+    return filters
+
+
+def bench_filters(count, packets=2000):
+    """:return: packets per second matched against count filters with Evaluator and with a FilterSet"""
+    filters = addon_filters(count)
+    frames = [sample_frame(100, i) for i in range(50)] * (packets // 50)
+    start = time.perf_counter()
+    for packet in frames:
+        [f for f in filters if Evaluator(f).evaluate(packet)]
+    evaluate = time.perf_counter() - start
+    filter_set = FilterSet(list(enumerate(filters)))
+    start = time.perf_counter()
+    for i in range(0, len(frames), 64):
+        filter_set.match_many(frames[i : i + 64])
+    matched = time.perf_counter() - start
+    return len(frames) / evaluate, len(frames) / matched
+
+
+def bench_compile(packets=20000):
+    """
+    :return: packets per second matched against the DNS request and response filters of the adblocker, with a new
+        Evaluator per packet (TrafficFilter.evaluate before compile) and with the compiled filters
+    """
+    filters = [
+        TrafficFilter(Ethernet.assert_ipv4 & IPv4.assert_udp & (UDP.dst_port == 53)),
+        TrafficFilter(Ethernet.assert_ipv4 & IPv4.assert_udp & (UDP.src_port == 53)),
+    ]
+    frames = [sample_frame(100, i) for i in range(50)] * (packets // 50)
+    results = []
+    for matchers in ([lambda p, f=f: Evaluator(f).evaluate(p) for f in filters], [f.compile() for f in filters]):
+        start = time.perf_counter()
+        for packet in frames:
+            for match in matchers:
+                match(packet)
+        results.append(len(frames) / (time.perf_counter() - start))
+    return results
+
+
+def bench_optimizer(count, packets=20000):
+    """
+    :return: length of the tcpdump expression, BPF instructions and packets per second of the compiled filter for the
+        negated OR of count addon filters that the interceptor builds, without and with the optimizer
+    """
+    filters = addon_filters(count) + addon_filters(count)
+    combined = filters[0]
+    for f in filters[1:]:
+        combined = combined.add_or_filter(f)
+    frames = [sample_frame(100, i) for i in range(50)] * (packets // 50)
+    results = []
+    for f in (combined.negate(), combined.negate().optimize()):
+        match = f.compile()
+        start = time.perf_counter()
+        for packet in frames:
+            match(packet)
+        pps = len(frames) / (time.perf_counter() - start)
+        results.append((len(f.get_ast().to_tcpdump_expr()), len(compile_bpf(f.get_ast())) // 8, pps))
+    return results
+
+
+def longest_path(code):
+    """:return: instructions a classic BPF program executes at most, jumps only go forward"""
+    program = [struct.unpack_from("HBBI", code, offset) for offset in range(0, len(code), 8)]
+    steps = [0] * (len(program) + 1)
+    for pc in reversed(range(len(program))):
+        op, jt, jf, k = program[pc]
+        if op & 0x07 == 0x06:  # ret
+            steps[pc] = 1
+        elif op == 0x05:  # ja
+            steps[pc] = 1 + steps[pc + 1 + k]
+        elif op & 0x07 == 0x05:
+            steps[pc] = 1 + max(steps[pc + 1 + jt], steps[pc + 1 + jf])
+        else:
+            steps[pc] = 1 + steps[pc + 1]
+    return steps[0]
+
+
+def bench_sets(count, packets=20000):
+    """
+    :return: BPF instructions, the most of them a packet executes and packets per second of the compiled filter for
+        count destination ports, as OR chain of comparisons and as one IN
+    """
+    ports = [1024 + 7 * i for i in range(count)]
+    chain = TrafficFilter(UDP.dst_port == ports[0])
+    for port in ports[1:]:
+        chain = chain.add_or_filter(TrafficFilter(UDP.dst_port == port))
+    # the destination port of every seventh frame is in the set
+    frames = [sample_frame(100, i) for i in range(50)]
+    frames = [frame[:36] + (1024 + 3 * i).to_bytes(2, "big") + frame[38:] for i, frame in enumerate(frames)] * (packets // 50)
+    results = []
+    for f in (chain, TrafficFilter(UDP.dst_port.isin(ports))):
+        match = f.compile()
+        start = time.perf_counter()
+        for packet in frames:
+            match(packet)
+        pps = len(frames) / (time.perf_counter() - start)
+        code = compile_bpf(f.get_ast())
+        results.append((len(code) // 8, longest_path(code), pps))
+    return results
+
+
+def script_main():
+    print("destination port sets (bpf instructions, executed at most, packets per second)")  # noqa: T001
+    print("{:>8} {:>24} {:>24}".format("ports", "or chain", "in"))  # noqa: T001
+    for count in (8, 64, 512):
+        chain, members = bench_sets(count)
+        print("{:>8} {:>6} {:>5} {:>11.0f} {:>6} {:>5} {:>11.0f}".format(count, *chain, *members))  # noqa: T001
+    print("interceptor filter of the addon filters (expression length, bpf instructions, packets per second)")  # noqa: T001
+    print("{:>8} {:>24} {:>24}".format("filters", "plain", "optimized"))  # noqa: T001
+    for count in (4, 16):
+        plain, optimized = bench_optimizer(count)
+        print("{:>8} {:>6} {:>5} {:>11.0f} {:>6} {:>5} {:>11.0f}".format(2 * count, *plain, *optimized))  # noqa: T001
+    print("adblocker DNS filters (packets per second)")  # noqa: T001
+    print("{:>12} {:>12}".format("evaluator", "compiled"))  # noqa: T001
+    print("{:>12.0f} {:>12.0f}".format(*bench_compile()))  # noqa: T001
+    print("interceptor statistics (packets per second)")  # noqa: T001
+    print("{:>12} {:>12}".format("by sender", "counters"))  # noqa: T001
+    print("{:>12.0f} {:>12.0f}".format(*bench_counters()))  # noqa: T001
+    print("filter matching (packets per second)")  # noqa: T001
+    print("{:>8} {:>12} {:>12}".format("filters", "evaluator", "filter set"))  # noqa: T001
+    for count in (1, 4, 16):
+        print("{:>8} {:>12.0f} {:>12.0f}".format(count, *bench_filters(count)))  # noqa: T001
+    print("internet checksum (checksums per second)")  # noqa: T001
+    print("{:>8} {:>12} {:>12} {:>12}".format("size", "ocooc", "int", "incremental"))  # noqa: T001
+    for size in (20, 100, 1500):
+        print("{:>8} {:>12.0f} {:>12.0f} {:>12.0f}".format(size, *bench_checksum(size)))  # noqa: T001
+    print("addon send path, UDP (packets per second)")  # noqa: T001
+    print("{:>8} {:>12} {:>12}".format("size", "bytes", "buffer"))  # noqa: T001
+    for size in (100, 1500, 4000):
+        print("{:>8} {:>12.0f} {:>12.0f}".format(size, *bench_send_path(size)))  # noqa: T001
+    print("ethernet header rewrite (rewrites per second)")  # noqa: T001
+    print("{:>8} {:>12} {:>12}".format("size", "function", "table"))  # noqa: T001
+    for size in (100, 1500):
+        print("{:>8} {:>12.0f} {:>12.0f}".format(size, *bench_rewrite(size)))  # noqa: T001
+    print("forwarding path (packets per second)")  # noqa: T001
+    print("{:<10} {:>8} {:>12}".format("mode", "size", "pps"))  # noqa: T001
+    for size in (100, 1500):
+        for mode in ("single", "loop", "batched"):
+            print("{:<10} {:>8} {:>12.0f}".format(mode, size, bench_forwarding(mode, size)))  # noqa: T001
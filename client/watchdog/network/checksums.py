@@ -12,7 +12,7 @@ def fix_ip_checksum(packet: bytes) -> bytes:
     if len(packet) < 34:
         # invalid IP packet
         return packet
-    return packet[:24] + ocooc(packet[14:24] + packet[26:34]) + packet[26:]
+    return packet[:24] + internet_checksum(packet[14:24] + packet[26:34]) + packet[26:]
 
 
 def fix_ip_checksum_fast(packet: bytes) -> bytes:
@@ -40,18 +40,53 @@ def fix_udp_checksum_fast(packet: bytes) -> bytes:
 
 
 def ocooc(data: Union[bytes, List[int]]) -> bytes:
-    """Compute Internet checksum (RFC 1071)"""
+    """Compute Internet checksum (RFC 1071), byte by byte. Reference for internet_checksum."""
     checksum = 0
     odd = 1
 
     for char in list(data):
         checksum += char << (8 * odd)
         odd ^= 1
-    checksum = (checksum & 0xFFFF) + (checksum >> 16)
+    while checksum >> 16:
+        checksum = (checksum & 0xFFFF) + (checksum >> 16)
     checksum = ~checksum & 0xFFFF
     return bytes([(checksum >> 8), checksum & 0xFF])
 
 
+def ones_complement_sum(data) -> int:
+    """
+    16 bit one's complement sum of data, padded with a zero byte if its length is odd.
+    2 ** 16 = 1 (mod 0xFFFF), so the sum of the 16 bit words is congruent to the data read as one big integer and the
+    whole sum is a single int.from_bytes and modulo in C. The only representative that does not follow is the
+    negative zero 0xFFFF, the sum of data that is not all zeros.
+    """
+    if len(data) % 2:
+        data = bytes(data) + b"\x00"
+    number = int.from_bytes(data, "big")
+    if not number:
+        return 0
+    return number % 0xFFFF or 0xFFFF
+
+
+def internet_checksum(data) -> bytes:
+    """Compute Internet checksum (RFC 1071) of any buffer, same result as ocooc"""
+    return p16(~ones_complement_sum(data) & 0xFFFF)
+
+
+def update_checksum(checksum: int, old, new) -> int:
+    """
+    Incremental checksum update (RFC 1624, eqn. 3): HC' = ~(~HC + ~m + m')
+    :param checksum: checksum of the data before the update
+    :param old: replaced 16 bit aligned words
+    :param new: new words, same length as old
+    :return: checksum of the updated data
+    """
+    total = (~checksum & 0xFFFF) + (~ones_complement_sum(old) & 0xFFFF) + ones_complement_sum(new)
+    while total >> 16:
+        total = (total & 0xFFFF) + (total >> 16)
+    return ~total & 0xFFFF
+
+
 def fix_udp_checksum(packet: bytes) -> bytes:
     if len(packet) < 42 or packet[23] != 0x11:
         # invalid UDP packet
@@ -62,9 +97,9 @@ def fix_udp_checksum(packet: bytes) -> bytes:
         # invalid UDP packet
         return packet
     pseudo_ip_header = packet[26:30] + packet[30:34] + bytes([0, 0x11]) + packet[transport_layer_offset + 4 : transport_layer_offset + 6]
-    msg = list(packet[transport_layer_offset:])
-    msg[6:8] = [0, 0]
-    msg[6:8] = ocooc(list(pseudo_ip_header) + msg)
+    msg = bytearray(packet[transport_layer_offset:])
+    msg[6:8] = b"\x00\x00"
+    msg[6:8] = internet_checksum(pseudo_ip_header + msg)
     return packet[:transport_layer_offset] + bytes(msg)
 
 
@@ -78,7 +113,7 @@ def fix_tcp_checksum(packet):
         # invalid UDP packet
         return packet
     pseudo_ip_header = packet[26:30] + packet[30:34] + bytes([0, 6]) + p16(u16(packet[16:18]) - ip_hdr_size)
-    msg = list(packet[transport_layer_offset:])
-    msg[16:18] = [0, 0]
-    msg[16:18] = ocooc(list(pseudo_ip_header) + msg)
+    msg = bytearray(packet[transport_layer_offset:])
+    msg[16:18] = b"\x00\x00"
+    msg[16:18] = internet_checksum(pseudo_ip_header + msg)
     return packet[:transport_layer_offset] + bytes(msg)
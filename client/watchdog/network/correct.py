@@ -1,3 +1,4 @@
+import struct
 from typing import Dict
 
 from watchdog.network.packet import FailedLookup
@@ -9,9 +10,10 @@ def correct_ethernet_header_receive(eth, gateway_mac: bytes, macs: Dict[IP, MAC]
     Spoofed clients think the packet is supposed to be sent to us,
     whereas the packet should look like a traffic capture between the 2 devices.
     Therefore we rewrite the addresses in the Ethernet header to mimic this behavior
+    eth may be a memoryview of a captured frame, the addresses are looked up as bytes.
     """
-    dst = eth[30:34]
-    src = eth[26:30]
+    dst = bytes(eth[30:34])
+    src = bytes(eth[26:30])
     if dst in macs:
         dst_mac = macs[dst]
         if dst_mac is None:
@@ -38,9 +40,77 @@ def correct_ethernet_header_send(eth, gateway_mac: bytes, own_mac: bytes, macs:
     Since the packet was patched in correct_target_mac we need to restore it,
     so it looks like it was sent from us, because the spoofed device thinks we are the real communication partner
     """
-    dst = eth[30:34]
+    dst = bytes(eth[30:34])
     dst_mac = macs.get(dst, gateway_mac)
     if dst_mac == gateway_mac and IP(dst) in network:
         raise FailedLookup(str(IP(dst)))
     src_mac = own_mac
     return dst_mac + src_mac + eth[12:]
+
+
+# source and destination address of an EthernetII + IPv4 frame, as integers they are hashable for every buffer type
+_ADDRESSES = struct.Struct("!II")
+_DST = struct.Struct("!I")
+
+
+class RewriteTable:
+    """
+    The rewrites of correct_ethernet_header_receive and correct_ethernet_header_send compiled from one nodeconfig.
+    The table maps addresses straight to the MAC addresses, and to the ready 12 byte header for sending, so a rewrite
+    is one dict get and one slice assignment into the frame. Addresses that are not a node are resolved once and
+    cached: the gateway for addresses outside of the network, a FailedLookup for unknown hosts inside of it.
+    Build a new table whenever the nodeconfig changes.
+
+    A bytearray frame is rewritten in place, other frames (bytes, memoryviews of a ring) are copied into a new one.
+    """
+
+    # addresses that are not a node and are cached at most, the cache is dropped when it is full
+    max_cached = 1 << 16
+
+    def __init__(self, gateway_mac, own_mac, macs: Dict[bytes, MAC], network: Network):
+        self.gateway_mac = bytes(gateway_mac)
+        self.own_mac = bytes(own_mac)
+        # hosts of the network, Network.__contains__ excludes the network and the broadcast address
+        self.first = int(network.ip) + 1
+        self.last = int(network.ip) + 2 ** (32 - network.range) - 2
+        self.node_macs = {int(IP(ip)): self.gateway_mac if mac is None else bytes(mac) for ip, mac in macs.items()}
+        self._reset()
+
+    def _reset(self):
+        self.macs = dict(self.node_macs)
+        self.send_prefixes = {ip: mac + self.own_mac for ip, mac in self.macs.items()}
+        self.failed = set()
+
+    def _resolve(self, ip: int) -> bytes:
+        """MAC of an address that is not cached yet"""
+        if ip in self.failed:
+            raise FailedLookup(str(IP(ip)))
+        if len(self.macs) + len(self.failed) >= len(self.node_macs) + self.max_cached:
+            self._reset()
+        if self.first <= ip <= self.last:
+            self.failed.add(ip)
+            raise FailedLookup(str(IP(ip)))
+        self.macs[ip] = self.gateway_mac
+        self.send_prefixes[ip] = self.gateway_mac + self.own_mac
+        return self.gateway_mac
+
+    def receive(self, eth) -> bytearray:
+        """Rewrite the header of a captured frame like correct_ethernet_header_receive"""
+        frame = eth if type(eth) is bytearray else bytearray(eth)
+        src, dst = _ADDRESSES.unpack_from(frame, 26)
+        macs = self.macs
+        dst_mac = macs.get(dst) or self._resolve(dst)
+        src_mac = macs.get(src) or self._resolve(src)
+        frame[0:6] = dst_mac
+        frame[6:12] = src_mac
+        return frame
+
+    def send(self, eth) -> bytearray:
+        """Rewrite the header of a frame to send like correct_ethernet_header_send"""
+        frame = eth if type(eth) is bytearray else bytearray(eth)
+        dst = _DST.unpack_from(frame, 30)[0]
+        prefix = self.send_prefixes.get(dst)
+        if prefix is None:
+            prefix = self._resolve(dst) + self.own_mac
+        frame[0:12] = prefix
+        return frame
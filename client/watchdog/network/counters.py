@@ -0,0 +1,82 @@
+"""
+Packet counters of the interceptor, cheap enough to be always on.
+"""
+import time
+from array import array
+
+from watchdog.network.utils import IP
+
+# per device, "up" is traffic the device sends and "down" is traffic it receives
+DEVICE_COUNTERS = ("up_packets", "up_bytes", "down_packets", "down_bytes")
+# per interceptor
+COUNTERS = ("drops", "failed_lookups", "fragmented", "fragments")
+
+
+class PacketCounters:
+    """
+    Fixed-size counter arrays indexed by device slot.
+    Every node ip gets a slot when the node config arrives, slot 0 counts the traffic of other addresses (the internet)
+    and of the nodes that did not get a slot because all are taken. Counting a packet are two dict lookups and a few
+    array increments, nothing is allocated per packet.
+    """
+
+    def __init__(self, devices=256):
+        self.devices = devices
+        self.slots = {}  # ip bytes -> slot
+        self.nodes = [None] * (devices + 1)  # slot -> (ip, mac)
+        self.current = {}  # the nodes of the last node config
+        self.start = time.time()
+        self._reset_counters()
+
+    def _reset_counters(self):
+        for name in DEVICE_COUNTERS:
+            setattr(self, name, array("Q", bytes(8 * (self.devices + 1))))
+        for name in COUNTERS:
+            setattr(self, name, 0)
+
+    def assign(self, macs):
+        """Give the nodes of a node config (ip bytes -> MAC) a slot, the nodes that already have one keep it"""
+        self.current = macs
+        for ip, mac in macs.items():
+            slot = self.slots.get(ip)
+            if slot is None:
+                if len(self.slots) == self.devices:
+                    continue
+                slot = self.slots[ip] = len(self.slots) + 1
+            self.nodes[slot] = (ip, mac)
+
+    def count(self, packet):
+        """Count an IPv4 EthernetII frame"""
+        size = len(packet)
+        up = self.slots.get(packet[26:30], 0)
+        down = self.slots.get(packet[30:34], 0)
+        self.up_packets[up] += 1
+        self.up_bytes[up] += size
+        self.down_packets[down] += 1
+        self.down_bytes[down] += size
+
+    def snapshot(self, reset=False):
+        """
+        :param reset: start a new interval, the slots of nodes that left are freed
+        :return: json serializable counters of the interval, devices without traffic are left out
+        """
+        now = time.time()
+        devices = []
+        for slot, node in enumerate(self.nodes):
+            values = {name: getattr(self, name)[slot] for name in DEVICE_COUNTERS}
+            if not any(values.values()):
+                continue
+            if node is None:
+                values.update(ip=None, mac=None)
+            else:
+                values.update(ip=str(IP(node[0])), mac=None if node[1] is None else str(node[1]))
+            devices.append(values)
+        snapshot = {"start": self.start, "end": now, "devices": devices}
+        snapshot.update({name: getattr(self, name) for name in COUNTERS})
+        if reset:
+            self.slots = {}
+            self.nodes = [None] * (self.devices + 1)
+            self.assign(self.current)
+            self.start = now
+            self._reset_counters()
+        return snapshot
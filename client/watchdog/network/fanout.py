@@ -0,0 +1,40 @@
+"""
+PACKET_FANOUT groups: the kernel spreads the frames of an interface over all AF_PACKET sockets of a group, so several
+receivers share the traffic without one BPF program per receiver deciding which frames are its own.
+See https://www.kernel.org/doc/html/latest/networking/packet_mmap.html#af-packet-fanout-mode
+"""
+import struct
+
+from watchdog.network.packetring import SOL_PACKET
+
+# linux/if_packet.h
+PACKET_FANOUT = 18
+
+PACKET_FANOUT_HASH = 0
+PACKET_FANOUT_LB = 1
+PACKET_FANOUT_CPU = 2
+
+FANOUT_MODES = {
+    # flow hash over the addresses and ports. IPv4 fragments carry no ports, so the kernel hashes them on the addresses
+    # only: all fragments of a datagram reach the same receiver, but not necessarily the one that gets the unfragmented
+    # packets of the flow, so those can be reordered against the fragments. PACKET_FANOUT_FLAG_DEFRAG would keep them
+    # together, at the price of reassembling every fragmented datagram in the kernel and fragmenting it again in the
+    # interceptor.
+    "hash": PACKET_FANOUT_HASH,
+    # the receiver that belongs to the cpu which handles the interrupt, cache friendly with RSS/RPS
+    "cpu": PACKET_FANOUT_CPU,
+    "lb": PACKET_FANOUT_LB,
+}
+
+
+def join_fanout(sock, group: int, mode: str = "hash") -> None:
+    """
+    Add a bound AF_PACKET socket to a fanout group. All sockets of a group must use the same mode and be bound to the
+    same interface and protocol.
+
+    :param group: 16 bit id of the group, unique per host
+    :param mode: one of FANOUT_MODES
+    """
+    if mode not in FANOUT_MODES:
+        raise ValueError("unknown fanout mode {!r}, expected one of {}".format(mode, ", ".join(FANOUT_MODES)))
+    sock.setsockopt(SOL_PACKET, PACKET_FANOUT, struct.pack("HH", group & 0xFFFF, FANOUT_MODES[mode]))
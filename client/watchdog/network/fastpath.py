@@ -0,0 +1,99 @@
+"""
+Kernel forwarding fast path for the spoofed traffic that no addon filter matches.
+tc on the ingress of the interface runs the same classic BPF program as the interceptor's recv socket, extended by
+the filters of all addons. Matching frames get the ethernet header of the interceptor's rewrite (pedit) and are sent
+out of the interface again (mirred), so they never reach user space. The interceptor's ETH_P_IP socket only sees
+frames after tc ingress, all other traffic takes the interceptor path as before.
+Needs iproute2 and the cls_bpf, cls_flower, act_gact, act_pedit and act_mirred kernel modules.
+"""
+import asyncio
+import struct
+from typing import Dict, List
+
+from watchdog.network.utils import IP, MAC, Network
+
+TC = "tc"
+REWRITE_CHAIN = "1"
+
+
+class FastPathError(Exception):
+    pass
+
+
+def tc_bytecode(code: bytes) -> str:
+    """Classic BPF instructions (struct sock_filter) in the format of tc's bytecode option"""
+    instructions = [struct.unpack_from("HBBI", code, offset) for offset in range(0, len(code), 8)]
+    return ",".join([str(len(instructions))] + ["{} {} {} {}".format(*instruction) for instruction in instructions])
+
+
+def fastpath_commands(iface: str, code: bytes, own_mac, gateway_mac, macs: Dict[bytes, MAC], network: Network) -> List[List[str]]:
+    """
+    tc commands that install the fast path, the rewrite follows RewriteTable.send.
+
+    :param code: classic BPF program, frames it accepts are forwarded in the kernel
+    """
+    gateway_mac = MAC(bytes(gateway_mac))
+    ingress = ["filter", "add", "dev", iface, "ingress"]
+
+    def redirect(mac):
+        rewrite = ["action", "pedit", "ex", "munge", "eth", "dst", "set", str(mac), "munge", "eth", "src", "set", str(MAC(bytes(own_mac)))]
+        return rewrite + ["pipe", "action", "mirred", "egress", "redirect", "dev", iface]
+
+    commands = [
+        ["qdisc", "add", "dev", iface, "clsact"],
+        ingress + ["pref", "1", "protocol", "ip", "bpf", "bytecode", tc_bytecode(code), "action", "goto", "chain", REWRITE_CHAIN],
+    ]
+    rules = [(str(IP(ip)), gateway_mac if mac is None else mac) for ip, mac in sorted(macs.items())]
+    # the network and the broadcast address are not hosts of the network, the interceptor sends them to the gateway
+    rules += [(str(network.ip), gateway_mac), (str(network.broadcast()), gateway_mac)]
+    for pref, (ip, mac) in enumerate(rules, 1):
+        commands.append(ingress + ["chain", REWRITE_CHAIN, "pref", str(pref), "protocol", "ip", "flower", "dst_ip", ip] + redirect(mac))
+    # unknown hosts of the network continue to the interceptor, which drops them after the failed lookup
+    commands.append(ingress + ["chain", REWRITE_CHAIN, "pref", str(len(rules) + 1), "protocol", "ip", "flower", "dst_ip", str(network)])
+    commands[-1] += ["action", "pass"]
+    # everything else leaves the network through the gateway
+    commands.append(ingress + ["chain", REWRITE_CHAIN, "pref", str(len(rules) + 2), "protocol", "ip", "flower"] + redirect(gateway_mac))
+    return commands
+
+
+async def tc(*args, check=True):
+    process = await asyncio.create_subprocess_exec(TC, *args, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE)
+    _, stderr = await process.communicate()
+    if check and process.returncode != 0:
+        raise FastPathError("tc {} failed: {}".format(" ".join(args), stderr.decode(errors="replace").strip()))
+    return process.returncode
+
+
+class KernelFastPath:
+    """
+    Installs the fast path on one interface and replaces it when the nodes or the filters change.
+    The clsact qdisc of the interface belongs to the fast path, remove() deletes it with all its filters.
+    """
+
+    def __init__(self):
+        self.iface = None
+        self.commands = None
+
+    async def update(self, iface: str, code: bytes, own_mac, gateway_mac, macs: Dict[bytes, MAC], network: Network):
+        """Install the rules for the current configuration, nothing happens if it did not change"""
+        commands = fastpath_commands(iface, code, own_mac, gateway_mac, macs, network)
+        if commands == self.commands:
+            return
+        await self.remove()
+        # a clsact qdisc left behind by a crashed run would make the qdisc add fail
+        await tc("qdisc", "del", "dev", iface, "clsact", check=False)
+        self.iface = iface
+        try:
+            for command in commands:
+                await tc(*command)
+        except (FastPathError, OSError):
+            await self.remove()
+            raise
+        self.commands = commands
+
+    async def remove(self):
+        """Give all traffic back to the interceptor"""
+        if self.iface is not None:
+            await tc("qdisc", "del", "dev", self.iface, "clsact", check=False)
+        self.iface = None
+        self.commands = None
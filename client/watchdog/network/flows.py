@@ -0,0 +1,112 @@
+"""
+Flow table that caches per-flow results, e.g. the filters that match the packets of a flow.
+"""
+import struct
+import sys
+import time
+from collections import OrderedDict
+
+# the header fields that identify a flow: MAC addresses and ethertype, IPv4 header length, protocol, addresses and ports
+_FLOW_KEY = struct.Struct("15s8xc2x12s")
+FLOW_KEY_BYTES = set(range(0, 15)) | {23} | set(range(26, 38))
+# the ports behind an IPv4 header with options, relative to its end
+FLOW_KEY_TRANSPORT_BYTES = set(range(0, 4))
+
+
+def flow_key(packet):
+    """:return: hashable key of the flow of an EthernetII frame, None if the frame is too short to have one"""
+    if len(packet) < _FLOW_KEY.size:
+        return None
+    key = _FLOW_KEY.unpack_from(packet)
+    if packet[14] & 0xF == 5:
+        # no IPv4 options, the ports are at 34
+        return key
+    offset = 14 + 4 * (packet[14] & 0xF)
+    return key + (bytes(packet[offset : offset + 4]),)
+
+
+def header_only(trafficfilter):
+    """
+    :return: True if the filter only looks at fields of the flow key, so it has the same result for every packet of
+        a flow and can be cached per flow
+    """
+    stack = [trafficfilter.get_ast()]
+    while stack:
+        node = stack.pop()
+        if node.op == "LD":
+            if not FLOW_KEY_BYTES.issuperset(range(node.l, node.r)):
+                return False
+        elif node.op == "LDX":
+            if not FLOW_KEY_TRANSPORT_BYTES.issuperset(range(node.l, node.r)):
+                return False
+        elif node.op in ("AND", "OR", "EQ", "LT", "GT"):
+            stack += [node.l, node.r]
+        elif node.op in ("NOT", "IN", "MEQ"):
+            stack.append(node.l)
+    return True
+
+
+class FlowCache:
+    """
+    Bounded LRU table of flow key -> value with a time to live.
+    A full table evicts the least recently used flow; entries expire ttl seconds after they were added, so flows that
+    are not closed explicitly do not stay forever.
+    """
+
+    def __init__(self, size=65536, ttl=30.0):
+        self.size = size
+        self.ttl = ttl
+        self.table = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self.table)
+
+    def get(self, key, now=None):
+        """:return: the value of the flow, None if it is unknown or expired"""
+        entry = self.table.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        value, expires = entry
+        if expires < (time.monotonic() if now is None else now):
+            del self.table[key]
+            self.misses += 1
+            return None
+        self.table.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def put(self, key, value, now=None):
+        self.table[key] = (value, (time.monotonic() if now is None else now) + self.ttl)
+        self.table.move_to_end(key)
+        if len(self.table) > self.size:
+            self.table.popitem(last=False)
+            self.evictions += 1
+
+    def clear(self):
+        """Forget all flows, e.g. when the values they cache became invalid"""
+        self.table.clear()
+
+    def hit_rate(self):
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
+
+    def memory(self):
+        """:return: approximate size of the table in bytes"""
+        size = sys.getsizeof(self.table)
+        for key, entry in self.table.items():
+            size += sys.getsizeof(key) + sum(sys.getsizeof(field) for field in key) + sys.getsizeof(entry) + sys.getsizeof(entry[0])
+        return size
+
+    def stats(self):
+        return {
+            "flows": len(self.table),
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_rate": self.hit_rate(),
+            "memory": self.memory(),
+        }
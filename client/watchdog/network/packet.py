@@ -1,7 +1,14 @@
+import struct
 import time
 from math import ceil
+from typing import List
 
-from watchdog.network.checksums import fix_ip_checksum
+from watchdog.network.checksums import (
+    fix_ip_checksum,
+    internet_checksum,
+    ones_complement_sum,
+    update_checksum,
+)
 from watchdog.network.utils import IP, MAC, p16, u16
 
 
@@ -9,15 +16,165 @@ class FailedLookup(Exception):
     pass
 
 
+class PacketBuffer:
+    """
+    EthernetII (+ IPv4) frame in a bytearray that is modified in place.
+    The header offsets are computed once, the checksum fixes write into the frame and fragment() copies every byte of
+    the frame exactly once. update() changes a few bytes and adjusts the checksums incrementally instead of summing
+    the whole packet again. Frames that are not IPv4 pass through all operations unchanged.
+
+    :param frame: bytearray to modify in place, any other buffer (bytes, memoryview of a ring) is copied
+    """
+
+    __slots__ = ["data", "view", "ip_header_length", "transport_layer_offset"]
+
+    def __init__(self, frame):
+        self.data = frame if type(frame) is bytearray else bytearray(frame)
+        self.view = memoryview(self.data)
+        self.ip_header_length = 4 * (self.data[14] & 0xF) if len(self.data) > 14 else 0
+        self.transport_layer_offset = 14 + self.ip_header_length
+
+    def __len__(self):
+        return len(self.data)
+
+    def __bytes__(self):
+        return bytes(self.data)
+
+    def __eq__(self, other):
+        return type(self) == type(other) and self.data == other.data
+
+    def __repr__(self):
+        return "PacketBuffer({!r})".format(bytes(self.data))
+
+    def is_ipv4(self):
+        return len(self.data) >= 34 and self.data[12:14] == b"\x08\x00"
+
+    def protocol(self):
+        return self.data[23]
+
+    def set_ethernet_addresses(self, header):
+        """Overwrite destination and source MAC address with a 12 byte header"""
+        self.data[0:12] = header
+
+    def fix_ip_checksum(self):
+        if len(self.data) < 34:
+            # invalid IP packet
+            return
+        self.data[24:26] = b"\x00\x00"
+        self.data[24:26] = internet_checksum(self.view[14 : self.transport_layer_offset])
+
+    def _fix_transport_checksum(self, protocol, length, checksum_offset):
+        offset = self.transport_layer_offset + checksum_offset
+        self.data[offset : offset + 2] = b"\x00\x00"
+        # the pseudo header has an even length, so its sum and the sum of the segment add up without a copy
+        total = ones_complement_sum(self.view[26:34]) + protocol + length + ones_complement_sum(self.view[self.transport_layer_offset :])
+        while total >> 16:
+            total = (total & 0xFFFF) + (total >> 16)
+        checksum = ~total & 0xFFFF
+        if not checksum and protocol == 0x11:
+            checksum = 0xFFFF  # a computed UDP checksum of zero is sent as all ones
+        self.data[offset : offset + 2] = p16(checksum)
+
+    def _transport_checksum_offset(self):
+        """:return: offset of the TCP or UDP checksum, None if the packet has none"""
+        if not self.is_ipv4():
+            return None
+        offset = self.transport_layer_offset
+        if self.data[23] == 6 and len(self.data) >= offset + 18:
+            return offset + 16
+        if self.data[23] == 0x11 and len(self.data) >= offset + 8 and self.data[offset + 6 : offset + 8] != b"\x00\x00":
+            # a UDP checksum of zero means there is none
+            return offset + 6
+        return None
+
+    def update(self, offset, data):
+        """
+        Overwrite bytes at offset and update the IPv4 and TCP/UDP checksums incrementally (RFC 1624).
+        data must not change the length fields or overlap a checksum field.
+        """
+        start, end = offset & ~1, offset + len(data)
+        end += end & 1
+        old = bytes(self.data[start:end])
+        self.data[offset : offset + len(data)] = data
+        new = bytes(self.data[start:end])
+        if len(new) < end - start:
+            # the last byte of an odd length frame is summed with a zero byte
+            old, new = old + b"\x00", new + b"\x00"
+        if not self.is_ipv4():
+            return
+        # the checksummed ranges start at even offsets, so the changed words can be clipped to them
+        ranges = [(24, 14, self.transport_layer_offset)]
+        transport_checksum = self._transport_checksum_offset()
+        if transport_checksum is not None:
+            ranges += [(transport_checksum, 26, 34), (transport_checksum, self.transport_layer_offset, len(self.data) + 1)]
+        for checksum_offset, first, last in ranges:
+            clip_start, clip_end = max(start, first), min(end, last)
+            if clip_start >= clip_end:
+                continue
+            old_words = old[clip_start - start : clip_end - start]
+            new_words = new[clip_start - start : clip_end - start]
+            checksum = update_checksum(u16(self.data[checksum_offset : checksum_offset + 2]), old_words, new_words)
+            if not checksum and checksum_offset != 24 and self.data[23] == 0x11:
+                checksum = 0xFFFF  # a computed UDP checksum of zero is sent as all ones
+            self.data[checksum_offset : checksum_offset + 2] = p16(checksum)
+
+    def fix_udp_checksum(self):
+        data = self.data
+        if len(data) < 42 or data[23] != 0x11 or len(data) < self.transport_layer_offset + 8:
+            # invalid UDP packet
+            return
+        self._fix_transport_checksum(0x11, u16(data[self.transport_layer_offset + 4 : self.transport_layer_offset + 6]), 6)
+
+    def fix_tcp_checksum(self):
+        data = self.data
+        if len(data) < 54 or data[23] != 6:
+            # invalid TCP packet
+            return
+        self._fix_transport_checksum(6, u16(data[16:18]) - self.ip_header_length, 16)
+
+    def fragment(self, chunksize=1480) -> List["PacketBuffer"]:
+        """
+        Fragment the packet into chunks of size chunksize like fragment().
+        Like fragment(), packets with IP options are not fragmented, only some options may be copied into every fragment.
+        :return: [self] if the packet is small enough or has options, new buffers otherwise
+        """
+        assert chunksize % 8 == 0
+        data, offset = self.data, self.transport_layer_offset
+        payload = len(data) - offset
+        if chunksize <= 0 or not self.is_ipv4() or payload <= chunksize or self.ip_header_length != 20:
+            return [self]
+        fo = u16(data[20:22])
+        if (fo & 0b10) != 0:
+            return [self]
+        mf = (fo >> 13) & 0b1
+        fo &= 0b1111111111111
+        chunks = ceil(payload / chunksize)
+        fragments = []
+        for i in range(chunks):
+            start = offset + i * chunksize
+            end = min(start + chunksize, len(data))
+            frame = bytearray(offset + end - start)
+            frame[:offset] = self.view[:offset]
+            frame[offset:] = self.view[start:end]
+            struct.pack_into("!H", frame, 16, len(frame) - 14)
+            struct.pack_into("!H", frame, 20, (fo + i * (chunksize // 8)) | (1 if i < (chunks - 1) else mf) << 13)
+            packet = PacketBuffer(frame)
+            packet.fix_ip_checksum()
+            fragments.append(packet)
+        return fragments
+
+
 class Packet:
     def __init__(self, eth, macs, conf):
         self.bytes = eth
+        self.buffer = PacketBuffer(eth)
         self.__box_mac = conf.box.mac
         self.__macs = macs
         self.__network = conf.network
         self.__gateway = conf.gateway.mac
         self.__broadcast = False  # IP(dst).is_broadcast(conf.network)
-        self.__payload = eth[0xC:]
+        self.__src_mac = bytes(self.buffer.data[6:12])
+        self.__dst_mac = bytes(self.buffer.data[0:6])
         self.__sendable_packet = None
         self.__received_at = time.time()
 
@@ -30,15 +187,18 @@ class Packet:
             return self.__macs[dst]
 
     def get_sendable_packet(self):
-        data = self.bytes
-        srcip = IP(data[30:34])
-        return self.__lookup_ip(bytes(srcip)) + bytes(self.__box_mac) + data[12:]
+        """The frame with rewritten ethernet header, the header is rewritten in the buffer on the first call"""
+        if self.__sendable_packet is None:
+            data = self.buffer.data
+            self.buffer.set_ethernet_addresses(bytes(self.__lookup_ip(bytes(data[30:34]))) + bytes(self.__box_mac))
+            self.__sendable_packet = data
+        return self.__sendable_packet
 
     def src_ip(self):
-        return IP(self.get_sendable_packet()[0x1A : 0x1A + 4])
+        return IP(bytes(self.buffer.data[0x1A : 0x1A + 4]))
 
     def dst_ip(self):
-        return IP(self.get_sendable_packet()[0x1A + 4 : 0x1A + 8])
+        return IP(bytes(self.buffer.data[0x1A + 4 : 0x1A + 8]))
 
     def src_mac(self):
         return MAC(self.__src_mac)
@@ -50,20 +210,19 @@ class Packet:
         return self.__received_at
 
     def transport_protocol(self):
-        return self.get_sendable_packet()[23]
+        return self.buffer.protocol()
 
     def was_broadcast(self):
         return self.__broadcast
 
     def src_port(self):
-
         if self.transport_protocol() in [6, 17]:
-            return (self.get_sendable_packet()[34] << 8) + self.get_sendable_packet()[35]
+            return u16(self.buffer.data[self.buffer.transport_layer_offset : self.buffer.transport_layer_offset + 2])
         return None
 
     def dst_port(self):
         if self.transport_protocol() in [6, 17]:
-            return (self.get_sendable_packet()[36] << 8) + self.get_sendable_packet()[37]
+            return u16(self.buffer.data[self.buffer.transport_layer_offset + 2 : self.buffer.transport_layer_offset + 4])
         return None
 
 
@@ -85,7 +244,7 @@ def fragment(packet, chunksize=1480):
     if len(packet) < 34:
         return [packet]
     eth, ip, payload = packet[0:14], packet[14:34], packet[34:]
-    if chunksize <= 0 or len(payload) <= chunksize or len(ip) != 20 or eth[12:14] != b"\x08\x00":
+    if chunksize <= 0 or len(payload) <= chunksize or ip_header_length(packet) != 20 or eth[12:14] != b"\x08\x00":
         return [packet]
     else:
         res = []
@@ -0,0 +1,182 @@
+"""
+PACKET_MMAP capture and transmission on AF_PACKET sockets (TPACKET_V3).
+The kernel writes received frames into blocks of a ring that is shared with this process and reads frames to send
+from a second ring, so frames are exchanged without a syscall per frame. RxRing and TxRing have the same
+recv/recv_batch and send/send_batch methods as watchdog.network.batchio.BatchSocket.
+See https://www.kernel.org/doc/html/latest/networking/packet_mmap.html
+"""
+import asyncio
+import mmap
+import struct
+from socket import MSG_DONTWAIT
+from typing import List
+
+# linux/if_packet.h
+SOL_PACKET = 263
+PACKET_RX_RING = 5
+PACKET_VERSION = 10
+PACKET_LOSS = 14
+PACKET_TX_RING = 13
+TPACKET_V3 = 2
+
+TP_STATUS_KERNEL = 0
+TP_STATUS_USER = 1
+TP_STATUS_AVAILABLE = 0
+TP_STATUS_SEND_REQUEST = 1
+TP_STATUS_SENDING = 2
+TP_STATUS_WRONG_FORMAT = 4
+
+# struct tpacket_req3
+TPACKET_REQ3 = struct.Struct("7I")
+# struct tpacket_block_desc: version, offset_to_priv, block_status, num_pkts, offset_to_first_pkt
+BLOCK_DESC = struct.Struct("5I")
+# struct tpacket3_hdr: tp_next_offset, tp_sec, tp_nsec, tp_snaplen, tp_len, tp_status, tp_mac
+TPACKET3_HDR = struct.Struct("6IH")
+# TPACKET_ALIGN(sizeof(struct tpacket3_hdr)), frames to send start here without PACKET_TX_HAS_OFF
+TPACKET3_HDRLEN = 48
+
+
+def _setup_ring(sock, option, block_size, block_nr, frame_size, timeout):
+    sock.setsockopt(SOL_PACKET, PACKET_VERSION, TPACKET_V3)
+    frame_nr = block_nr * (block_size // frame_size)
+    sock.setsockopt(SOL_PACKET, option, TPACKET_REQ3.pack(block_size, block_nr, frame_size, frame_nr, timeout, 0, 0))
+    return mmap.mmap(sock.fileno(), block_size * block_nr, mmap.MAP_SHARED, mmap.PROT_READ | mmap.PROT_WRITE)
+
+
+class _Ring:
+    def __init__(self, sock, ring):
+        self.sock = sock
+        self.fd = sock.fileno()
+        self.ring = ring
+        self.view = memoryview(ring)
+
+    async def _wait(self, add, remove):
+        loop = asyncio.get_event_loop()
+        future = loop.create_future()
+
+        def ready():
+            remove(self.fd)
+            if not future.done():
+                future.set_result(None)
+
+        add(self.fd, ready)
+        try:
+            await future
+        finally:
+            remove(self.fd)
+
+    def close(self):
+        """Unmap the ring, it stays mapped until the last frame view is gone if views are still alive"""
+        self.view.release()
+        try:
+            self.ring.close()
+        except BufferError:
+            pass
+
+
+class RxRing(_Ring):
+    """
+    Receive ring of an AF_PACKET socket. Attach the BPF filter (watchdog.network.bpf) before creating the ring, so no
+    unfiltered frame ends up in a block.
+    recv_batch() hands out the frames of one block as read-only memoryviews into the ring. The block goes back to the
+    kernel with the next recv_batch() call or release(), the views must not be used afterwards: copy a frame with
+    bytes(frame) to keep it.
+
+    :param timeout: milliseconds after which the kernel hands out a block that is not full, the maximum added latency
+    """
+
+    def __init__(self, sock, block_size=1 << 20, block_nr=32, frame_size=2048, timeout=1):
+        super().__init__(sock, _setup_ring(sock, PACKET_RX_RING, block_size, block_nr, frame_size, timeout))
+        self.block_size = block_size
+        self.block_nr = block_nr
+        self.block = 0  # next block to read
+        self.pending = None  # block whose frames were handed out
+
+    def release(self):
+        """Give the block of the last recv_batch() back to the kernel"""
+        if self.pending is not None:
+            struct.pack_into("I", self.ring, self.pending * self.block_size + 8, TP_STATUS_KERNEL)
+            self.pending = None
+
+    def recv_batch(self) -> List[memoryview]:
+        """:return: the frames of the next block that is ready, an empty list if there is none"""
+        self.release()
+        offset = self.block * self.block_size
+        _, _, status, count, first = BLOCK_DESC.unpack_from(self.ring, offset)
+        if not status & TP_STATUS_USER:
+            return []
+        frames = []
+        position = offset + first
+        for _ in range(count):
+            next_offset, _, _, snaplen, _, _, mac = TPACKET3_HDR.unpack_from(self.ring, position)
+            frames.append(self.view[position + mac : position + mac + snaplen].toreadonly())
+            position += next_offset
+        self.pending = self.block
+        self.block = (self.block + 1) % self.block_nr
+        return frames
+
+    async def recv(self) -> List[memoryview]:
+        """Wait for the next block and return its frames"""
+        frames = self.recv_batch()
+        while not frames:
+            loop = asyncio.get_event_loop()
+            await self._wait(loop.add_reader, loop.remove_reader)
+            frames = self.recv_batch()
+        return frames
+
+    def close(self):
+        self.release()
+        super().close()
+
+
+class TxRing(_Ring):
+    """
+    Transmit ring of a bound AF_PACKET socket. send_batch() copies the frames into free slots of the ring and lets the
+    kernel send all of them with a single syscall.
+    Every send on the socket goes through the ring, so frames that are longer than a slot are dropped and counted in
+    oversized. The default slot fits every frame up to the usual MTU. Malformed frames are dropped by the kernel
+    (PACKET_LOSS) instead of stopping the ring.
+    """
+
+    def __init__(self, sock, block_size=1 << 16, block_nr=16, frame_size=2048):
+        sock.setsockopt(SOL_PACKET, PACKET_LOSS, 1)
+        super().__init__(sock, _setup_ring(sock, PACKET_TX_RING, block_size, block_nr, frame_size, 0))
+        self.frame_size = frame_size
+        self.frame_nr = block_nr * (block_size // frame_size)
+        self.frame = 0  # next slot to fill, the kernel sends the slots in the same order
+        self.oversized = 0
+
+    def send_batch(self, frames) -> int:
+        """
+        Send frames without blocking.
+
+        :return: number of frames that were queued or dropped, the others did not fit into the ring
+        """
+        queued = 0
+        for frame in frames:
+            if len(frame) > self.frame_size - TPACKET3_HDRLEN:
+                self.oversized += 1
+                queued += 1
+                continue
+            offset = self.frame * self.frame_size
+            if struct.unpack_from("I", self.ring, offset + 20)[0] not in (TP_STATUS_AVAILABLE, TP_STATUS_WRONG_FORMAT):
+                break
+            self.ring[offset + TPACKET3_HDRLEN : offset + TPACKET3_HDRLEN + len(frame)] = frame
+            struct.pack_into("I", self.ring, offset + 16, len(frame))  # tp_len
+            struct.pack_into("I", self.ring, offset + 20, TP_STATUS_SEND_REQUEST)
+            self.frame = (self.frame + 1) % self.frame_nr
+            queued += 1
+        if queued:
+            try:
+                self.sock.send(b"", MSG_DONTWAIT)
+            except BlockingIOError:
+                pass
+        return queued
+
+    async def send(self, frames):
+        """Send all frames, wait while the ring is full"""
+        sent = self.send_batch(frames)
+        while sent < len(frames):
+            loop = asyncio.get_event_loop()
+            await self._wait(loop.add_writer, loop.remove_writer)
+            sent += self.send_batch(frames[sent:])
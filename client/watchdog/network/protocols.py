@@ -1,7 +1,7 @@
 from struct import pack
 from typing import Union
 
-from watchdog.network.checksums import ocooc
+from watchdog.network.checksums import internet_checksum
 from watchdog.network.utils import IP, MAC, p16
 
 
@@ -29,7 +29,7 @@ def ip_packet(
     pckt += bytes(src)  # Source ip len == 4
     pckt += bytes(dst)  # Destination ip len == 4
     pckt += payload
-    return pckt[:10] + ocooc(pckt[:20]) + pckt[12:]  # Add checksum over headers
+    return pckt[:10] + internet_checksum(pckt[:20]) + pckt[12:]  # Add checksum over headers
 
 
 def arp_packet(
@@ -95,4 +95,4 @@ def icmp_echo(
     if timestamp is not None:
         pckt += pack("<II", int(timestamp), 0)
     pckt += payload
-    return pckt[:2] + ocooc(pckt) + pckt[4:]
+    return pckt[:2] + internet_checksum(pckt) + pckt[4:]
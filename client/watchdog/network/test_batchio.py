@@ -0,0 +1,83 @@
+import asyncio
+import socket
+
+import pytest
+
+from watchdog.network.batchio import HEADROOM, MAX_FRAME, BatchSocket, interface_snaplen
+
+
+@pytest.fixture
+def socket_pair():
+    a, b = socket.socketpair(socket.AF_UNIX, socket.SOCK_DGRAM)
+    for sock in (a, b):
+        sock.setblocking(False)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 1 << 20)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 1 << 20)
+    yield a, b
+    a.close()
+    b.close()
+
+
+@pytest.mark.parametrize("mmsg", [True, False])
+def test_batches_keep_frame_boundaries_and_order(socket_pair, mmsg):
+    a, b = socket_pair
+    sender, receiver = BatchSocket(a, 8, 2048, mmsg), BatchSocket(b, 8, 2048, mmsg)
+    frames = [bytes([i]) * (i + 1) for i in range(20)] + [bytearray(b"mutable"), memoryview(b"view"), bytearray()]
+    frames.append(memoryview(bytearray(b"writable view"))[2:])
+    assert sender.send_batch(frames) == len(frames)
+    # a socket that only sends has no receive buffers
+    assert sender.recv_msgs is None
+    received = receiver.recv_batch()
+    assert len(received) == 8
+    while len(received) < len(frames):
+        received += receiver.recv_batch()
+    assert received == [bytes(frame) for frame in frames]
+    assert receiver.recv_batch() == []
+
+
+@pytest.mark.parametrize("mmsg", [True, False])
+def test_long_frames_are_truncated_to_snaplen(socket_pair, mmsg):
+    a, b = socket_pair
+    a.send(b"x" * 100)
+    assert BatchSocket(b, 4, 64, mmsg).recv_batch() == [b"x" * 64]
+
+
+def test_snaplen_follows_the_mtu_of_the_interface(socket_pair):
+    assert interface_snaplen(socket_pair[0]) == MAX_FRAME
+    with socket.socket(socket.AF_PACKET, socket.SOCK_RAW, socket.htons(0x88B5)) as sock:
+        sock.bind(("lo", 0))
+        with open("/sys/class/net/lo/mtu") as f:
+            assert interface_snaplen(sock) == min(int(f.read()) + HEADROOM, MAX_FRAME)
+        receiver = BatchSocket(sock, 4)
+        sock.setblocking(False)
+        assert receiver.recv_batch() == [] and receiver.snaplen == interface_snaplen(sock)
+
+
+@pytest.mark.parametrize("mmsg", [True, False])
+def test_full_socket_buffer_stops_the_batch(mmsg):
+    a, b = socket.socketpair(socket.AF_UNIX, socket.SOCK_DGRAM)
+    try:
+        a.setblocking(False)
+        sent = BatchSocket(a, 64, 2048, mmsg).send_batch([b"x" * 1024] * 10000)
+        assert 0 < sent < 10000
+    finally:
+        a.close()
+        b.close()
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("mmsg", [True, False])
+async def test_async_send_waits_for_the_receiver(socket_pair, mmsg):
+    a, b = socket_pair
+    sender, receiver = BatchSocket(a, 64, 2048, mmsg), BatchSocket(b, 64, 2048, mmsg)
+    frames = [i.to_bytes(4, "big") * 64 for i in range(5000)]
+
+    async def receive():
+        received = []
+        while len(received) < len(frames):
+            received += await receiver.recv()
+        return received
+
+    task = asyncio.ensure_future(receive())
+    await sender.send(frames)
+    assert await asyncio.wait_for(task, 5) == frames
@@ -1,4 +1,15 @@
-from watchdog.network.checksums import fix_ip_checksum, u16
+import os
+import random
+
+import pytest
+
+from watchdog.network.checksums import (
+    fix_ip_checksum,
+    internet_checksum,
+    ocooc,
+    u16,
+    update_checksum,
+)
 
 tls_packet = (
     b"\xb8\x59\x9f\xbc\x24\x5e\xf8\x34\x41\x35\xaf\x16\x08\x00\x45\x00"
@@ -19,3 +30,27 @@ def test_ip_checksum_1():
 def test_ip_checksum_2():
     broken_checksum = tls_packet[:24] + b"\x00\x00" + tls_packet[26:]
     assert fix_ip_checksum(broken_checksum) == tls_packet
+
+
+@pytest.mark.parametrize("size", [0, 1, 2, 3, 20, 21, 1500, 65535])
+def test_internet_checksum_matches_ocooc(size):
+    for _ in range(20):
+        data = os.urandom(size)
+        assert internet_checksum(data) == ocooc(data)
+    assert internet_checksum(b"\xff" * size) == ocooc(b"\xff" * size)
+    assert internet_checksum(bytes(size)) == ocooc(bytes(size))
+
+
+def test_ocooc_folds_every_carry():
+    # 0xffff + 0xffff + 0x0001 = 0x1ffff, folded 0x10000 needs a second fold
+    assert ocooc(b"\xff\xff" * 2 + b"\x00\x01") == internet_checksum(b"\xff\xff" * 2 + b"\x00\x01") == b"\xff\xfe"
+
+
+def test_incremental_update_matches_full_checksum():
+    for _ in range(200):
+        data = bytearray(os.urandom(60))
+        checksum = u16(internet_checksum(data))
+        offset = random.randrange(0, 56, 2)
+        old, new = bytes(data[offset : offset + 4]), os.urandom(4)
+        data[offset : offset + 4] = new
+        assert update_checksum(checksum, old, new) == u16(internet_checksum(data))
@@ -0,0 +1,65 @@
+import pytest
+
+from watchdog.network.correct import (
+    RewriteTable,
+    correct_ethernet_header_receive,
+    correct_ethernet_header_send,
+)
+from watchdog.network.packet import FailedLookup
+from watchdog.network.utils import IP, MAC, Network
+
+NETWORK = Network("192.168.1.0/24")
+GATEWAY = MAC("aa:bb:cc:00:00:01")
+BOX = MAC("aa:bb:cc:00:00:02")
+MACS = {bytes(IP("192.168.1.10")): MAC("02:00:00:00:00:0a"), bytes(IP("192.168.1.11")): MAC("02:00:00:00:00:0b")}
+
+
+def frame(src, dst):
+    ip = b"\x45\x00\x00\x28\x00\x00\x40\x00\x40\x06\x00\x00" + bytes(IP(src)) + bytes(IP(dst))
+    return bytes(GATEWAY) + bytes(BOX) + b"\x08\x00" + ip + bytes(20)
+
+
+@pytest.mark.parametrize(
+    "src,dst", [("192.168.1.10", "192.168.1.11"), ("192.168.1.10", "1.1.1.1"), ("8.8.8.8", "192.168.1.11"), ("1.1.1.1", "192.168.1.255")]
+)
+def test_table_matches_the_functions(src, dst):
+    table = RewriteTable(GATEWAY, BOX, MACS, NETWORK)
+    eth = frame(src, dst)
+    for _ in range(2):  # the second lookup is served from the cache
+        assert table.receive(eth) == correct_ethernet_header_receive(eth, GATEWAY, MACS, NETWORK)
+        assert table.send(eth) == correct_ethernet_header_send(eth, GATEWAY, BOX, MACS, NETWORK)
+
+
+@pytest.mark.parametrize("src,dst", [("192.168.1.10", "192.168.1.99"), ("192.168.1.99", "1.1.1.1")])
+def test_unknown_hosts_of_the_network_fail_every_time(src, dst):
+    table = RewriteTable(GATEWAY, BOX, MACS, NETWORK)
+    for _ in range(2):
+        with pytest.raises(FailedLookup):
+            table.receive(frame(src, dst))
+    if dst == "192.168.1.99":
+        for _ in range(2):
+            with pytest.raises(FailedLookup):
+                table.send(frame(src, dst))
+
+
+def test_bytearrays_are_rewritten_in_place():
+    table = RewriteTable(GATEWAY, BOX, MACS, NETWORK)
+    eth = bytearray(frame("1.1.1.1", "192.168.1.10"))
+    assert table.send(eth) is eth
+    assert eth[:12] == bytes(MACS[bytes(IP("192.168.1.10"))]) + bytes(BOX)
+    view = memoryview(frame("1.1.1.1", "192.168.1.10")).toreadonly()
+    assert table.send(view) == eth
+
+
+def test_nodes_without_a_mac_are_reached_through_the_gateway():
+    table = RewriteTable(GATEWAY, BOX, {bytes(IP("192.168.1.12")): None}, NETWORK)
+    assert table.send(frame("1.1.1.1", "192.168.1.12"))[:12] == bytes(GATEWAY) + bytes(BOX)
+
+
+def test_cache_of_foreign_addresses_is_bounded():
+    table = RewriteTable(GATEWAY, BOX, MACS, NETWORK)
+    table.max_cached = 16
+    for i in range(100):
+        table.send(frame("192.168.1.10", "10.0.0.%d" % i))
+    assert len(table.macs) <= len(MACS) + 16
+    assert table.send(frame("1.1.1.1", "192.168.1.11"))[:6] == bytes(MACS[bytes(IP("192.168.1.11"))])
@@ -0,0 +1,49 @@
+from watchdog.network.counters import PacketCounters
+from watchdog.network.test_packet import udp_packet
+from watchdog.network.utils import IP, MAC
+
+DEVICE = bytes(IP("192.168.1.10"))
+MACS = {DEVICE: MAC("02:00:00:00:00:02"), bytes(IP("192.168.1.11")): None}
+
+
+def test_traffic_is_counted_per_device_and_direction():
+    counters = PacketCounters()
+    counters.assign(MACS)
+    upload = udp_packet(100)  # 192.168.1.10 -> 1.1.1.1
+    download = upload[:26] + upload[30:34] + upload[26:30] + upload[34:]
+    for packet in (upload, upload, download):
+        counters.count(packet)
+    devices = {device["ip"]: device for device in counters.snapshot()["devices"]}
+    assert devices["192.168.1.10"] == {
+        "up_packets": 2,
+        "up_bytes": 2 * len(upload),
+        "down_packets": 1,
+        "down_bytes": len(download),
+        "ip": "192.168.1.10",
+        "mac": "02:00:00:00:00:02",
+    }
+    # the internet side and the idle device
+    assert devices[None]["up_packets"] == 1 and devices[None]["down_packets"] == 2
+    assert "192.168.1.11" not in devices
+
+
+def test_slots_are_limited():
+    counters = PacketCounters(devices=1)
+    counters.assign({bytes(IP("192.168.1.11")): None})
+    counters.assign(MACS)
+    counters.count(udp_packet(10))
+    assert counters.slots == {bytes(IP("192.168.1.11")): 1}
+    assert counters.snapshot()["devices"][0]["ip"] is None
+
+
+def test_reset_starts_a_new_interval():
+    counters = PacketCounters()
+    counters.assign(MACS)
+    counters.count(udp_packet(10))
+    counters.drops += 1
+    first = counters.snapshot(reset=True)
+    assert first["drops"] == 1 and len(first["devices"]) == 2
+    second = counters.snapshot()
+    assert second["start"] == first["end"]
+    assert second["drops"] == 0 and second["devices"] == []
+    assert counters.slots.keys() == MACS.keys()
@@ -0,0 +1,103 @@
+import os
+import socket
+import struct
+from collections import Counter
+
+import pytest
+
+from watchdog.network.fanout import join_fanout
+
+ETH_P_EXPERIMENTAL = 0x88B5
+
+
+def frame(i):
+    return b"\xff" * 6 + b"\x02\x00\x00\x00\x00\x01" + ETH_P_EXPERIMENTAL.to_bytes(2, "big") + i.to_bytes(4, "big") * 15
+
+
+def udp_frame(src_port, ident=0, frag=0):
+    """IPv4/UDP frame from 10.99.0.1 to 10.99.0.2, frag is the flags and fragment offset field"""
+    payload = b"x" * 32
+    if not frag & 0x1FFF:
+        payload = struct.pack("!HHHH", src_port, 9, 8 + len(payload), 0) + payload
+    ip = struct.pack("!BBHHHBBH4s4s", 0x45, 0, 20 + len(payload), ident, frag, 64, 17, 0, b"\x0a\x63\x00\x01", b"\x0a\x63\x00\x02")
+    return b"\xff" * 6 + b"\x02\x00\x00\x00\x00\x01" + b"\x08\x00" + ip + payload
+
+
+def open_group(protocol):
+    """Two receivers in one fanout group on the loopback interface and a sender"""
+    receivers = [socket.socket(socket.AF_PACKET, socket.SOCK_RAW, socket.htons(protocol)) for _ in range(2)]
+    sender = socket.socket(socket.AF_PACKET, socket.SOCK_RAW, socket.htons(protocol))
+    for sock in receivers + [sender]:
+        sock.bind(("lo", 0))
+    for sock in receivers:
+        sock.setblocking(False)
+        join_fanout(sock, os.getpid(), "hash")
+    return receivers, sender
+
+
+@pytest.fixture
+def fanout_group():
+    receivers, sender = open_group(ETH_P_EXPERIMENTAL)
+    yield receivers, sender
+    for sock in receivers + [sender]:
+        sock.close()
+
+
+@pytest.fixture
+def ipv4_fanout_group():
+    receivers, sender = open_group(0x0800)
+    yield receivers, sender
+    for sock in receivers + [sender]:
+        sock.close()
+
+
+def drain(sock):
+    frames = []
+    while True:
+        try:
+            frames.append(sock.recv(2048))
+        except BlockingIOError:
+            return frames
+
+
+@pytest.mark.networktest
+def test_every_frame_reaches_one_receiver(fanout_group):
+    receivers, sender = fanout_group
+    frames = [frame(i) for i in range(200)]
+    for f in frames:
+        sender.send(f)
+    received = [drain(sock) for sock in receivers]
+    assert sorted(received[0] + received[1]) == sorted(frames)
+
+
+@pytest.mark.networktest
+def test_hash_mode_keeps_a_flow_on_one_receiver(fanout_group):
+    receivers, sender = fanout_group
+    for _ in range(50):
+        sender.send(frame(7))
+    counts = Counter(len(drain(sock)) for sock in receivers)
+    assert counts == Counter([50, 0])
+
+
+@pytest.mark.networktest
+def test_hash_mode_hashes_fragments_without_ports(ipv4_fanout_group):
+    receivers, sender = ipv4_fanout_group
+    for port in range(1000, 1064):
+        sender.send(udp_frame(port))
+        # first and second fragment of a datagram
+        sender.send(udp_frame(port, ident=port, frag=0x2000))
+        sender.send(udp_frame(0, ident=port, frag=4))
+    fragments, unfragmented = [], []
+    for sock in receivers:
+        frames = [f for f in drain(sock) if f[26:30] == b"\x0a\x63\x00\x01"]
+        fragments.append(sum(1 for f in frames if f[20:22] != b"\x00\x00"))
+        unfragmented.append(len(frames) - fragments[-1])
+    # the fragments of all datagrams between two addresses reach the same receiver
+    assert sorted(fragments) == [0, 128]
+    # the unfragmented packets are spread by their ports, so a flow with both kinds of packets can be split
+    assert sum(unfragmented) == 64 and 0 not in unfragmented
+
+
+def test_unknown_mode_is_rejected():
+    with pytest.raises(ValueError):
+        join_fanout(None, 1, "modulo")
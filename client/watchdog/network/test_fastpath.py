@@ -0,0 +1,93 @@
+import socket
+import subprocess  # nosec
+
+import pytest
+
+from watchdog.network.bpf import BPF_K, BPF_RET, bpf_stmt
+from watchdog.network.fastpath import FastPathError, KernelFastPath, fastpath_commands, tc_bytecode
+from watchdog.network.test_packet import udp_packet
+from watchdog.network.utils import IP, MAC, Network
+
+ACCEPT_ALL = bpf_stmt(BPF_RET | BPF_K, 0xFFFFFFFF)
+OWN_MAC = MAC("02:00:00:00:00:aa")
+GATEWAY_MAC = MAC("02:00:00:00:00:01")
+NODE_MAC = MAC("02:00:00:00:00:02")
+NETWORK = Network("192.168.1.0/24")
+MACS = {bytes(IP("192.168.1.2")): NODE_MAC, bytes(IP("192.168.1.3")): None}
+
+
+def test_tc_bytecode():
+    code = bpf_stmt(0x28, 12) + ACCEPT_ALL
+    assert tc_bytecode(code) == "2,40 0 0 12,6 0 0 4294967295"
+
+
+def test_commands_follow_the_rewrite_of_the_interceptor():
+    commands = fastpath_commands("eth0", ACCEPT_ALL, OWN_MAC, GATEWAY_MAC, MACS, NETWORK)
+    assert commands[0] == ["qdisc", "add", "dev", "eth0", "clsact"]
+    assert commands[1][-4:] == ["action", "goto", "chain", "1"]
+    rules = [(c[c.index("flower") + 2] if "dst_ip" in c else None, c[c.index("dst") + 2] if "pedit" in c else c[-1]) for c in commands[2:]]
+    assert rules == [
+        ("192.168.1.2", str(NODE_MAC)),
+        ("192.168.1.3", str(GATEWAY_MAC)),
+        ("192.168.1.0", str(GATEWAY_MAC)),
+        ("192.168.1.255", str(GATEWAY_MAC)),
+        ("192.168.1.0/24", "pass"),
+        (None, str(GATEWAY_MAC)),
+    ]
+    assert all(str(OWN_MAC) in c for c in commands[2:] if "pedit" in c)
+
+
+@pytest.fixture
+def veth():
+    """A veth pair, frames sent on the peer arrive on the ingress of fp0"""
+    try:
+        subprocess.run(["ip", "link", "add", "fp0", "type", "veth", "peer", "name", "fp1"], check=True, capture_output=True)  # nosec
+    except (OSError, subprocess.CalledProcessError):
+        pytest.skip("can not create a veth pair")
+    for iface in ("fp0", "fp1"):
+        subprocess.run(["ip", "link", "set", iface, "up"], check=True)  # nosec
+    yield "fp0", "fp1"
+    subprocess.run(["ip", "link", "del", "fp0"])  # nosec
+
+
+@pytest.mark.networktest
+@pytest.mark.asyncio
+async def test_frames_are_forwarded_in_the_kernel(veth):
+    iface, peer = veth
+    fastpath = KernelFastPath()
+    try:
+        await fastpath.update(iface, ACCEPT_ALL, OWN_MAC, GATEWAY_MAC, MACS, NETWORK)
+    except FastPathError as e:
+        pytest.skip("tc classifiers or actions are not available: {}".format(e))
+    sock = socket.socket(socket.AF_PACKET, socket.SOCK_RAW, socket.htons(0x800))
+    sock.bind((peer, 0))
+    sock.settimeout(1)
+    try:
+        packet = udp_packet(100)
+        # to 1.1.1.1, so it leaves through the gateway
+        sock.send(packet)
+        received = sock.recv(2048)
+        while received == packet:  # our own frame on the way out
+            received = sock.recv(2048)
+        assert received == bytes(GATEWAY_MAC) + bytes(OWN_MAC) + packet[12:]
+    finally:
+        sock.close()
+        await fastpath.remove()
+    assert fastpath.commands is None
+
+
+@pytest.mark.networktest
+@pytest.mark.asyncio
+async def test_leftover_qdisc_is_replaced(veth):
+    iface, _ = veth
+    # the qdisc of a crashed run
+    subprocess.run(["tc", "qdisc", "add", "dev", iface, "clsact"], check=True)  # nosec
+    fastpath = KernelFastPath()
+    try:
+        await fastpath.update(iface, ACCEPT_ALL, OWN_MAC, GATEWAY_MAC, MACS, NETWORK)
+    except FastPathError as e:
+        pytest.skip("tc classifiers or actions are not available: {}".format(e))
+    try:
+        assert fastpath.commands is not None
+    finally:
+        await fastpath.remove()
@@ -0,0 +1,63 @@
+from bitahoy_sdk.filter import UDP, Ethernet, IPv4, TrafficFilter
+
+from watchdog.network.flows import FlowCache, flow_key, header_only
+from watchdog.network.test_packet import udp_packet
+
+
+def test_flow_key_covers_the_flow_fields():
+    packet = udp_packet(100)
+    same_flow = packet[:18] + b"\x99\x99" + packet[20:42] + bytes(100)
+    other_port = packet[:34] + b"\x12\x34" + packet[36:]
+    assert flow_key(packet) == flow_key(same_flow)
+    assert flow_key(packet) != flow_key(other_port)
+    assert flow_key(memoryview(packet)) == flow_key(packet)
+    assert flow_key(packet[:37]) is None
+
+
+def test_flow_key_covers_ports_behind_ip_options():
+    packet = udp_packet(100)
+    options = packet[:14] + b"\x46" + packet[15:34] + bytes(4) + packet[34:]
+    other_port = options[:38] + b"\x12\x34" + options[40:]
+    assert flow_key(options) != flow_key(packet)
+    assert flow_key(options) != flow_key(other_port)
+    assert flow_key(options) == flow_key(memoryview(options))
+
+
+def test_only_header_filters_are_cacheable():
+    assert header_only(TrafficFilter(Ethernet.assert_ipv4 & IPv4.assert_udp & ((UDP.dst_port == 53) | (UDP.src_port == 53))))
+    assert header_only(TrafficFilter().negate())
+    assert not header_only(TrafficFilter(IPv4.ttl == 64))
+    assert not header_only(TrafficFilter(UDP.length == 8))
+    assert header_only(TrafficFilter(UDP.dst_port.isin([53, 853]) & IPv4.in_network(IPv4.source, "10.0.0.0/8")))
+    assert header_only(TrafficFilter(UDP.src_port > 1023))
+    assert not header_only(TrafficFilter(IPv4.ttl < 2))
+
+
+def test_least_recently_used_flow_is_evicted():
+    cache = FlowCache(size=2)
+    cache.put("a", 1)
+    cache.put("b", 2)
+    assert cache.get("a") == 1
+    cache.put("c", 3)
+    assert cache.get("b") is None
+    assert (cache.get("a"), cache.get("c")) == (1, 3)
+    assert (cache.hits, cache.misses, cache.evictions) == (3, 1, 1)
+
+
+def test_flows_expire():
+    cache = FlowCache(ttl=10)
+    cache.put("a", (), now=100)
+    assert cache.get("a", now=109) == ()
+    assert cache.get("a", now=111) is None
+    assert len(cache) == 0
+
+
+def test_stats():
+    cache = FlowCache()
+    cache.put(flow_key(udp_packet(10)), (0, 1))
+    cache.get(flow_key(udp_packet(10)))
+    cache.get(None)
+    stats = cache.stats()
+    assert stats["flows"] == 1 and stats["hit_rate"] == 0.5 and stats["memory"] > 0
+    cache.clear()
+    assert len(cache) == 0
@@ -0,0 +1,94 @@
+import os
+
+import pytest
+
+from watchdog.network.checksums import fix_ip_checksum, fix_tcp_checksum, fix_udp_checksum
+from watchdog.network.packet import PacketBuffer, fragment
+from watchdog.network.test_checksums import tls_packet
+from watchdog.network.utils import IP, p16
+
+
+def udp_packet(size, flags=0x4000):
+    payload = os.urandom(size)
+    udp = b"\x04\xd2\x00\x35" + p16(8 + len(payload)) + b"\x00\x00" + payload
+    ip = b"\x45\x00" + p16(20 + len(udp)) + b"\x12\x34" + p16(flags) + b"\x40\x11\x00\x00"
+    ip += bytes(IP("192.168.1.10")) + bytes(IP("1.1.1.1"))
+    return b"\x02\x00\x00\x00\x00\x01\x02\x00\x00\x00\x00\x02\x08\x00" + ip + udp
+
+
+def corrupt(packet, *offsets):
+    packet = bytearray(packet)
+    for offset in offsets:
+        packet[offset] ^= 0xFF
+    return bytes(packet)
+
+
+@pytest.mark.parametrize("packet", [tls_packet, udp_packet(100), udp_packet(1001)])
+def test_checksums_match_the_bytes_functions(packet):
+    broken = corrupt(packet, 24, 40, 50)
+    buffer = PacketBuffer(broken)
+    buffer.fix_ip_checksum()
+    buffer.fix_udp_checksum()
+    buffer.fix_tcp_checksum()
+    assert bytes(buffer) == fix_tcp_checksum(fix_udp_checksum(fix_ip_checksum(broken)))
+
+
+def test_tcp_checksum_is_restored():
+    buffer = PacketBuffer(tls_packet[:50] + b"\x00\x00" + tls_packet[52:])
+    buffer.fix_tcp_checksum()
+    assert bytes(buffer) == tls_packet
+
+
+@pytest.mark.parametrize("size,chunksize", [(100, 1480), (1480, 1480), (4000, 1480), (3000, 800)])
+def test_fragments_match_the_bytes_function(size, chunksize):
+    packet = udp_packet(size)
+    fragments = PacketBuffer(packet).fragment(chunksize)
+    assert [bytes(f) for f in fragments] == fragment(packet, chunksize)
+
+
+def test_packets_with_options_are_not_fragmented():
+    packet = udp_packet(3000)
+    # IHL 6 with a 4 byte record route option
+    packet = packet[:14] + b"\x46" + packet[15:16] + p16(24 + 3008) + packet[18:34] + b"\x07\x04\x04\x00" + packet[34:]
+    assert PacketBuffer(packet).fragment() == [PacketBuffer(packet)]
+    assert fragment(packet) == [packet]
+
+
+def test_computed_udp_checksum_of_zero_is_sent_as_all_ones():
+    buffer = PacketBuffer(udp_packet(100))
+    buffer.data[42:44] = b"\x00\x00"
+    buffer.fix_udp_checksum()
+    # adding the checksum as a payload word makes the ones' complement sum 0xFFFF, so the new checksum is zero
+    buffer.data[42:44] = buffer.data[40:42]
+    buffer.fix_udp_checksum()
+    assert buffer.data[40:42] == b"\xff\xff"
+    assert fix_udp_checksum(bytes(buffer))[40:42] == b"\x00\x00"
+
+
+def test_operations_work_in_place():
+    data = bytearray(udp_packet(100))
+    buffer = PacketBuffer(data)
+    buffer.set_ethernet_addresses(b"\xaa" * 12)
+    buffer.fix_udp_checksum()
+    assert buffer.data is data and data[:12] == b"\xaa" * 12
+    assert buffer.fragment() == [buffer]
+
+
+def test_non_ip_frames_pass_unchanged():
+    arp = b"\xff" * 6 + b"\x02" * 6 + b"\x08\x06" + bytes(28)
+    buffer = PacketBuffer(memoryview(arp))
+    buffer.fix_ip_checksum()
+    buffer.fix_udp_checksum()
+    assert bytes(buffer) == fix_ip_checksum(arp)
+    assert buffer.fragment(8) == [buffer]
+
+
+@pytest.mark.parametrize("packet", [tls_packet, udp_packet(100), udp_packet(101)])
+def test_update_keeps_the_checksums_valid(packet):
+    packet = fix_tcp_checksum(fix_udp_checksum(fix_ip_checksum(packet)))
+    buffer = PacketBuffer(packet)
+    # an address (ip and pseudo header), a port and payload at even and odd offsets
+    for offset, data in [(30, bytes(IP("10.0.0.1"))), (35, b"\x50"), (45, b"\x01\x02\x03"), (len(packet) - 1, b"\xff")]:
+        buffer.update(offset, data)
+        assert buffer.data[offset : offset + len(data)] == data
+        assert bytes(buffer) == fix_tcp_checksum(fix_udp_checksum(fix_ip_checksum(bytes(buffer))))
@@ -0,0 +1,75 @@
+import asyncio
+import socket
+
+import pytest
+
+from watchdog.network.packetring import RxRing, TxRing
+
+ETH_P_EXPERIMENTAL = 0x88B5
+
+
+def frame(i, size=60):
+    return b"\xff" * 6 + b"\x02\x00\x00\x00\x00\x01" + ETH_P_EXPERIMENTAL.to_bytes(2, "big") + i.to_bytes(4, "big") * (size // 4)
+
+
+@pytest.fixture
+def rings():
+    """Receive and transmit ring on the loopback interface for frames with an experimental ethertype"""
+    rx_sock = socket.socket(socket.AF_PACKET, socket.SOCK_RAW, socket.htons(ETH_P_EXPERIMENTAL))
+    tx_sock = socket.socket(socket.AF_PACKET, socket.SOCK_RAW, socket.htons(ETH_P_EXPERIMENTAL))
+    rx = RxRing(rx_sock, block_size=4096, block_nr=4, frame_size=2048)
+    tx = TxRing(tx_sock, block_size=4096, block_nr=4, frame_size=2048)
+    for sock in (rx_sock, tx_sock):
+        sock.setblocking(False)
+        sock.bind(("lo", 0))
+    yield rx, tx
+    rx.close()
+    tx.close()
+    rx_sock.close()
+    tx_sock.close()
+
+
+async def receive(rx, count):
+    received = []
+    while len(received) < count:
+        received += [bytes(view) for view in await rx.recv()]
+    return received
+
+
+@pytest.mark.asyncio
+@pytest.mark.networktest
+async def test_ring_roundtrip(rings):
+    rx, tx = rings
+    frames = [frame(i, 60 + i * 4) for i in range(6)]
+    assert tx.send_batch(frames) == len(frames)
+    assert await asyncio.wait_for(receive(rx, len(frames)), 2) == frames
+
+
+@pytest.mark.asyncio
+@pytest.mark.networktest
+async def test_ring_frames_are_readonly_views(rings):
+    rx, tx = rings
+    await tx.send([frame(1)])
+    views = await asyncio.wait_for(rx.recv(), 2)
+    assert type(views[0]) is memoryview and views[0].readonly
+    assert views[0] == frame(1)
+
+
+@pytest.mark.asyncio
+@pytest.mark.networktest
+async def test_rings_wrap_around(rings):
+    rx, tx = rings
+    # 8 slots in the tx ring and 4 blocks of 4 KiB in the rx ring
+    frames = [frame(i, 500) for i in range(200)]
+    for i in range(0, len(frames), 5):
+        await tx.send(frames[i : i + 5])
+        assert await asyncio.wait_for(receive(rx, 5), 2) == frames[i : i + 5]
+
+
+@pytest.mark.asyncio
+@pytest.mark.networktest
+async def test_frames_larger_than_a_slot_are_dropped(rings):
+    rx, tx = rings
+    assert tx.send_batch([frame(1), frame(2, 4000), frame(3)]) == 3
+    assert tx.oversized == 1
+    assert await asyncio.wait_for(receive(rx, 2), 2) == [frame(1), frame(3)]
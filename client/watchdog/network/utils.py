@@ -89,6 +89,10 @@ class MAC:
         elif type(mac) == bytes:
             assert len(mac) == 6
             self.mac = mac
+        elif type(mac) in (bytearray, memoryview):
+            # slices of captured frames, see watchdog.network.packetring
+            assert len(mac) == 6
+            self.mac = bytes(mac)
         else:
             raise NotImplementedError("MAC constructor does not support " + type(mac).__name__)
 
@@ -140,6 +144,8 @@ class IP:
         elif type(ip) == bytes:
             assert len(ip) == 4
             self.ip = ip
+        elif type(ip) in (bytearray, memoryview):
+            self.ip = bytes(ip)
         elif type(ip) == type(self):
             self.ip = ip.ip
         else: